@@ -0,0 +1,295 @@
+"""
+Throughput benchmarks of the analysis pipeline with synthetic inputs and mock plugins.
+
+    python -m benchmarks.bench                          # all scenarios, JSON to stdout
+    python -m benchmarks.bench -s batch -s stream --rows 50000 -o results.json
+    python -m benchmarks.bench --compare results.json   # fails on regressions
+
+Every scenario runs in its own process, so peak RSS is per scenario. Reported per scenario:
+rows/s, entities/s, peak RSS, mock plugin calls and busy time, memo hits, and the time of
+the stages read (CSV parsing only), parse (entity extraction on top of reading) and
+pipeline (the complete run with plugins).
+"""
+import argparse
+import copy
+import csv
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from benchmarks.mock_plugins import MockStats, make_mock_plugin  # noqa: E402
+from benchmarks.workload import WORKLOAD_DEFAULTS, generate_csv  # noqa: E402
+
+# Paths through the code: 'jobs' is the JobScheduler behind CsvWorker and the CLI for files,
+# 'stream' the CLI's sequential stdin path, 'worker' CsvWorker.run itself (needs PyQt5)
+PATHS = ('jobs', 'stream', 'worker')
+
+SCENARIO_DEFAULTS = dict(
+    WORKLOAD_DEFAULTS,
+    files=1,
+    path='jobs',
+    parsers=['ipv4 address'],
+    plugins=[{'mode': 'sync', 'latency': '0'}],
+    max_workers=32,
+    max_in_flight=4096,
+    parallel_files=4,
+    shards=1,
+)
+
+SCENARIOS = {
+    'fast-sync': {'rows': 20000},
+    'slow-async': {'rows': 5000, 'plugins': [{'mode': 'async', 'latency': 'uniform:1ms:20ms', 'failure_rate': 0.01}]},
+    'batch': {'rows': 20000, 'plugins': [{'mode': 'batch', 'latency': 'fixed:20ms', 'batch_size': 256}]},
+    'multi-file': {
+        'rows': 5000, 'files': 3,
+        'plugins': [{'mode': 'sync', 'latency': 'lognormal:2ms:0.5', 'max_concurrency': 16},
+                    {'mode': 'async', 'latency': 'uniform:1ms:5ms', 'error_rate': 0.01}],
+    },
+    'stream': {'rows': 20000, 'path': 'stream'},
+    # Every file split into 4 shards run by a process pool, however small the file
+    'sharded': {'rows': 20000, 'files': 2, 'shards': 4},
+    # An upstream refusing more than 8 concurrent calls; adaptive rate control has to find that
+    'throttling': {'rows': 5000, 'plugins': [{'mode': 'sync', 'latency': 'fixed:5ms', 'capacity': 8}]},
+    'parse-heavy': {
+        'rows': 20000, 'columns': 8, 'ip_density': 0.8, 'ipv6_ratio': 0.2,
+        'parsers': ['ipv4 address', 'ipv6 address', 'cidr network'],
+    },
+}
+
+# Regressions: throughput below, or peak RSS above, the baseline by more than this share
+DEFAULT_TOLERANCE = 0.15
+
+
+def scenario_config(name, overrides):
+    config = copy.deepcopy(SCENARIO_DEFAULTS)
+    config.update(copy.deepcopy(SCENARIOS[name]))
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    config['name'] = name
+    return config
+
+
+def stage_read(paths):
+    rows = 0
+    for path in paths:
+        with open(path, newline='') as f:
+            for _ in csv.reader(f):
+                rows += 1
+    return rows
+
+
+def stage_parse(paths, parser_set):
+    entities = 0
+    for path in paths:
+        with open(path, newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                for cell in row:
+                    entities += len(parser_set.findall(cell))
+    return entities
+
+
+def run_pipeline(config, paths, plugins, parser_set, engine, output_dir):
+    from core.jobs import JobScheduler
+    from core.pipeline import CsvProcessor
+
+    command_flags = {name: '' for name in plugins}
+    output_path = os.path.join(output_dir, 'output.csv')
+    if config['path'] == 'stream':
+        processor = CsvProcessor(plugins, command_flags, parser_set, engine)
+        with open(output_path, 'w', newline='') as outfile:
+            writer = csv.writer(outfile)
+            for index, path in enumerate(paths):
+                with open(path, newline='') as infile:
+                    processor.max_input_cols = None
+                    processor.process_csv(csv.reader(infile), writer, write_headers=index == 0)
+    elif config['path'] == 'worker':
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        from mass_ip_analysis import CsvWorker
+        worker = CsvWorker(paths, plugins, output_path, command_flags, parser_set, engine,
+                           parallel_files=config['parallel_files'])
+        worker.run()
+    else:
+        scheduler = JobScheduler(plugins, command_flags, parser_set, engine, paths, output_path,
+                                 parallel_files=config['parallel_files'], shards=config['shards'], shard_min_bytes=0)
+        failed = [job for job in scheduler.run() if job.state == 'failed']
+        if failed:
+            raise RuntimeError(f"{failed[0].input_path}: {failed[0].error}")
+
+
+def run_scenario(config):
+    """
+    Runs one scenario in this process and returns its metrics.
+    """
+    import logging
+    logging.disable(logging.CRITICAL)
+    from core.parsers import load_parsers, select_parsers
+    from core.metrics import metrics
+    from core.pipeline import create_engine
+
+    if config['path'] not in PATHS:
+        raise ValueError(f"Unknown path: {config['path']}")
+    with tempfile.TemporaryDirectory(prefix='mia-bench-') as work_dir:
+        paths = []
+        for index in range(config['files']):
+            path = os.path.join(work_dir, f"input{index}.csv")
+            generate_csv(path, config['rows'], config['columns'], config['cell_bytes'], config['ip_density'],
+                         config['duplicate_ratio'], config['ipv6_ratio'], config['seed'] + index)
+            paths.append(path)
+        input_bytes = sum(os.path.getsize(path) for path in paths)
+        parser_set = select_parsers(load_parsers('parser'), config['parsers'])
+
+        stages = {}
+        start = time.perf_counter()
+        rows = stage_read(paths) - len(paths)  # Without the headers
+        stages['read'] = time.perf_counter() - start
+        start = time.perf_counter()
+        entities = stage_parse(paths, parser_set)
+        stages['parse'] = max(0.0, time.perf_counter() - start - stages['read'])
+
+        stats = MockStats()
+        plugins = {}
+        for index, spec in enumerate(config['plugins']):
+            name = f"mock{index}_{spec.get('mode', 'sync')}"
+            plugins[name] = make_mock_plugin(name, stats=stats, seed=config['seed'] + index, **spec)
+        engine = create_engine(plugins, None, config['max_workers'], config['max_in_flight'])
+        start = time.perf_counter()
+        try:
+            run_pipeline(config, paths, plugins, parser_set, engine, work_dir)
+        finally:
+            engine.shutdown()
+        stages['pipeline'] = time.perf_counter() - start
+        hits, misses = engine.memo.stats()
+        counters = metrics.snapshot()[0]
+        # From the metrics, which include those of shard processes
+        calls = sum(value for (name, labels), value in counters.items() if name == 'mia_plugin_calls_total')
+        throttled = sum(value for (name, labels), value in counters.items()
+                        if name == 'mia_plugin_calls_total' and ('outcome', 'throttled') in labels)
+
+    pipeline = stages['pipeline'] or 1e-9
+    return {
+        'config': config,
+        'rows': rows,
+        'entities': entities,
+        'input_bytes': input_bytes,
+        'rows_per_s': round(rows / pipeline, 1),
+        'entities_per_s': round(entities / pipeline, 1),
+        # Shard processes count with their largest one
+        'peak_rss_kb': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                           resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+        'stages_s': {stage: round(seconds, 4) for stage, seconds in stages.items()},
+        'plugin_calls': calls,
+        'plugin_busy_s': round(stats.busy, 4),  # Without shard processes
+        'plugin_throttled': throttled,
+        'memo_hits': hits,
+        'memo_misses': misses,
+    }
+
+
+def run_isolated(config):
+    """
+    Runs a scenario in a child process, so its peak RSS is its own.
+    """
+    completed = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.bench', '--child', json.dumps(config)],
+        cwd=BASE_DIR, capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        return {'config': config, 'error': completed.stderr.strip().splitlines()[-1:] or ['failed']}
+    return json.loads(completed.stdout)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns (report lines, regression count) of results against a baseline results file.
+    """
+    lines = []
+    regressions = 0
+    for name, result in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if base is None or 'error' in base or 'error' in result:
+            lines.append(f"{name}: not comparable")
+            continue
+        if base.get('config') != result['config']:
+            lines.append(f"{name}: settings differ from the baseline, not comparable")
+            continue
+        for metric, higher_is_better in (('rows_per_s', True), ('entities_per_s', True), ('peak_rss_kb', False)):
+            if not base[metric]:
+                continue
+            ratio = result[metric] / base[metric]
+            regressed = ratio < 1 - tolerance if higher_is_better else ratio > 1 + tolerance
+            regressions += regressed
+            lines.append(f"{name} {metric}: {base[metric]} -> {result[metric]} ({ratio - 1:+.1%})"
+                         + (" REGRESSION" if regressed else ""))
+    return lines, regressions
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.bench', description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-s', '--scenario', action='append', choices=list(SCENARIOS),
+                        help='Scenario to run, can be repeated (default: all)')
+    parser.add_argument('--rows', type=int, help='Rows per input file')
+    parser.add_argument('--columns', type=int, help='Columns per row')
+    parser.add_argument('--cell-bytes', type=int, help='Filler bytes per cell')
+    parser.add_argument('--ip-density', type=float, help='Fraction of cells containing an address')
+    parser.add_argument('--duplicate-ratio', type=float, help='Fraction of addresses repeating earlier ones')
+    parser.add_argument('--files', type=int, help='Input files per scenario')
+    parser.add_argument('--path', choices=PATHS, help='Code path to run')
+    parser.add_argument('--shards', type=int, help="Shard processes per input file ('jobs' path)")
+    parser.add_argument('--latency', help="Latency of all mock plugins, e.g. 'fixed:5ms', 'uniform:1ms:20ms', 'lognormal:5ms:0.5'")
+    parser.add_argument('--failure-rate', type=float, help='Share of failed results of all mock plugins')
+    parser.add_argument('-o', '--output', help='Write the results JSON to this file instead of stdout')
+    parser.add_argument('--compare', metavar='BASELINE', help='Compare against an earlier results JSON, exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=f'Allowed deviation from the baseline (default: {DEFAULT_TOLERANCE})')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(sys.argv[1:] if argv is None else argv)
+    if args.child:
+        print(json.dumps(run_scenario(json.loads(args.child))))
+        return 0
+
+    overrides = {
+        'rows': args.rows, 'columns': args.columns, 'cell_bytes': args.cell_bytes, 'ip_density': args.ip_density,
+        'duplicate_ratio': args.duplicate_ratio, 'files': args.files, 'path': args.path, 'shards': args.shards,
+    }
+    results = {'python': sys.version.split()[0], 'scenarios': {}}
+    for name in args.scenario or SCENARIOS:
+        config = scenario_config(name, overrides)
+        for spec in config['plugins']:
+            if args.latency is not None:
+                spec['latency'] = args.latency
+            if args.failure_rate is not None:
+                spec['failure_rate'] = args.failure_rate
+        print(f"Running {name}...", file=sys.stderr)
+        results['scenarios'][name] = run_isolated(config)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(results, baseline, args.tolerance)
+        print('\n'.join(lines), file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+"""
+Mock plugins with configurable latency and failure distributions.
+
+make_mock_plugin registers a generated module under benchmarks.mock_plugins.<name>, so
+the plugin registry imports it like any plugin from the plugins folder. Shard processes
+are not forked from the benchmark, so the plugin dict carries what they need to register
+the same module when they unpickle it.
+"""
+import asyncio
+import random
+import re
+import sys
+import threading
+import time
+import types
+
+# Durations like '5ms', '0.2s' or plain seconds
+_DURATION = re.compile(r'\s*([0-9.]+)\s*(ms|s)?\s*')
+
+
+def parse_duration(value):
+    match = _DURATION.fullmatch(str(value))
+    if not match:
+        raise ValueError(f"Invalid duration: {value}")
+    return float(match.group(1)) / (1000 if match.group(2) == 'ms' else 1)
+
+
+def latency_sampler(spec, rng):
+    """
+    Returns a function drawing latencies in seconds from spec:
+    '0', 'fixed:5ms', 'uniform:1ms:20ms' or 'lognormal:<median>:<sigma>'.
+    """
+    kind, _, args = str(spec).partition(':')
+    args = args.split(':') if args else []
+    if kind in ('0', 'none'):
+        return lambda: 0.0
+    if kind == 'fixed':
+        value = parse_duration(args[0])
+        return lambda: value
+    if kind == 'uniform':
+        low, high = parse_duration(args[0]), parse_duration(args[1])
+        return lambda: rng.uniform(low, high)
+    if kind == 'lognormal':
+        median, sigma = parse_duration(args[0]), float(args[1])
+        return lambda: median * rng.lognormvariate(0, sigma)
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class MockStats:
+    """
+    Counts calls and the time mock plugins spent working, shared by all their threads.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, calls, busy):
+        with self._lock:
+            self.calls += calls
+            self.busy += busy
+
+
+class MockModule:
+    """
+    Recreates a mock plugin's module when unpickled, e.g. in a shard process. Calls made
+    there are counted by that process's own MockStats.
+    """
+
+    def __init__(self, name, options):
+        self.name = name
+        self.options = options
+
+    def __reduce__(self):
+        return _register_mock_module, (self.name, self.options)
+
+
+def _register_mock_module(name, options):
+    return make_mock_plugin(name, **options)['mock']
+
+
+def make_mock_plugin(name, mode='sync', latency='0', failure_rate=0.0, error_rate=0.0, stats=None,
+                     max_concurrency=None, batch_size=64, batch_latency=0.05, seed=1, capacity=None):
+    """
+    Creates a mock plugin and returns its plugin dict, as load_plugins would.
+
+    mode: 'sync' (run in a pool thread), 'async' (run_async on the engine's loop) or
+    'batch' (async run_batch, one latency sample per batch). failure_rate is the share of
+    results with success False, error_rate the share of calls raising an exception.
+    capacity simulates an upstream with a concurrency limit (sync and async modes): calls
+    above it are answered right away with a throttled failure.
+    """
+    rng = random.Random(seed)
+    sample = latency_sampler(latency, rng)
+    stats = stats if stats is not None else MockStats()
+    lock = threading.Lock()
+    running = [0]
+
+    def enter():
+        with lock:
+            running[0] += 1
+            return capacity is not None and running[0] > capacity
+
+    def leave():
+        with lock:
+            running[0] -= 1
+
+    def throttled():
+        stats.add(1, 0.0)
+        return {'success': False, 'result': f"mock {name} throttled", 'throttled': True}
+
+    def draw():
+        with lock:
+            return sample(), rng.random()
+
+    def answer(entity, roll):
+        if roll < error_rate:
+            raise RuntimeError(f"mock {name} error")
+        if roll < error_rate + failure_rate:
+            return {'success': False, 'result': f"mock {name} failure"}
+        return {'success': True, 'result': f"{name}:{entity}"}
+
+    def run(entity, command_flag=None):
+        try:
+            if enter():
+                return throttled()
+            delay, roll = draw()
+            time.sleep(delay)
+            stats.add(1, delay)
+            return answer(entity, roll)
+        finally:
+            leave()
+
+    async def run_async(entity, command_flag=None):
+        try:
+            if enter():
+                return throttled()
+            delay, roll = draw()
+            await asyncio.sleep(delay)
+            stats.add(1, delay)
+            return answer(entity, roll)
+        finally:
+            leave()
+
+    async def run_batch(entities, command_flag=None):
+        delay, _ = draw()
+        await asyncio.sleep(delay)
+        stats.add(1, delay)
+        results = {}
+        for entity in entities:
+            try:
+                results[entity] = answer(entity, draw()[1])
+            except RuntimeError as e:
+                results[entity] = {'success': False, 'result': str(e)}
+        return results
+
+    module_name = f"{__name__}.{name}"
+    module = types.ModuleType(module_name)
+    module.run = run
+    if mode == 'async':
+        module.run_async = run_async
+    elif mode == 'batch':
+        module.run_batch = run_batch
+    elif mode != 'sync':
+        raise ValueError(f"Unknown mock plugin mode: {mode}")
+    sys.modules[module_name] = module
+    options = {'mode': mode, 'latency': latency, 'failure_rate': failure_rate, 'error_rate': error_rate,
+               'max_concurrency': max_concurrency, 'batch_size': batch_size, 'batch_latency': batch_latency,
+               'seed': seed, 'capacity': capacity}
+    return {
+        'type': 'python', 'name': module_name, 'exec_order': 0, 'cache_ttl': 0,
+        'max_concurrency': max_concurrency,
+        'batch_size': batch_size if mode == 'batch' else 1,
+        'batch_latency': batch_latency,
+        'adaptive': True, 'max_rate': None, 'entity_classes': None, 'requires': None, 'conditions': None,
+        'timeout': None, 'mock': MockModule(name, options),
+    }
@@ -0,0 +1,54 @@
+"""
+Synthetic CSV inputs for the benchmarks.
+"""
+import csv
+import ipaddress
+import random
+import string
+
+# Workload defaults, overridable per scenario
+WORKLOAD_DEFAULTS = {
+    'rows': 10000,
+    'columns': 4,
+    'cell_bytes': 24,  # Filler text per cell, besides any address in it
+    'ip_density': 0.25,  # Fraction of cells containing an address
+    'duplicate_ratio': 0.5,  # Fraction of addresses repeating one seen before
+    'ipv6_ratio': 0.0,
+    'seed': 1,
+}
+
+
+def random_address(rng, ipv6_ratio):
+    if rng.random() < ipv6_ratio:
+        return str(ipaddress.IPv6Address(rng.getrandbits(128)))
+    # Public-looking IPv4 space, so plugins don't skip the addresses as private
+    return f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+
+
+def generate_csv(path, rows, columns, cell_bytes, ip_density, duplicate_ratio, ipv6_ratio=0.0, seed=1):
+    """
+    Writes a CSV with a header and rows x columns cells of filler text, some of which contain
+    an address. Returns the number of addresses written.
+    """
+    rng = random.Random(seed)
+    filler = string.ascii_letters + ' '
+    seen = []
+    addresses = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([f"column{index}" for index in range(columns)])
+        for _ in range(rows):
+            row = []
+            for _ in range(columns):
+                cell = ''.join(rng.choices(filler, k=cell_bytes))
+                if rng.random() < ip_density:
+                    if seen and rng.random() < duplicate_ratio:
+                        address = rng.choice(seen)
+                    else:
+                        address = random_address(rng, ipv6_ratio)
+                        seen.append(address)
+                    cell = f"{cell[:cell_bytes // 2]} {address} {cell[cell_bytes // 2:]}"
+                    addresses += 1
+                row.append(cell)
+            writer.writerow(row)
+    return addresses
@@ -0,0 +1,154 @@
+"""
+Classification of entities before any plugin runs: every entity gets one class, and
+plugins only receive the classes listed in their entity_classes setting.
+
+Classes come from prefix lists (classification.yaml) first, the most specific prefix over
+all lists winning, and otherwise from the address itself: global, private, loopback,
+link-local, multicast, reserved or unspecified. Networks (CIDR entities) are 'network',
+whatever their addresses, since plugins made for single addresses cannot look them up.
+Entities that are no IP address or network are 'other'.
+"""
+import hashlib
+import ipaddress
+import os
+from functools import lru_cache
+
+import yaml
+
+from core.prefix_index import PrefixIndex
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CLASSIFICATION_FILE = os.path.join(BASE_DIR, 'classification.yaml')
+
+BUILTIN_CLASSES = ('global', 'private', 'loopback', 'link-local', 'multicast', 'reserved', 'unspecified')
+NETWORK_CLASS = 'network'
+OTHER_CLASS = 'other'
+
+# Distinct entities whose class is kept, shared by all files of a run
+CLASSIFY_CACHE_SIZE = 65536
+
+
+class ClassificationError(ValueError):
+    """
+    An invalid classification file or prefix list.
+    """
+
+
+def builtin_class(address):
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    # Multicast first: ipaddress counts most of 224.0.0.0/4 as global
+    if address.is_multicast:
+        return 'multicast'
+    if address.is_global:
+        return 'global'
+    for name, test in (('unspecified', address.is_unspecified), ('loopback', address.is_loopback),
+                       ('link-local', address.is_link_local), ('private', address.is_private)):
+        if test:
+            return name
+    # e.g. shared address space (100.64.0.0/10) or documentation ranges
+    return 'reserved'
+
+
+class Classifier:
+    """
+    Classifies entities through a PrefixIndex of {prefix: class} and the built-in classes.
+    classify() is cached, so each distinct entity is classified once. Networks (CIDR
+    entities) are always NETWORK_CLASS.
+    """
+
+    def __init__(self, lists=None):
+        self.index = PrefixIndex()
+        self._lists = lists
+        self.lists = {}
+        for class_name, prefixes in (lists or {}).items():
+            self.lists[class_name] = len(prefixes)
+            for prefix in prefixes:
+                self.index.insert(prefix, class_name)
+        self._prefixes = sorted((str(prefix), class_name) for class_name, prefixes in (lists or {}).items()
+                                for prefix in prefixes)
+        self.classify = lru_cache(maxsize=CLASSIFY_CACHE_SIZE)(self._classify)
+
+    def __reduce__(self):
+        # The index and cache are rebuilt on unpickling, e.g. in shard processes
+        return Classifier, (self._lists,)
+
+    @property
+    def classes(self):
+        return tuple(self.lists) + BUILTIN_CLASSES + (NETWORK_CLASS, OTHER_CLASS)
+
+    def _classify(self, entity):
+        try:
+            address = ipaddress.ip_address(entity)
+        except ValueError:
+            try:
+                ipaddress.ip_network(entity, strict=False)
+            except ValueError:
+                return OTHER_CLASS
+            return NETWORK_CLASS
+        if len(self.index):
+            listed = self.index.get(address)
+            if listed is not None:
+                return listed
+        return builtin_class(address)
+
+    def fingerprint(self):
+        """
+        Identifies the prefix lists, e.g. for the settings of a run journal.
+        """
+        digest = hashlib.sha256(repr(self._prefixes).encode('utf-8'))
+        return digest.hexdigest()
+
+
+def read_prefix_file(path):
+    """
+    Reads one CIDR prefix or address per line; '#' starts a comment.
+    """
+    prefixes = []
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            prefix = line.split('#', 1)[0].strip()
+            if not prefix:
+                continue
+            try:
+                prefixes.append(ipaddress.ip_network(prefix, strict=False))
+            except ValueError as e:
+                raise ClassificationError(f"{path}:{line_number}: {e}")
+    return prefixes
+
+
+def load_classifier(path=None):
+    """
+    Builds the Classifier from a classification YAML, by default the one next to the
+    application; only built-in classes if that does not exist. List files are relative
+    to the YAML's folder.
+    """
+    if path is None:
+        path = DEFAULT_CLASSIFICATION_FILE
+        if not os.path.exists(path):
+            return Classifier()
+    with open(path, encoding='utf-8') as f:
+        try:
+            config = yaml.safe_load(f) or {}
+        except yaml.YAMLError as e:
+            raise ClassificationError(f"{path}: {e}")
+    if not isinstance(config, dict):
+        raise ClassificationError(f"{path}: not a mapping")
+    lists = {}
+    folder = os.path.dirname(os.path.abspath(path))
+    for class_name, source in (config.get('lists') or {}).items():
+        if class_name in BUILTIN_CLASSES or class_name == OTHER_CLASS:
+            raise ClassificationError(f"{path}: '{class_name}' is a built-in class")
+        source = source or {}
+        if not isinstance(source, dict):
+            raise ClassificationError(f"{path}: {class_name} needs files and/or prefixes")
+        prefixes = []
+        for prefix in source.get('prefixes') or []:
+            try:
+                prefixes.append(ipaddress.ip_network(str(prefix), strict=False))
+            except ValueError as e:
+                raise ClassificationError(f"{path}: {class_name}: {e}")
+        for list_file in source.get('files') or []:
+            prefixes += read_prefix_file(os.path.join(folder, list_file))
+        lists[class_name] = prefixes
+    return Classifier(lists)
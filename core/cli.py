@@ -0,0 +1,298 @@
+"""
+Headless command line interface: streams CSV from files or stdin through the selected
+plugins to a file or stdout, without importing PyQt5.
+
+    python mass_ip_analysis.py --headless -p geoip -p "nmap=-sT -p 22,80" logs.csv > out.csv
+    zcat logs.csv.gz | python -m core.cli -p whois > out.csv
+"""
+import argparse
+import csv
+import io
+import logging
+import os
+import signal
+import sqlite3
+import sys
+import threading
+
+from core.classify import ClassificationError, load_classifier
+from core.dependencies import DependencyPlan
+from core.jobs import DEFAULT_OUTPUT_MODE, MAX_PARALLEL_FILES, OUTPUT_MODES, JobScheduler
+from core.journal import JournalMismatch, default_journal_path
+from core.metrics import MetricsExporter, configure_logging, format_entity_classes, metrics
+from core.parsers import DEFAULT_PARSER, load_parsers, select_parsers
+from core.pipeline import (
+    COLUMN_LAYOUTS, DEFAULT_CACHE_FILE, DEFAULT_COLUMN_LAYOUT, MAX_IN_FLIGHT, MAX_WORKERS, CsvProcessor, create_engine
+)
+from core.plugins import load_plugins
+from core.records import RECORD_FORMATS, open_record_sink
+from core.remote import RemoteWorkers
+from core.result_cache import CACHE_MODES, ResultCache
+from core.shards import SHARD_MIN_BYTES
+
+
+def add_engine_arguments(parser):
+    """
+    Arguments shared by the GUI and the headless mode.
+    """
+    parser.add_argument('--cache-mode', choices=list(CACHE_MODES), default='refresh',
+                        help='use: serve any cached result, refresh: rerun results older than the plugin TTL, '
+                             'bypass: ignore cached results (default: refresh)')
+    parser.add_argument('--cache-file', default=DEFAULT_CACHE_FILE, help='Path of the SQLite result cache')
+    parser.add_argument('--max-workers', type=int, default=MAX_WORKERS,
+                        help=f'Size of the plugin thread pool (default: {MAX_WORKERS})')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT,
+                        help=f'Maximum number of plugin runs in flight over all input files (default: {MAX_IN_FLIGHT})')
+    parser.add_argument('--parallel-files', type=int, default=MAX_PARALLEL_FILES,
+                        help=f'Number of input files processed at the same time (default: {MAX_PARALLEL_FILES})')
+    parser.add_argument('--shards', type=int, default=1,
+                        help=f'Split input files of at least {SHARD_MIN_BYTES // (1024 * 1024)} MiB into this many parts, '
+                             'processed by as many processes (default: 1, no sharding). Sharded runs are not journaled')
+    parser.add_argument('--output-mode', choices=list(OUTPUT_MODES), default=DEFAULT_OUTPUT_MODE,
+                        help='; '.join(f'{name}: {text.lower()}' for name, text in OUTPUT_MODES.items()) +
+                             f' (default: {DEFAULT_OUTPUT_MODE})')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run from its journal, only rerunning missing plugin work')
+    parser.add_argument('--layout', choices=list(COLUMN_LAYOUTS), default=DEFAULT_COLUMN_LAYOUT,
+                        help='Where plugin result columns go: ' +
+                             '; '.join(f'{name}: {text.lower()}' for name, text in COLUMN_LAYOUTS.items()) +
+                             f' (default: {DEFAULT_COLUMN_LAYOUT})')
+    parser.add_argument('--agents', action='append', metavar='HOST:PORT[,HOST:PORT...]',
+                        help='Run the plugins on remote agents (python3 -m core.remote) instead of this host; '
+                             'can be repeated. Does not work with --shards')
+    parser.add_argument('--agent-token', default=os.environ.get('MIA_AGENT_TOKEN'),
+                        help='Shared secret of the agents (default: $MIA_AGENT_TOKEN)')
+    parser.add_argument('--records', metavar='PATH',
+                        help='Also write every result as a record of its own (input, line, entity, plugin, result) '
+                             f'to a SQLite database or JSON Lines file, by extension: {", ".join(RECORD_FORMATS)}. '
+                             'Does not work with --shards')
+    parser.add_argument('--classification', metavar='PATH',
+                        help='Prefix lists classifying entities, which decides the plugins that run on them '
+                             '(default: classification.yaml next to the application)')
+    parser.add_argument('--metrics-file', metavar='PATH',
+                        help='Write plugin latencies, error rates, queue depths and cache hit ratios to this file '
+                             'during the run: JSON for a .json file, Prometheus text format otherwise')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='Serve the metrics on http://127.0.0.1:PORT/metrics (Prometheus) and /metrics.json')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='Log debug output to stderr, -vv also logs every row and command')
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(prog='mass_ip_analysis.py --headless', description=__doc__.strip().split('\n')[0])
+    parser.add_argument('inputs', nargs='*', default=['-'], help="CSV files to analyse, '-' for stdin (default)")
+    parser.add_argument('-o', '--output', default='-', help="Output CSV file, '-' for stdout (default)")
+    parser.add_argument('-p', '--plugin', action='append', default=[], metavar='NAME[=FLAGS]',
+                        help='Plugin to run, optionally with command flags. Can be given several times.')
+    parser.add_argument('--parser', action='append', default=[], metavar='NAME',
+                        help=f"Parser to extract entities, repeat to extract several entity types in one pass (default: '{DEFAULT_PARSER}')")
+    parser.add_argument('--list', action='store_true', help='List available plugins and parsers and exit')
+    parser.add_argument('--no-cache', action='store_true', help='Do not open the persistent result cache')
+    parser.add_argument('--journal', metavar='PATH',
+                        help='Journal of finished plugin results for --resume (default: <output>.journal, '
+                             'none when writing to stdout)')
+    parser.add_argument('--no-journal', action='store_true', help='Do not journal results, the run cannot be resumed')
+    add_engine_arguments(parser)
+    return parser, parser.parse_args(argv)
+
+
+def select_plugins(plugins, specs):
+    """
+    Turns NAME[=FLAGS] specs into (selected_plugins, command_flags), keeping exec_order.
+    """
+    command_flags = {}
+    for spec in specs:
+        name, _, flags = spec.partition('=')
+        if name not in plugins:
+            raise ValueError(f"Unknown plugin '{name}', available: {', '.join(plugins)}")
+        command_flags[name] = flags
+    selected = {name: plugin for name, plugin in plugins.items() if name in command_flags}
+    return selected, command_flags
+
+
+def open_input(path):
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, newline='')
+    return open(path, newline='')
+
+
+def open_output(path):
+    if path == '-':
+        return io.TextIOWrapper(sys.stdout.buffer, newline='')
+    return open(path, 'w', newline='')
+
+
+def main(argv=None):
+    parser, args = parse_arguments(sys.argv[1:] if argv is None else argv)
+    configure_logging(args.verbose, sys.stderr)
+
+    plugins = load_plugins('plugins')
+    parsers = load_parsers('parser')
+    if args.list:
+        print("Plugins: " + ', '.join(plugins))
+        print("Parsers: " + ', '.join(parsers))
+        return 0
+    try:
+        parser_set = select_parsers(parsers, args.parser or [DEFAULT_PARSER])
+        selected_plugins, command_flags = select_plugins(plugins, args.plugin)
+        # Unknown conditions and plugins requiring each other are reported before any work starts
+        DependencyPlan(selected_plugins)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        classifier = load_classifier(args.classification)
+    except (ClassificationError, OSError) as e:
+        parser.error(f'cannot load the classification: {e}')
+    if not selected_plugins:
+        parser.error('no plugins selected, use -p NAME')
+
+    streaming = '-' in args.inputs
+    if args.output_mode == 'separate' and (streaming or args.output == '-'):
+        parser.error('--output-mode separate needs input files and an output file (-o)')
+    journal_path = None
+    if not args.no_journal and not streaming and args.shards <= 1:
+        journal_path = args.journal or (default_journal_path(args.output) if args.output != '-' else None)
+    if args.resume and args.shards > 1:
+        parser.error('--resume does not work with --shards')
+    if args.resume and journal_path is None:
+        parser.error('--resume needs input files and a journal (-o FILE or --journal PATH)')
+    if args.records is not None and args.shards > 1:
+        parser.error('--records does not work with --shards')
+    if args.layout == 'none' and args.records is None:
+        parser.error('--layout none leaves the results out of the CSV, use it with --records PATH')
+    if args.agents and args.shards > 1:
+        parser.error('--agents does not work with --shards')
+    record_sink = None
+    if args.records is not None:
+        try:
+            record_sink = open_record_sink(args.records)
+        except (ValueError, OSError, sqlite3.Error) as e:
+            parser.error(f'cannot write records to {args.records}: {e}')
+    try:
+        remote = start_remote_workers(agent_addresses(args.agents), selected_plugins, args.agent_token)
+    except (ValueError, OSError) as e:
+        if record_sink is not None:
+            record_sink.close()
+        parser.error(f'cannot use the agents: {e}')
+
+    try:
+        exporter = start_metrics_exporter(args)
+    except OSError as e:
+        # parser.error exits, so what was opened above is released here
+        if remote is not None:
+            remote.close()
+        if record_sink is not None:
+            record_sink.close()
+        parser.error(f'cannot serve metrics on port {args.metrics_port}: {e}')
+    cache = None if args.no_cache else ResultCache(args.cache_file, args.cache_mode)
+    engine = create_engine(selected_plugins, cache, args.max_workers, args.max_in_flight, remote)
+    # The scheduler opens output files itself, after the journal has been checked
+    outfile = open_output(args.output) if streaming or args.output == '-' else None
+    # Streamed output is flushed row by row so downstream commands see results immediately
+    flush_rows = args.output == '-'
+    failed = False
+    previous_handler = cancel_on_interrupt(engine)
+    try:
+        if streaming:
+            processor = CsvProcessor(selected_plugins, command_flags, parser_set, engine, layout=args.layout,
+                                     classifier=classifier, record_sink=record_sink)
+            stream_inputs(processor, args.inputs, outfile, flush_rows)
+        else:
+            # Files are processed in parallel; merged output still follows the input order
+            scheduler = JobScheduler(selected_plugins, command_flags, parser_set, engine, args.inputs, args.output,
+                                     args.output_mode, args.layout, args.parallel_files, classifier=classifier,
+                                     shards=args.shards, record_sink=record_sink)
+            if journal_path is not None:
+                scheduler.open_journal(journal_path, args.resume)
+            jobs = scheduler.run(outfile, flush_rows)
+            failed = any(job.state == 'failed' for job in jobs)
+        if outfile is not None:
+            outfile.flush()
+    except BrokenPipeError:
+        # The consumer (e.g. head) went away; nothing left to do
+        sys.stderr.close()
+        return 0
+    except (OSError, csv.Error, JournalMismatch) as e:
+        logging.error(f"Analysis failed: {e}")
+        return 1
+    finally:
+        signal.signal(signal.SIGINT, previous_handler)
+        # The final metrics still include the engine's queue and memo figures
+        for line in metrics.summary_lines():
+            logging.info(f"Metrics: {line}")
+        # Reported even without -v, which has it in the metrics summary
+        entity_classes = metrics.entity_class_counts()
+        if entity_classes and not args.verbose and not sys.stderr.closed:
+            print(format_entity_classes(entity_classes), file=sys.stderr)
+        if exporter is not None:
+            exporter.stop()
+        engine.shutdown(wait=False)
+        if cache is not None:
+            cache.close()
+        if outfile is not None and args.output != '-':
+            outfile.close()
+        if record_sink is not None:
+            record_sink.close()
+    if engine.cancelled:
+        return 130
+    return 1 if failed else 0
+
+
+def cancel_on_interrupt(engine):
+    """
+    Makes the first Ctrl-C cancel the engine, so the rows read so far are still written with
+    the results they got; a second one interrupts at once. Returns the previous handler.
+    """
+    def interrupt(signum, frame):
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        logging.warning("Interrupted, writing the rows read so far; press Ctrl-C again to stop at once")
+        # Not in the handler: the interrupted code may hold the engine's locks
+        threading.Thread(target=engine.cancel, name='cancel', daemon=True).start()
+
+    return signal.signal(signal.SIGINT, interrupt)
+
+
+def start_metrics_exporter(args):
+    """
+    Starts publishing metrics as asked for by --metrics-file / --metrics-port, or returns None.
+    """
+    if args.metrics_file is None and args.metrics_port is None:
+        return None
+    return MetricsExporter(args.metrics_file, args.metrics_port).start()
+
+
+def agent_addresses(values):
+    """
+    The addresses of repeated, comma-separated --agents values.
+    """
+    return [address.strip() for value in values or [] for address in value.split(',') if address.strip()]
+
+
+def start_remote_workers(addresses, plugins, token=None):
+    """
+    Connects to the agents and returns the RemoteWorkers, or None without addresses.
+    """
+    if not addresses:
+        return None
+    return RemoteWorkers(addresses, list(plugins), token).start()
+
+
+def stream_inputs(processor, inputs, outfile, flush_rows):
+    """
+    Processes the inputs one after another into a single stream with the first input's header.
+    Used when stdin is among the inputs, which can only be read sequentially.
+    """
+    writer = csv.writer(outfile)
+    flush = outfile.flush if flush_rows else None
+    for index, input_path in enumerate(inputs):
+        if input_path != '-':
+            processor.process_file(input_path, writer, write_headers=index == 0, flush=flush)
+            continue
+        # stdin can only be read once, so the 'scan' layout falls back to the header width
+        processor.max_input_cols = None
+        processor.source = input_path
+        with open_input(input_path) as infile:
+            processor.process_csv(csv.reader(infile), writer, write_headers=index == 0, flush=flush)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import os
+import signal
+
+from core.metrics import TRACE
+
+# Upper bound on concurrently running child processes per event loop
+MAX_PARALLEL = 256
+# Output beyond this many bytes is dropped and the command is stopped
+MAX_OUTPUT_BYTES = 1024 * 1024
+
+_semaphores = {}
+
+
+def configure(max_parallel=None, max_output_bytes=None):
+    global MAX_PARALLEL, MAX_OUTPUT_BYTES
+    if max_parallel is not None:
+        MAX_PARALLEL = max_parallel
+        _semaphores.clear()
+    if max_output_bytes is not None:
+        MAX_OUTPUT_BYTES = max_output_bytes
+
+
+def kill_process_group(process):
+    """
+    Kills a process started in a session of its own together with everything it started.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+
+
+def _semaphore():
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(MAX_PARALLEL)
+    return _semaphores[loop]
+
+
+async def run_command(argv, max_output_bytes=None):
+    """
+    Runs a command without a shell and returns (returncode, output).
+
+    stdout and stderr are merged, decoded as UTF-8 and stripped. If the output exceeds
+    max_output_bytes, the process is killed and the output is truncated.
+    Raises FileNotFoundError if the executable does not exist.
+
+    The command runs in a process group of its own, which is killed when the coroutine is
+    cancelled (e.g. by a plugin timeout), so no children of it are left behind.
+    """
+    limit = max_output_bytes or MAX_OUTPUT_BYTES
+    async with _semaphore():
+        if logging.getLogger().isEnabledFor(TRACE):
+            logging.log(TRACE, f"Executing command: {argv}")
+        process = await asyncio.create_subprocess_exec(
+            *argv, stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True
+        )
+        chunks = []
+        size = 0
+        truncated = False
+        try:
+            while True:
+                chunk = await process.stdout.read(65536)
+                if not chunk:
+                    break
+                if size + len(chunk) > limit:
+                    chunks.append(chunk[:limit - size])
+                    truncated = True
+                    kill_process_group(process)
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+            returncode = await process.wait()
+        except BaseException:
+            kill_process_group(process)
+            raise
+
+    output = b''.join(chunks).decode('utf-8', errors='replace').strip()
+    if truncated:
+        output += f"\n[output truncated after {limit} bytes]"
+    return returncode, output
@@ -0,0 +1,145 @@
+"""
+Dependencies between plugins. A plugin's `requires` in its YAML lists conditions on the
+results other plugins produced for the same entity; the plugin only runs for an entity once
+they are all met, otherwise its run is skipped:
+
+    requires: [ping.up]                         # a condition named in ping.yaml
+    requires: [geoip.success]                   # built-in: success or failed
+    requires: ["geoip !~ (Narnia|Atlantis)"]    # ~ / !~ a regular expression
+
+Named conditions are declared by the plugin producing the result, as regular expressions
+matched against its successful results (`conditions: {up: '\\bUP\\b'}` in ping.yaml).
+A `~` condition is met by a successful result matching the expression, a `!~` condition by
+any result not matching it.
+
+Requirements only apply where the required plugin runs on the entity too: they are ignored
+if it is not selected or does not take the entity's class.
+"""
+import re
+
+# "plugin.condition" and "plugin ~ regex" / "plugin !~ regex"
+NAMED_REQUIREMENT = re.compile(r'^([\w-]+)\.([\w-]+)$')
+PATTERN_REQUIREMENT = re.compile(r'^([\w-]+)\s*(!?~)\s*(.+)$')
+
+BUILTIN_CONDITIONS = {
+    'success': lambda result: bool(result.get('success')),
+    'failed': lambda result: not result.get('success'),
+}
+
+
+class DependencyError(ValueError):
+    """
+    An invalid requirement, or plugins requiring each other.
+    """
+
+
+def parse_requirement(spec):
+    """
+    Splits a requirement into (plugin, operator, operand): operator is '.' for a named
+    condition, '~' or '!~' for a regular expression. Raises DependencyError.
+    """
+    match = NAMED_REQUIREMENT.match(spec.strip())
+    if match:
+        return match.group(1), '.', match.group(2)
+    match = PATTERN_REQUIREMENT.match(spec.strip())
+    if match is None:
+        raise DependencyError(f"'{spec}' is no requirement, use plugin.condition or plugin ~ regex")
+    try:
+        re.compile(match.group(3))
+    except re.error as e:
+        raise DependencyError(f"'{spec}': {e}")
+    return match.groups()
+
+
+def _matches(pattern):
+    regex = re.compile(pattern)
+    return lambda result: bool(result.get('success')) and regex.search(str(result.get('result'))) is not None
+
+
+class Requirement:
+    """
+    A condition on the result of the plugin named plugin.
+    """
+
+    def __init__(self, spec, plugins):
+        self.spec = spec
+        self.plugin, operator, operand = parse_requirement(spec)
+        if operator == '~':
+            self.check = _matches(operand)
+        elif operator == '!~':
+            matches = _matches(operand)
+            self.check = lambda result: not matches(result)
+        elif operand in BUILTIN_CONDITIONS:
+            self.check = BUILTIN_CONDITIONS[operand]
+        else:
+            conditions = plugins[self.plugin].get('conditions') or {}
+            if operand not in conditions:
+                raise DependencyError(f"'{spec}': {self.plugin} has no condition {operand}, "
+                                      f"only: {', '.join(list(conditions) + list(BUILTIN_CONDITIONS))}")
+            self.check = _matches(conditions[operand])
+
+    def met(self, result):
+        return isinstance(result, dict) and self.check(result)
+
+
+def skipped_result(requirement):
+    return {'success': False, 'result': f"Skipped, {requirement.spec} not met", 'skipped': True}
+
+
+class DependencyPlan:
+    """
+    The requirements between the plugins of a run. order is the plugin names with every
+    plugin after the plugins it requires (by exec_order otherwise); raises DependencyError
+    for plugins requiring each other.
+    """
+
+    def __init__(self, plugins):
+        self.requirements = {}
+        for name, plugin in plugins.items():
+            requirements = []
+            for spec in plugin.get('requires') or []:
+                if parse_requirement(spec)[0] in plugins:
+                    requirements.append(Requirement(spec, plugins))
+            self.requirements[name] = requirements
+        self.gated = any(self.requirements.values())
+        self.order = self._sort(list(plugins))
+
+    def _sort(self, names):
+        order = []
+        visiting = []
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                cycle = visiting[visiting.index(name):] + [name]
+                raise DependencyError(f"Plugins require each other: {' -> '.join(cycle)}")
+            visiting.append(name)
+            for requirement in self.requirements[name]:
+                visit(requirement.plugin)
+            visiting.pop()
+            order.append(name)
+
+        for name in names:
+            visit(name)
+        return order
+
+    def gate(self, plugin_name, futures):
+        """
+        For a plugin run on an entity, given {plugin: future} of the runs scheduled for it so
+        far: None if it can start right away, otherwise (prerequisites, decide), where decide()
+        returns None once the plugin may run or the skipped result to use instead.
+        """
+        requirements = [requirement for requirement in self.requirements[plugin_name]
+                        if requirement.plugin in futures]
+        if not requirements:
+            return None
+        prerequisites = [futures[requirement.plugin] for requirement in requirements]
+
+        def decide():
+            for requirement, prerequisite in zip(requirements, prerequisites):
+                if not requirement.met(prerequisite.result()):
+                    return skipped_result(requirement)
+            return None
+
+        return prerequisites, decide
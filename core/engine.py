@@ -0,0 +1,565 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+
+from core import command_runner
+from core.memo import ResultMemo
+from core.metrics import metrics
+from core.plugins import (
+    batch_mode, execute_plugin, execute_plugin_async, execute_plugin_batch, execute_plugin_batch_async,
+    execute_plugin_remote, result_outcome, supports_async
+)
+from core.ratelimit import AimdController
+
+# Times a plugin run with a throttled result is queued again before the result is kept
+THROTTLE_RETRIES = 3
+
+# How often a submit waiting for an in-flight slot checks whether the run was cancelled
+SLOT_WAIT_INTERVAL = 0.2
+
+# Seconds shutdown waits for the coroutines it cancels to kill their commands
+CANCEL_GRACE_SECONDS = 5
+
+CANCELLED_RESULT = {'success': False, 'result': "Cancelled", 'cancelled': True}
+
+
+def timed_out_result(timeout):
+    return {'success': False, 'result': f"Timed out after {timeout:g} s", 'timed_out': True}
+
+
+class PluginEngine:
+    """
+    Runs (plugin, entity) tasks concurrently on a bounded thread pool.
+
+    Every plugin gets its own concurrency cap (max_concurrency in the plugin YAML), so a
+    slow tool like nmap cannot occupy all workers. Tasks above a plugin's cap wait in a
+    per-plugin queue instead of blocking a worker thread. Results are deduplicated through
+    the run's ResultMemo and read from / written to the optional persistent ResultCache.
+
+    Plugins exposing run_async are driven as coroutines on one shared event loop thread
+    instead of occupying a pool thread each. Plugins exposing run_batch get their pending
+    entities grouped into chunks of batch_size, flushed at the latest after batch_latency
+    seconds; each chunk is one invocation and counts once against the concurrency cap.
+
+    max_in_flight caps the plugin runs submitted but not finished yet, over all plugins and
+    all callers sharing the engine (e.g. several input files). submit blocks while the cap
+    is reached, which keeps fast readers from queueing unbounded work.
+
+    The concurrency cap and request rate of every plugin adapt to its outcomes through an
+    AimdController: results marked throttled cut both, successful ones raise them back up to
+    the ceilings (max_concurrency and max_rate in the plugin YAML). Plugins with
+    'adaptive: false' keep their fixed cap. A throttled single-entity run is queued again,
+    up to THROTTLE_RETRIES times, before its result is kept.
+
+    A run submitted with prerequisites (see core/dependencies.py) waits until their futures
+    are done and is then started, or skipped, by a dispatcher thread, so callbacks of other
+    plugins never block on the engine's caps. Dependent runs released together are started
+    as one batch instead of waiting for their batch to fill.
+
+    A plugin with a timeout in its YAML gets a timed-out result for every invocation (a
+    single run or a batch) that takes longer; coroutines are cancelled, which kills the
+    commands they started (see core/command_runner.py), while a thread running a sync
+    plugin is left to finish on its own and its result is dropped. cancel() stops a run the
+    same way for all tasks: queued ones are dropped and every pending result resolves
+    with a cancelled result at once.
+
+    With remote (a RemoteWorkers, see core/remote.py), plugins run on remote agents instead:
+    single runs and batches become tasks for the agents, and the concurrency caps are those
+    of one host times the number of agents. The engine closes remote on shutdown.
+
+    While running, the engine reports its queue depths, limits and memo hits to the shared metrics.
+    """
+
+    def __init__(self, plugins, memo=None, cache=None, max_workers=32, max_in_flight=None, remote=None):
+        self.plugins = plugins
+        self.remote = remote
+        self.memo = memo if memo is not None else ResultMemo()
+        self.cache = cache
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight
+        self._slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='plugin')
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._active = {name: 0 for name in plugins}
+        self._queued = {name: deque() for name in plugins}
+        self._async_plugins = {name for name, plugin in plugins.items() if supports_async(plugin)}
+        self._batch_modes = {name: batch_mode(plugin) for name, plugin in plugins.items()}
+        self._batchers = {}
+        self._deferred = queue.SimpleQueue()
+        self._dispatcher = None
+        self.cancelled = False
+        needs_loop = remote is None and (self._async_plugins or 'async' in self._batch_modes.values())
+        self._loop = AsyncLoop() if needs_loop else None
+        self._controllers = {
+            name: AimdController(self.concurrency_ceiling(name), plugin.get('max_rate'))
+            for name, plugin in plugins.items() if plugin.get('adaptive', True)
+        }
+        metrics.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        """
+        Gauges for the metrics snapshot: per-plugin queue depths, plugin runs in flight and memo lookups.
+        """
+        with self._lock:
+            gauges = [('mia_in_flight', {}, self._in_flight)]
+            for name in self.plugins:
+                gauges.append(('mia_plugin_queued', {'plugin': name}, len(self._queued[name])))
+                gauges.append(('mia_plugin_active', {'plugin': name}, self._active[name]))
+                controller = self._controllers.get(name)
+                if controller is not None:
+                    gauges.append(('mia_plugin_concurrency_limit', {'plugin': name}, controller.limit))
+                    gauges.append(('mia_plugin_rate_limit', {'plugin': name}, round(controller.rate or 0, 3)))
+        hits, misses = self.memo.stats()
+        gauges.append(('mia_memo_lookups', {'result': 'hit'}, hits))
+        gauges.append(('mia_memo_lookups', {'result': 'miss'}, misses))
+        return gauges
+
+    def concurrency_limit(self, plugin_name):
+        """
+        The plugin's current cap on concurrently running tasks.
+        """
+        controller = self._controllers.get(plugin_name)
+        if controller is not None:
+            return controller.limit
+        return self.concurrency_ceiling(plugin_name)
+
+    def concurrency_ceiling(self, plugin_name):
+        declared = self.plugins[plugin_name].get('max_concurrency')
+        if self.remote is not None:
+            # Every agent enforces the plugin's own cap
+            return (declared or self.max_workers) * self.remote.agent_count
+        if plugin_name in self._async_plugins:
+            # Coroutines do not occupy pool threads, only the runner's process slots
+            return declared or command_runner.MAX_PARALLEL
+        return min(declared or self.max_workers, self.max_workers)
+
+    def submit(self, plugin_name, entity, command_flag="", after=None):
+        """
+        Schedules a plugin run and returns a Future resolving to its result dict.
+
+        With after=(prerequisites, decide), the run waits for the prerequisite futures;
+        decide() then returns None to start it or the result to resolve with instead.
+        """
+        if self.cancelled:
+            return _resolved(CANCELLED_RESULT)
+        key = (plugin_name, entity, command_flag)
+        if self._batch_modes[plugin_name]:
+            launch = lambda: self._add_to_batch(plugin_name, entity, command_flag)
+        else:
+            launch = lambda: self._schedule(plugin_name, lambda: self._run_single(plugin_name, entity, command_flag))
+        if after is not None:
+            return self.memo.get_or_submit(key, lambda: self._defer(plugin_name, command_flag, launch, *after))
+        # Memo hits return right away; only actual runs take an in-flight slot
+        return self.memo.get_or_submit(key, lambda: self._start_in_slot(launch))
+
+    def _defer(self, plugin_name, command_flag, launch, prerequisites, decide):
+        future = Future()
+        waiting = [len(prerequisites)]
+        lock = threading.Lock()
+
+        def prerequisite_done(done):
+            with lock:
+                waiting[0] -= 1
+                if waiting[0]:
+                    return
+            self._deferred.put((plugin_name, command_flag, launch, decide, future))
+
+        with self._lock:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name='plugin-deps', daemon=True)
+                self._dispatcher.start()
+        for prerequisite in prerequisites:
+            prerequisite.add_done_callback(prerequisite_done)
+        return future
+
+    def _dispatch(self):
+        while True:
+            item = self._deferred.get()
+            batches = set()
+            # Drain what is ready, then start the batches it filled
+            while item is not None:
+                plugin_name, command_flag, launch, decide, future = item
+                try:
+                    # Cancelled runs are not skipped: starting them resolves them as cancelled
+                    skipped = None if self.cancelled else decide()
+                    if skipped is not None:
+                        metrics.inc('mia_plugin_skipped_total', plugin=plugin_name)
+                        future.set_result(skipped)
+                    else:
+                        self._start_in_slot(launch).add_done_callback(lambda done, future=future: _chain_future(done, future))
+                        if self._batch_modes[plugin_name]:
+                            batches.add((plugin_name, command_flag))
+                except Exception as e:
+                    future.set_exception(e)
+                try:
+                    item = self._deferred.get_nowait()
+                except queue.Empty:
+                    break
+            for key in batches:
+                with self._lock:
+                    batcher = self._batchers.get(key)
+                if batcher is not None:
+                    batcher.flush()
+            if item is None:
+                return
+
+    def _start_in_slot(self, launch):
+        if self._slots is not None and not self._slots.acquire(blocking=False):
+            # Waiting for running work, so start partial batches instead of letting them idle
+            self.flush_batches()
+            while not self._slots.acquire(timeout=SLOT_WAIT_INTERVAL):
+                if self.cancelled:
+                    return _resolved(CANCELLED_RESULT)
+        with self._lock:
+            self._in_flight += 1
+        try:
+            running = launch()
+        except BaseException:
+            self._release_slot()
+            raise
+        running.add_done_callback(lambda done: self._release_slot())
+        return running
+
+    def _release_slot(self):
+        with self._lock:
+            self._in_flight -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+    def _run_single(self, plugin_name, entity, command_flag):
+        if self.remote is not None:
+            running = Future()
+            batch = execute_plugin_remote(self.plugins[plugin_name], [entity], command_flag, self.cache, self.remote)
+            batch.add_done_callback(lambda done: _settle(running, done.result()[entity]))
+        else:
+            task = (self.plugins[plugin_name], entity, command_flag, self.cache)
+            if plugin_name in self._async_plugins:
+                running = self._loop.submit(execute_plugin_async(*task))
+            else:
+                running = self._executor.submit(execute_plugin, *task)
+        return self._guard(plugin_name, running, lambda result: result)
+
+    def _add_to_batch(self, plugin_name, entity, command_flag):
+        with self._lock:
+            if self.cancelled:
+                return _resolved(CANCELLED_RESULT)
+            batcher = self._batchers.get((plugin_name, command_flag))
+            if batcher is None:
+                plugin = self.plugins[plugin_name]
+                batcher = Batcher(
+                    plugin.get('batch_size') or 1, plugin.get('batch_latency') or 0,
+                    lambda items: self._schedule_batch(plugin_name, command_flag, items)
+                )
+                self._batchers[(plugin_name, command_flag)] = batcher
+        future = Future()
+        batcher.add(entity, future)
+        return future
+
+    def _schedule_batch(self, plugin_name, command_flag, items):
+        # Retrying a throttled batch would repeat its successful entities, so batches are not retried
+        entities = [entity for entity, _ in items]
+        running = self._schedule(plugin_name, lambda: self._run_batch(plugin_name, entities, command_flag),
+                                 retries=0, cancelled={entity: CANCELLED_RESULT for entity in entities})
+        running.add_done_callback(lambda done: _distribute_batch(done, items))
+
+    def _run_batch(self, plugin_name, entities, command_flag):
+        if self.remote is not None:
+            running = execute_plugin_remote(self.plugins[plugin_name], entities, command_flag, self.cache, self.remote)
+        else:
+            task = (self.plugins[plugin_name], entities, command_flag, self.cache)
+            if self._batch_modes[plugin_name] == 'async':
+                running = self._loop.submit(execute_plugin_batch_async(*task))
+            else:
+                running = self._executor.submit(execute_plugin_batch, *task)
+        return self._guard(plugin_name, running, lambda result: {entity: result for entity in entities})
+
+    def _guard(self, plugin_name, running, for_all):
+        """
+        Returns a Future for the result of running that resolves to for_all(timed-out result)
+        once the plugin's timeout has passed, or to for_all(CANCELLED_RESULT) if running is
+        cancelled. running itself where neither can happen; agents apply timeouts themselves.
+        """
+        timeout = self.plugins[plugin_name].get('timeout')
+        if self.remote is not None or (not timeout and self._loop is None):
+            return running
+        future = Future()
+
+        def expire():
+            if running.done() or not _settle(future, for_all(timed_out_result(timeout))):
+                return
+            logging.warning(f"Plugin {plugin_name} timed out after {timeout:g} s")
+            metrics.inc('mia_plugin_timeouts_total', plugin=plugin_name)
+            # Cancels a coroutine, and with it its commands; a running thread cannot be stopped
+            running.cancel()
+
+        def finish(done):
+            if timer is not None:
+                timer.cancel()
+            if done.cancelled():
+                _settle(future, for_all(CANCELLED_RESULT))
+            elif done.exception() is not None:
+                _settle(future, None, done.exception())
+            else:
+                _settle(future, done.result())
+
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, expire)
+            timer.daemon = True
+            timer.start()
+        running.add_done_callback(finish)
+        return future
+
+    def _schedule(self, plugin_name, start, retries=THROTTLE_RETRIES, cancelled=CANCELLED_RESULT):
+        """
+        Calls start() to launch a task if the plugin is below its concurrency cap and rate,
+        otherwise queues or delays it. A throttled result is retried up to retries times.
+        Returns a Future for the task's result.
+        """
+        future = Future()
+        with self._lock:
+            if self.cancelled:
+                future.set_result(cancelled)
+                return future
+            if self._active[plugin_name] >= self.concurrency_limit(plugin_name):
+                self._queued[plugin_name].append((start, future, retries))
+                return future
+            self._active[plugin_name] += 1
+            wait = self._rate_delay(plugin_name)
+        if wait > 0:
+            self._start_later(plugin_name, start, future, retries, wait)
+            return future
+        try:
+            self._start(plugin_name, start, future, retries)
+        except BaseException:
+            with self._lock:
+                self._active[plugin_name] -= 1
+            raise
+        return future
+
+    def _rate_delay(self, plugin_name):
+        controller = self._controllers.get(plugin_name)
+        return controller.delay() if controller is not None else 0.0
+
+    def _start(self, plugin_name, start, future, retries):
+        started = time.monotonic()
+        running = start()
+        running.add_done_callback(lambda done: self._on_done(plugin_name, start, future, retries, started, done))
+
+    def _start_later(self, plugin_name, start, future, retries, wait=0):
+        """
+        Starts a task holding a concurrency slot, once the plugin's rate allows it.
+        """
+        if wait > 0:
+            timer = threading.Timer(wait, self._start_later, (plugin_name, start, future, retries))
+            timer.daemon = True
+            timer.start()
+            return
+        if self.cancelled:
+            # cancel() has resolved the results waiting for it
+            return
+        try:
+            self._start(plugin_name, start, future, retries)
+        except RuntimeError as e:
+            # The executor was shut down while tasks were still queued
+            logging.debug(f"Dropping queued {plugin_name} task: {e}")
+            with self._lock:
+                self._active[plugin_name] -= 1
+            future.set_exception(e)
+
+    def _on_done(self, plugin_name, start, future, retries, started, done):
+        starts = []
+        controller = self._controllers.get(plugin_name)
+        outcome = result_outcome(done.result()) if controller is not None and done.exception() is None else None
+        # Retried ahead of the queue, once the lowered limit and rate let it start
+        retry = outcome == 'throttled' and retries > 0
+        with self._lock:
+            if outcome is not None:
+                controller.record(outcome, started)
+            if retry:
+                self._queued[plugin_name].appendleft((start, future, retries - 1))
+            self._active[plugin_name] -= 1
+            # A raised limit can start more than the one queued task replacing this one
+            while self._queued[plugin_name] and self._active[plugin_name] < self.concurrency_limit(plugin_name):
+                queued = self._queued[plugin_name].popleft()
+                self._active[plugin_name] += 1
+                starts.append((*queued, self._rate_delay(plugin_name)))
+        if not retry:
+            _chain_future(done, future)
+        for queued_start, queued_future, queued_retries, wait in starts:
+            self._start_later(plugin_name, queued_start, queued_future, queued_retries, wait)
+
+    def cancel(self):
+        """
+        Cancels the run: queued and batched tasks are dropped, coroutines are cancelled, and
+        all pending results, also those submitted later, resolve with CANCELLED_RESULT.
+        """
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            for queued in self._queued.values():
+                queued.clear()
+            batchers = list(self._batchers.values())
+        logging.warning("Cancelling the analysis")
+        for batcher in batchers:
+            batcher.clear()
+        if self._loop is not None:
+            self._loop.cancel_all()
+        self.memo.resolve_pending(CANCELLED_RESULT)
+
+    def flush_batches(self):
+        """
+        Starts all partially filled batches right away, e.g. once the input is exhausted.
+        """
+        with self._lock:
+            batchers = list(self._batchers.values())
+        for batcher in batchers:
+            batcher.flush()
+
+    def shutdown(self, wait=True):
+        metrics.remove_collector(self.collect_metrics)
+        if self._dispatcher is not None:
+            self._deferred.put(None)
+        self.flush_batches()
+        self._executor.shutdown(wait=wait)
+        if self._loop is not None and self._loop.loop.is_running():
+            # Coroutines left over, e.g. after a timeout or cancel(), get to kill their commands
+            try:
+                self._loop.cancel_all().result(CANCEL_GRACE_SECONDS)
+            except TimeoutError:
+                logging.warning("Cancelled plugin runs did not end in time")
+            self._loop.stop()
+        if self.remote is not None:
+            self.remote.close()
+        if self.cache is not None:
+            self.cache.flush()
+
+
+class Batcher:
+    """
+    Collects (entity, future) items and hands them to on_flush in chunks of at most size
+    items. A partially filled chunk is flushed latency seconds after its first item arrived.
+    """
+
+    def __init__(self, size, latency, on_flush):
+        self.size = size
+        self.latency = latency
+        self.on_flush = on_flush
+        self._items = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, entity, future):
+        with self._lock:
+            self._items.append((entity, future))
+            if len(self._items) >= self.size:
+                items = self._take_locked()
+            else:
+                items = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.latency, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if items:
+            self.on_flush(items)
+
+    def flush(self):
+        with self._lock:
+            items = self._take_locked()
+        if items:
+            self.on_flush(items)
+
+    def clear(self):
+        with self._lock:
+            self._take_locked()
+
+    def _take_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        items, self._items = self._items, []
+        return items
+
+
+class AsyncLoop:
+    """
+    An asyncio event loop running forever in a daemon thread.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name='plugin-async', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """
+        Schedules a coroutine on the loop and returns a concurrent.futures.Future.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def cancel_all(self):
+        """
+        Cancels every task running on the loop. Returns a Future resolving once they ended.
+        """
+        async def cancel():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        return self.submit(cancel())
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def _resolved(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def _settle(future, result, exception=None):
+    """
+    Resolves future unless that happened already (timeouts and cancel() race with late
+    results); True if it did.
+    """
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+        return True
+    except InvalidStateError:
+        return False
+
+
+def _chain_future(source, target):
+    if source.cancelled():
+        _settle(target, CANCELLED_RESULT)
+    elif source.exception() is not None:
+        _settle(target, None, source.exception())
+    else:
+        _settle(target, source.result())
+
+
+def _distribute_batch(source, items):
+    cancelled = source.cancelled()
+    exception = None if cancelled else source.exception()
+    for entity, future in items:
+        if cancelled:
+            _settle(future, CANCELLED_RESULT)
+        elif exception is not None:
+            _settle(future, None, exception)
+        else:
+            _settle(future, source.result()[entity])
@@ -0,0 +1,194 @@
+import bisect
+import csv
+import ipaddress
+import json
+import logging
+import mmap
+import os
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Layout of a compiled table: header, uint32 range starts, uint32 range ends,
+# uint16 indexes into the label list, UTF-8 JSON list of labels ("US, United States")
+MAGIC = b'MIAGEO1\0'
+HEADER = struct.Struct('<8sII')  # magic, number of ranges, byte offset of the label list
+
+NOT_FOUND = "IP Address not found"
+
+
+def _parse_csv_row(row):
+    """
+    Extracts (start, end, label) from one row of a CSV range dump. Supported layouts:
+    - GeoIP legacy: "start_ip","end_ip","start_num","end_num","CC","Country"
+    - start,end,CC[,Country] with dotted quads or integers
+    - network,CC[,Country] with a CIDR network
+    Returns None for headers and rows that do not describe an IPv4 range.
+    """
+    fields = [field.strip() for field in row if field.strip()]
+    if not fields:
+        return None
+    try:
+        if '/' in fields[0]:
+            network = ipaddress.ip_network(fields[0], strict=False)
+            start, end, rest = network.network_address, network.broadcast_address, fields[1:]
+        else:
+            start, end, rest = _to_address(fields[0]), _to_address(fields[1]), fields[2:]
+    except (ValueError, IndexError):
+        return None
+    if start.version != 4 or end.version != 4:
+        return None
+    # Skip the numeric duplicates of the legacy layout
+    rest = [field for field in rest if not field.isdigit()]
+    if not rest:
+        return None
+    label = ', '.join(rest[:2])
+    return int(start), int(end), label
+
+
+def _to_address(value):
+    if value.isdigit():
+        return ipaddress.IPv4Address(int(value))
+    return ipaddress.ip_address(value)
+
+
+def _read_csv(path):
+    with open(path, newline='', encoding='utf-8', errors='replace') as file:
+        for row in csv.reader(file):
+            entry = _parse_csv_row(row)
+            if entry is not None:
+                yield entry
+
+
+def _read_mmdb(path):
+    try:
+        import maxminddb
+    except ImportError:
+        raise RuntimeError("Reading .mmdb databases requires the 'maxminddb' package (pip install maxminddb)")
+    with maxminddb.open_database(path) as reader:
+        for network, record in reader:
+            if network.version != 4 or not record:
+                continue
+            country = record.get('country') or record.get('registered_country') or {}
+            code = country.get('iso_code')
+            if not code:
+                continue
+            name = (country.get('names') or {}).get('en')
+            label = f"{code}, {name}" if name else code
+            yield int(network.network_address), int(network.broadcast_address), label
+
+
+def compile_database(source_path, table_path):
+    """
+    Compiles a MaxMind .mmdb file or a CSV range dump into a sorted binary range table.
+    Overlapping ranges are resolved in favour of the range that starts first.
+    """
+    reader = _read_mmdb if source_path.endswith('.mmdb') else _read_csv
+    entries = sorted(reader(source_path))
+
+    starts, ends, indexes = [], [], []
+    labels = {}
+    for start, end, label in entries:
+        if ends and start <= ends[-1]:
+            if end <= ends[-1]:
+                continue
+            start = ends[-1] + 1
+        starts.append(start)
+        ends.append(end)
+        indexes.append(labels.setdefault(label, len(labels)))
+
+    count = len(starts)
+    label_offset = HEADER.size + count * 10
+    temporary_path = table_path + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, count, label_offset))
+        file.write(struct.pack(f'<{count}I', *starts))
+        file.write(struct.pack(f'<{count}I', *ends))
+        file.write(struct.pack(f'<{count}H', *indexes))
+        file.write(json.dumps(list(labels), ensure_ascii=False).encode('utf-8'))
+    os.replace(temporary_path, table_path)
+    logging.debug(f"Compiled {count} GeoIP ranges from {source_path} into {table_path}")
+    return count
+
+
+class GeoIPTable:
+    """
+    Read-only view of a compiled range table. The file is memory-mapped, so the arrays are
+    shared with the page cache instead of being loaded into Python objects, and single
+    lookups are a binary search over the start array.
+    """
+
+    def __init__(self, table_path):
+        with open(table_path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, label_offset = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{table_path} is not a compiled GeoIP table")
+        view = self._view = memoryview(self._mmap)
+        self.count = count
+        self.starts = view[HEADER.size:HEADER.size + count * 4].cast('I')
+        self.ends = view[HEADER.size + count * 4:HEADER.size + count * 8].cast('I')
+        self.indexes = view[HEADER.size + count * 8:label_offset].cast('H')
+        self.labels = json.loads(bytes(view[label_offset:]).decode('utf-8'))
+
+    @classmethod
+    def open(cls, source_path, table_path=None):
+        """
+        Opens the compiled table for a database, compiling it first if it is missing or
+        older than the source.
+        """
+        table_path = table_path or source_path + '.miageo'
+        if not os.path.exists(table_path) or os.path.getmtime(table_path) < os.path.getmtime(source_path):
+            compile_database(source_path, table_path)
+        return cls(table_path)
+
+    def lookup(self, ip):
+        """
+        Returns the label for an IPv4 address (string or int), or None if no range contains it.
+        """
+        value = int(ipaddress.IPv4Address(ip))
+        position = bisect.bisect_right(self.starts, value) - 1
+        if position >= 0 and value <= self.ends[position]:
+            return self.labels[self.indexes[position]]
+        return None
+
+    def lookup_many(self, ips):
+        """
+        Bulk lookup: returns a list of labels (or None) in the order of ips.
+        Uses numpy.searchsorted when numpy is installed, otherwise the queries are sorted
+        and each binary search starts where the previous one ended.
+        """
+        values = [int(ipaddress.IPv4Address(ip)) for ip in ips]
+        if not values or not self.count:
+            return [None] * len(values)
+
+        if numpy is not None:
+            starts = numpy.frombuffer(self.starts, dtype='<u4')
+            ends = numpy.frombuffer(self.ends, dtype='<u4')
+            queries = numpy.array(values, dtype='<u4')
+            positions = numpy.searchsorted(starts, queries, side='right') - 1
+            clipped = numpy.maximum(positions, 0)
+            found = (positions >= 0) & (queries <= ends[clipped])
+            return [
+                self.labels[self.indexes[int(position)]] if hit else None
+                for position, hit in zip(clipped, found)
+            ]
+
+        results = [None] * len(values)
+        low = 0
+        for order in sorted(range(len(values)), key=values.__getitem__):
+            value = values[order]
+            position = bisect.bisect_right(self.starts, value, low) - 1
+            if position >= 0:
+                low = position
+                if value <= self.ends[position]:
+                    results[order] = self.labels[self.indexes[position]]
+        return results
+
+    def close(self):
+        for view in (self.starts, self.ends, self.indexes, self._view):
+            view.release()
+        self._mmap.close()
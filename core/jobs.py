@@ -0,0 +1,403 @@
+import csv
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from core.classify import Classifier
+from core.journal import JournalMismatch, RunJournal
+from core.pipeline import DEFAULT_COLUMN_LAYOUT, CsvProcessor
+from core.shards import SHARD_MIN_BYTES, OutputFile, ShardedFile, ShardPool
+
+# Input files processed at the same time; all of them share one PluginEngine
+MAX_PARALLEL_FILES = 4
+
+OUTPUT_MODES = {
+    'merged': "All input files into one output file",
+    'separate': "One output file per input file",
+}
+DEFAULT_OUTPUT_MODE = 'merged'
+
+# Rows waiting for the merged sink's writer thread before producers block
+SINK_QUEUE_SIZE = 10000
+# Rows of files that are not yet due in the merged output stay in memory up to this size, then spill to disk
+SPOOL_MEMORY_BYTES = 8 * 1024 * 1024
+
+
+def output_paths(input_paths, output_path):
+    """
+    Output file of every input for the 'separate' mode: a single input writes to output_path,
+    several inputs to <output>_<input name><ext>.
+    """
+    if len(input_paths) == 1:
+        return [output_path]
+    base, ext = os.path.splitext(output_path)
+    paths = []
+    for input_path in input_paths:
+        path = f"{base}_{os.path.splitext(os.path.basename(input_path))[0]}{ext or '.csv'}"
+        while path in paths:
+            # Same file name from different directories
+            path = f"{os.path.splitext(path)[0]}_{len(paths)}{ext or '.csv'}"
+        paths.append(path)
+    return paths
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class Job:
+    """
+    One input file of a JobScheduler run and its progress.
+    """
+
+    def __init__(self, index, input_path, output_path=None):
+        self.index = index
+        self.input_path = input_path
+        self.output_path = output_path
+        self.state = 'queued'
+        self.error = None
+        self.rows = 0
+        self.started = None
+        self.finished = None
+        self.processor = None
+        try:
+            self.size = os.path.getsize(input_path)
+        except OSError:
+            self.size = 0
+
+    def progress(self):
+        """
+        Fraction of the input file read so far, between 0 and 1.
+        """
+        if self.state in ('done', 'failed', 'cancelled'):
+            return 1.0
+        position = self.processor.read_position() if self.processor is not None else None
+        if not position or not self.size:
+            return 0.0
+        return min(position / self.size, 1.0)
+
+    def eta(self):
+        """
+        Estimated seconds until the file is done, or None while there is nothing to go by.
+        """
+        progress = self.progress()
+        if self.state != 'running' or not progress:
+            return None
+        elapsed = time.monotonic() - self.started
+        return elapsed * (1 - progress) / progress
+
+    def describe(self):
+        name = os.path.basename(self.input_path)
+        if self.state == 'queued':
+            return f"{name}: queued"
+        if self.state == 'failed':
+            return f"{name}: failed ({self.error})"
+        if self.state == 'done':
+            return f"{name}: done, {self.rows} rows in {format_duration(self.finished - self.started)}"
+        if self.state == 'cancelled':
+            return f"{name}: cancelled after {self.rows} rows"
+        eta = self.eta()
+        eta_text = f", ETA {format_duration(eta)}" if eta is not None else ""
+        return f"{name}: {self.progress():.0%}, {self.rows} rows{eta_text}"
+
+
+class MergedSink:
+    """
+    Writes the rows of several jobs to one CSV file from a single writer thread.
+
+    Rows of the job currently due are written straight through; rows of later jobs are
+    spooled to temporary files and appended once all earlier jobs are complete, so the
+    output has the same order as processing the files one after another.
+    """
+
+    def __init__(self, outfile, flush_rows=False):
+        self.outfile = outfile
+        self.writer = csv.writer(outfile)
+        self.flush_rows = flush_rows
+        self.error = None
+        self._queue = queue.Queue(maxsize=SINK_QUEUE_SIZE)
+        self._spools = {}
+        self._closed = set()
+        self._current = 0
+        self._thread = threading.Thread(target=self._run, name='merged-sink', daemon=True)
+        self._thread.start()
+
+    def channel(self, index):
+        return SinkChannel(self, index)
+
+    def put(self, index, row):
+        self._queue.put((index, row))
+
+    def put_file(self, index, path):
+        """
+        Appends a file of CSV rows to a job's output; it must exist until the sink is closed.
+        """
+        self._queue.put((index, path))
+
+    def close_job(self, index):
+        self._queue.put((index, None))
+
+    def close(self):
+        """
+        Waits until everything queued is written, raising the writer thread's error if it had one.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        for spool, _ in self._spools.values():
+            spool.close()
+        self.outfile.flush()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                # Keep draining so producers don't block on a full queue
+                continue
+            index, row = item
+            try:
+                if row is None:
+                    self._finish(index)
+                elif isinstance(row, str):
+                    # A part file of a sharded job
+                    with open(row, newline='') as part:
+                        target = self.outfile if index == self._current else self._spool_file(index)
+                        shutil.copyfileobj(part, target)
+                elif index == self._current:
+                    self.writer.writerow(row)
+                    if self.flush_rows:
+                        self.outfile.flush()
+                else:
+                    self._spool_writer(index).writerow(row)
+            except Exception as e:
+                logging.error(f"Writing merged output failed: {e}")
+                self.error = e
+
+    def _spool_writer(self, index):
+        if index not in self._spools:
+            spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES, mode='w+', newline='')
+            self._spools[index] = (spool, csv.writer(spool))
+        return self._spools[index][1]
+
+    def _spool_file(self, index):
+        self._spool_writer(index)
+        return self._spools[index][0]
+
+    def _finish(self, index):
+        self._closed.add(index)
+        while self._current in self._closed:
+            self._current += 1
+            # Catch up on the next job's spooled rows; from now on it writes straight through
+            spool = self._spools.pop(self._current, None)
+            if spool is not None:
+                spool[0].seek(0)
+                shutil.copyfileobj(spool[0], self.outfile)
+                spool[0].close()
+                if self.flush_rows:
+                    self.outfile.flush()
+
+
+class SinkChannel:
+    """
+    csv.writer lookalike that hands rows of one job to a MergedSink.
+    """
+
+    def __init__(self, sink, index):
+        self.sink = sink
+        self.index = index
+
+    def writerow(self, row):
+        self.sink.put(self.index, row)
+
+    def append_file(self, path):
+        self.sink.put_file(self.index, path)
+
+
+class JobScheduler:
+    """
+    Runs a queue of input files through one shared PluginEngine, at most parallel_files at
+    a time. The engine's caps (per plugin and max_in_flight) apply across all files, and
+    its memo and result cache serve every file.
+
+    Output goes to one file per input ('separate') or, in input order, to a single file
+    written by a MergedSink ('merged', only the first file's header is written). A failing
+    file is marked as failed and does not stop the others.
+
+    With open_journal, finished plugin results are journaled so an interrupted run can be
+    resumed. The journal is removed once every file is done and the resumed output matched it.
+
+    Once the engine is cancelled, running files stop reading and are marked as cancelled with
+    the rows they wrote, and files not started yet are marked as cancelled right away.
+
+    With shards > 1, files of at least shard_min_bytes are split into that many shards and
+    processed by a pool of as many processes (see core/shards.py); such runs are not journaled.
+
+    With a record_sink (see core/records.py), the results of all files are also written to it
+    as records; it cannot be combined with shards.
+
+    Callbacks, all called from job threads:
+    - on_row(job, row, current_line) after a row has been written
+    - on_status(plugin_name, entity, current_line, cell_index) when a plugin run is scheduled
+    - on_job_done(job) when a file is done, failed or cancelled
+    """
+
+    def __init__(self, plugins, command_flags, parser_set, engine, input_paths, output_path,
+                 output_mode=DEFAULT_OUTPUT_MODE, layout=DEFAULT_COLUMN_LAYOUT,
+                 parallel_files=MAX_PARALLEL_FILES, on_row=None, on_status=None, on_job_done=None, classifier=None,
+                 shards=1, shard_min_bytes=SHARD_MIN_BYTES, record_sink=None):
+        if output_mode not in OUTPUT_MODES:
+            raise ValueError(f"Unknown output mode: {output_mode}")
+        if record_sink is not None and shards > 1:
+            raise ValueError("Records cannot be written by sharded runs")
+        self.plugins = plugins
+        self.command_flags = command_flags
+        self.parser_set = parser_set
+        self.engine = engine
+        self.output_path = output_path
+        self.output_mode = output_mode
+        self.layout = layout
+        self.classifier = classifier if classifier is not None else Classifier()
+        self.parallel_files = max(1, parallel_files)
+        self.shards = max(1, shards)
+        self.shard_min_bytes = shard_min_bytes
+        self.shard_pool = None
+        self.record_sink = record_sink
+        self.on_row = on_row
+        self.on_status = on_status
+        self.on_job_done = on_job_done
+        if output_mode == 'separate':
+            paths = output_paths(input_paths, output_path)
+        else:
+            paths = [output_path] * len(input_paths)
+        self.jobs = [Job(index, input_path, path) for index, (input_path, path) in enumerate(zip(input_paths, paths))]
+        self.journal = None
+
+    def settings(self):
+        """
+        Everything besides the inputs that decides what the output looks like.
+        """
+        return {
+            'plugins': {name: self.command_flags.get(name, '') for name in self.plugins},
+            'parsers': [[parser.name, parser.pattern, parser.validate] for parser in self.parser_set.parsers],
+            'layout': self.layout,
+            'output_mode': self.output_mode,
+            'classification': {
+                'lists': self.classifier.fingerprint(),
+                'plugins': {name: plugin.get('entity_classes') for name, plugin in self.plugins.items()},
+            },
+            'requires': {name: plugin.get('requires') for name, plugin in self.plugins.items()},
+        }
+
+    def open_journal(self, path, resume=False):
+        """
+        Starts journaling to path. With resume, an existing journal at path is replayed;
+        JournalMismatch is raised if it was written for other inputs or settings.
+        """
+        if self.shards > 1:
+            raise ValueError("Sharded runs cannot be journaled")
+        self.journal = RunJournal(path, self.settings(), [job.input_path for job in self.jobs], resume)
+        return self.journal
+
+    def run(self, outfile=None, flush_rows=False):
+        """
+        Processes all jobs and returns them. In 'merged' mode, outfile can be an already
+        open text file (e.g. stdout) to write to instead of output_path.
+        """
+        sink = None
+        owns_outfile = False
+        if self.output_mode == 'merged':
+            if outfile is None:
+                outfile = open(self.output_path, 'w', newline='')
+                owns_outfile = True
+            sink = MergedSink(outfile, flush_rows)
+        sharded = sum(self.is_sharded(job) for job in self.jobs)
+        if sharded:
+            self.shard_pool = ShardPool(self.shards, self.shards * sharded, self.plugins, self.command_flags,
+                                        self.parser_set, self.engine, self.layout, self.classifier)
+        try:
+            with ThreadPoolExecutor(max_workers=self.parallel_files, thread_name_prefix='job') as pool:
+                for job in self.jobs:
+                    pool.submit(self.run_job, job, sink)
+        finally:
+            try:
+                if sink is not None:
+                    sink.close()
+            finally:
+                if owns_outfile:
+                    outfile.close()
+                # Part files are only removed once the sink has copied them
+                if self.shard_pool is not None:
+                    self.shard_pool.shutdown()
+                    self.shard_pool = None
+                if self.journal is not None:
+                    self.close_journal()
+        return self.jobs
+
+    def is_sharded(self, job):
+        return self.shards > 1 and job.size >= self.shard_min_bytes
+
+    def close_journal(self):
+        complete = all(job.state == 'done' for job in self.jobs)
+        unused = self.journal.unused()
+        self.journal.close(remove=complete and not unused)
+        if complete and unused:
+            raise JournalMismatch(f"{unused} journaled results were not asked for by any input row, "
+                                  f"the output does not match {self.journal.path}")
+
+    def run_job(self, job, sink=None):
+        job.processor = CsvProcessor(
+            self.plugins, self.command_flags, self.parser_set, self.engine,
+            on_row=lambda row, current_line: self._row_written(job, row, current_line),
+            on_status=self.on_status, layout=self.layout, classifier=self.classifier,
+            record_sink=self.record_sink,
+            journal=self.journal.for_file(job.index) if self.journal is not None else None
+        )
+        sharded = self.shard_pool is not None and self.is_sharded(job)
+        if sharded:
+            # Rows are only read back from the shards' output if someone wants to see them
+            on_row = None
+            if self.on_row is not None:
+                on_row = lambda row, current_line: self.on_row(job, row, current_line)
+            job.processor = ShardedFile(self.shard_pool, job.processor, on_row,
+                                        on_progress=lambda rows: setattr(job, 'rows', rows))
+        job.started = time.monotonic()
+        try:
+            if self.engine.cancelled:
+                job.state = 'cancelled'
+                return
+            job.state = 'running'
+            if sink is not None:
+                job.processor.process_file(job.input_path, sink.channel(job.index), write_headers=job.index == 0)
+            else:
+                os.stat(job.input_path)  # Don't leave an empty output behind for a missing input
+                with open(job.output_path, 'w', newline='') as outfile:
+                    job.processor.process_file(job.input_path, OutputFile(outfile) if sharded else csv.writer(outfile))
+            job.state = 'cancelled' if self.engine.cancelled else 'done'
+        except Exception as e:
+            logging.error(f"Processing {job.input_path} failed: {e}")
+            job.error = str(e)
+            job.state = 'failed'
+        finally:
+            job.finished = time.monotonic()
+            if sink is not None:
+                sink.close_job(job.index)
+            if self.on_job_done is not None:
+                self.on_job_done(job)
+
+    def _row_written(self, job, row, current_line):
+        job.rows += 1
+        if self.on_row is not None:
+            self.on_row(job, row, current_line)
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+# Journal entries are written and fsynced in batches of this many entries, or after this many seconds
+JOURNAL_BATCH_SIZE = 500
+JOURNAL_FLUSH_SECONDS = 5.0
+
+JOURNAL_VERSION = 1
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class JournalMismatch(ValueError):
+    """
+    The journal was written for other inputs or settings than the run being resumed.
+    """
+
+
+def default_journal_path(output_path):
+    return f"{output_path}.journal"
+
+
+def fingerprint(path):
+    """
+    Size and SHA-256 of a file, to tell whether an input changed since the journal was written.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return {'path': os.path.abspath(path), 'size': os.path.getsize(path), 'sha256': digest.hexdigest()}
+
+
+class RunJournal:
+    """
+    Append-only JSON lines journal of the plugin results of a run, so an interrupted run can
+    be resumed without repeating finished plugin work.
+
+    The first line describes the run (input fingerprints and every setting that influences
+    the output). 'v' lines hold a plugin result, written once per (plugin, entity); 'd' lines
+    mark a (file, row, plugin, entity) task as done. Lines are buffered and fsynced in batches;
+    a line cut off by a crash is dropped when the journal is resumed.
+
+    On resume, journaled results are served for any row asking for the same (plugin, entity),
+    like the run's memo would. Every 'd' entry must be asked for again by its row, otherwise
+    the resumed output does not match what the journal was written for (see unused()).
+
+    Only successful results are journaled, so failed lookups are retried on resume.
+    """
+
+    def __init__(self, path, settings, input_paths, resume=False):
+        self.path = path
+        self.header = {
+            'version': JOURNAL_VERSION,
+            'inputs': [fingerprint(input_path) for input_path in input_paths],
+            'settings': settings,
+        }
+        self._values = {}
+        self._done = set()
+        self._used = set()
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        if resume and os.path.exists(path):
+            self._load()
+            self._file = open(path, 'a', encoding='utf-8')
+        else:
+            self._file = open(path, 'w', encoding='utf-8')
+            self._write_now([self.header])
+        self.replayed = len(self._done)
+
+    def _load(self):
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            # A crash can cut off the last line; drop it so appended entries start on a new line
+            complete = data.rfind(b'\n') + 1
+            if complete < len(data):
+                f.truncate(complete)
+        lines = data[:complete].decode('utf-8').split('\n')[:-1]
+        try:
+            header = json.loads(lines[0])
+        except (ValueError, IndexError):
+            raise JournalMismatch(f"{self.path} is not a journal")
+        if header != self.header:
+            if header.get('inputs') != self.header['inputs']:
+                raise JournalMismatch(f"The input files changed since {self.path} was written")
+            raise JournalMismatch(f"{self.path} was written with other plugins, flags, parsers or output settings")
+        for line in lines[1:]:
+            entry = json.loads(line)
+            if 'v' in entry:
+                plugin_name, entity, result = entry['v']
+                self._values[(plugin_name, entity)] = result
+            else:
+                self._done.add(tuple(entry['d']))
+        logging.info(f"Resuming from {self.path}: {len(self._done)} finished plugin runs")
+
+    def lookup(self, file_index, row, plugin_name, entity):
+        """
+        Returns the journaled result for a task, or None if it has to be run.
+        """
+        with self._lock:
+            result = self._values.get((plugin_name, entity))
+            key = (file_index, row, plugin_name, entity)
+            if key in self._done:
+                self._used.add(key)
+            elif result is not None:
+                # Served from another row's result; journal this row too
+                self._done.add(key)
+                self._used.add(key)
+                self._append_locked({'d': list(key)})
+            return result
+
+    def unused(self):
+        """
+        Number of replayed entries that no row of the inputs asked for. Anything but 0
+        means the resumed output does not match the journal.
+        """
+        with self._lock:
+            return len(self._done) - len(self._used)
+
+    def record(self, file_index, row, plugin_name, entity, result):
+        if not (isinstance(result, dict) and result.get('success')):
+            return
+        key = (file_index, row, plugin_name, entity)
+        with self._lock:
+            if (plugin_name, entity) not in self._values:
+                self._values[(plugin_name, entity)] = result
+                self._buffer.append({'v': [plugin_name, entity, result]})
+            if key not in self._done:
+                self._done.add(key)
+                self._used.add(key)
+                self._append_locked({'d': list(key)})
+
+    def _append_locked(self, entry):
+        self._buffer.append(entry)
+        if len(self._buffer) >= JOURNAL_BATCH_SIZE or time.monotonic() - self._last_flush >= JOURNAL_FLUSH_SECONDS:
+            self._flush_locked()
+
+    def for_file(self, file_index):
+        return FileJournal(self, file_index)
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        entries, self._buffer = self._buffer, []
+        self._last_flush = time.monotonic()
+        if entries:
+            self._write_now(entries)
+
+    def _write_now(self, entries):
+        self._file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self, remove=False):
+        """
+        Flushes and closes the journal; remove deletes it, e.g. once the run is complete.
+        """
+        with self._lock:
+            self._flush_locked()
+            self._file.close()
+        if remove:
+            os.remove(self.path)
+
+
+class FileJournal:
+    """
+    The RunJournal as seen by the CsvProcessor of one input file.
+    """
+
+    def __init__(self, journal, file_index):
+        self.journal = journal
+        self.file_index = file_index
+
+    def lookup(self, row, plugin_name, entity):
+        return self.journal.lookup(self.file_index, row, plugin_name, entity)
+
+    def record(self, row, plugin_name, entity, result):
+        self.journal.record(self.file_index, row, plugin_name, entity, result)
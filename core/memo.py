@@ -0,0 +1,103 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, InvalidStateError
+
+
+class ResultMemo:
+    """
+    Bounded LRU memo of plugin results for the duration of one analysis run.
+
+    Keys are (plugin_name, entity, command_flag) tuples. Concurrent lookups of a key
+    that is still being computed wait for the running call instead of starting a second one.
+    Only successful results are kept, so failed lookups get retried on the next occurrence.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def get_or_submit(self, key, start):
+        """
+        Returns a Future for the result of key. On a miss, start() is called once to begin
+        the computation and must itself return a Future.
+        """
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                future = Future()
+                future.set_result(self._results[key])
+                return future
+            if key in self._in_flight:
+                self.hits += 1
+                return self._in_flight[key]
+            self.misses += 1
+            future = Future()
+            self._in_flight[key] = future
+
+        try:
+            source = start()
+        except BaseException as e:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            future.set_exception(e)
+            raise
+        source.add_done_callback(lambda done: self._complete(key, done, future))
+        return future
+
+    def get_or_compute(self, key, compute):
+        """
+        Blocking variant of get_or_submit that runs compute() in the calling thread on a miss.
+        """
+        def start():
+            future = Future()
+            try:
+                future.set_result(compute())
+            except BaseException as e:
+                future.set_exception(e)
+            return future
+
+        return self.get_or_submit(key, start).result()
+
+    def _complete(self, key, source, future):
+        exception = source.exception()
+        result = None if exception is not None else source.result()
+        with self._lock:
+            if isinstance(result, dict) and result.get('success'):
+                self._results[key] = result
+                self._results.move_to_end(key)
+                while len(self._results) > self.max_size:
+                    self._results.popitem(last=False)
+            self._in_flight.pop(key, None)
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            pass  # Resolved by resolve_pending already
+
+    def resolve_pending(self, result):
+        """
+        Resolves every lookup still being computed with result, e.g. when a run is cancelled.
+        The computations themselves are not stopped.
+        """
+        with self._lock:
+            pending = list(self._in_flight.values())
+            self._in_flight.clear()
+        for future in pending:
+            try:
+                future.set_result(result)
+            except InvalidStateError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return self.hits, self.misses
+
+    def __len__(self):
+        return len(self._results)
@@ -0,0 +1,440 @@
+"""
+Run metrics: per-plugin call counts, latency histograms, error and throttling rates,
+queue depths, cache hit ratios and CSV I/O, exported as JSON or Prometheus text.
+
+    metrics.inc('mia_plugin_calls_total', plugin='whois', outcome='success')
+    metrics.observe('mia_plugin_latency_seconds', 0.42, plugin='whois')
+    write_metrics('run.prom')
+
+Counters and histograms are pushed by the code doing the work; gauges like queue depths
+are pulled from registered collectors when a snapshot is taken, so they cost nothing on
+the hot path.
+"""
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets, from cache-fast to nmap-slow
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Seconds between metric file writes while a run is going on
+METRICS_WRITE_INTERVAL = 5.0
+
+# Log level below DEBUG for per-row and per-command messages, only enabled with -vv
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+VERBOSITY_LEVELS = (logging.WARNING, logging.DEBUG, TRACE)
+
+HELP = {
+    'mia_plugin_calls_total': 'Plugin invocations by outcome (success, failure, throttled, error); a batch counts once',
+    'mia_plugin_entities_total': 'Entities handed to plugin invocations',
+    'mia_plugin_latency_seconds': 'Duration of plugin invocations',
+    'mia_plugin_skipped_total': "Plugin runs skipped because a requirement on another plugin's result was not met",
+    'mia_plugin_timeouts_total': "Plugin runs and batches given up on after the plugin's timeout",
+    'mia_plugin_throttled_total': 'Answers of remote services refusing a query for rate limiting (e.g. whois %ERROR:201)',
+    'mia_cache_lookups_total': 'Persistent result cache lookups by result (hit, miss)',
+    'mia_memo_lookups': 'Lookups in the run memo by result (hit, miss)',
+    'mia_plugin_queued': 'Plugin tasks waiting for their concurrency cap',
+    'mia_plugin_active': 'Plugin tasks running',
+    'mia_plugin_concurrency_limit': 'Current adaptive concurrency limit of the plugin',
+    'mia_plugin_rate_limit': 'Current adaptive request rate limit of the plugin (0: unlimited)',
+    'mia_in_flight': 'Plugin runs submitted but not finished',
+    'mia_csv_rows_read_total': 'CSV rows read',
+    'mia_csv_rows_written_total': 'CSV rows written',
+    'mia_csv_read_seconds_total': 'Time spent reading CSV rows',
+    'mia_csv_write_seconds_total': 'Time spent writing CSV rows',
+    'mia_pending_rows': 'Rows read but waiting for plugin results',
+    'mia_agent_up': 'Whether the coordinator is connected to the agent',
+    'mia_agent_tasks': 'Plugin tasks leased to the agent and not answered yet',
+    'mia_remote_pending': 'Plugin tasks waiting for a free agent',
+    'mia_remote_retries_total': 'Plugin tasks sent to another agent after theirs was lost',
+    'mia_entities_total': 'Entities found in the input by class (see classification.yaml)',
+}
+
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+def configure_logging(verbosity, stream=None):
+    """
+    0: warnings and errors, 1 (-v): debug output, 2 (-vv): also every row and command.
+    """
+    level = VERBOSITY_LEVELS[min(verbosity, len(VERBOSITY_LEVELS) - 1)]
+    logging.basicConfig(level=level, format=LOG_FORMAT, stream=stream)
+
+
+class Histogram:
+    """
+    Counts of observations per bucket, plus their sum, as in a Prometheus histogram.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimates a quantile by interpolating within its bucket. None without observations.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def to_dict(self):
+        return {
+            'count': self.count, 'sum': round(self.sum, 6),
+            'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts)),
+            'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99),
+        }
+
+
+class Metrics:
+    """
+    Thread-safe registry of labelled counters, histograms and gauge collectors.
+
+    Series are keyed by (name, labels), labels being a sorted tuple of (label, value).
+    Collectors are callables returning [(name, labels dict, value)] for gauges.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def merge(self, counters, histograms):
+        """
+        Adds the counters and histograms of another registry's snapshot, e.g. of a shard process.
+        """
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, other in histograms.items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram(other.buckets)
+                histogram.counts = [count + more for count, more in zip(histogram.counts, other.counts)]
+                histogram.count += other.count
+                histogram.sum += other.sum
+
+    def after_fork(self):
+        """
+        Starts a forked child with a fresh lock and nothing collected; another thread of
+        the parent may have held the lock while forking.
+        """
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self.started = time.time()
+
+    def reset(self):
+        """
+        Drops all counters and histograms, e.g. when the GUI starts a new analysis.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started = time.time()
+
+    def snapshot(self):
+        """
+        Returns (counters, histograms, gauges), each a dict keyed by (name, labels).
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: _copy_histogram(histogram) for key, histogram in self._histograms.items()}
+            collectors = list(self._collectors)
+        gauges = {}
+        for collector in collectors:
+            try:
+                for name, labels, value in collector():
+                    key = (name, tuple(sorted(labels.items())))
+                    gauges[key] = gauges.get(key, 0) + value
+            except Exception as e:
+                logging.debug(f"Metrics collector failed: {e}")
+        return counters, histograms, gauges
+
+    def to_json(self):
+        counters, histograms, gauges = self.snapshot()
+        return {
+            'uptime_s': round(time.time() - self.started, 3),
+            'counters': [_series(key, value) for key, value in sorted(counters.items())],
+            'gauges': [_series(key, value) for key, value in sorted(gauges.items())],
+            'histograms': [_series(key, histogram.to_dict()) for key, histogram in sorted(histograms.items())],
+        }
+
+    def to_prometheus(self):
+        counters, histograms, gauges = self.snapshot()
+        lines = []
+        for kind, series in (('counter', counters), ('gauge', gauges)):
+            for name in sorted({name for name, _ in series}):
+                lines += _type_lines(name, kind)
+                for (series_name, labels), value in sorted(series.items()):
+                    if series_name == name:
+                        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for name in sorted({name for name, _ in histograms}):
+            lines += _type_lines(name, 'histogram')
+            for (series_name, labels), histogram in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip([str(bound) for bound in histogram.buckets] + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def summary_lines(self):
+        """
+        Human-readable figures per plugin, for CSV I/O and for the caches, as shown in the GUI.
+        """
+        counters, histograms, gauges = self.snapshot()
+        values = dict(counters)
+        values.update(gauges)
+
+        def total(name, **labels):
+            wanted = set(labels.items())
+            return sum(value for (series_name, series_labels), value in values.items()
+                       if series_name == name and wanted <= set(series_labels))
+
+        plugins = sorted({dict(labels)['plugin'] for name, labels in list(values) + list(histograms)
+                          if name.startswith('mia_plugin_') and 'plugin' in dict(labels)})
+        lines = []
+        for plugin in plugins:
+            calls = total('mia_plugin_calls_total', plugin=plugin)
+            line = (f"{plugin}: {calls} calls, {total('mia_plugin_calls_total', plugin=plugin, outcome='failure')} failed, "
+                    f"{total('mia_plugin_calls_total', plugin=plugin, outcome='error')} errors")
+            throttled = total('mia_plugin_calls_total', plugin=plugin, outcome='throttled')
+            if throttled:
+                line += f", {throttled} throttled"
+            skipped = total('mia_plugin_skipped_total', plugin=plugin)
+            if skipped:
+                line += f", {skipped} skipped"
+            timeouts = total('mia_plugin_timeouts_total', plugin=plugin)
+            if timeouts:
+                line += f", {timeouts} timed out"
+            histogram = histograms.get(('mia_plugin_latency_seconds', (('plugin', plugin),)))
+            if histogram is not None and histogram.count:
+                line += f", p50 {_format_seconds(histogram.quantile(0.5))}, p95 {_format_seconds(histogram.quantile(0.95))}"
+            line += (f", {total('mia_plugin_active', plugin=plugin)} running, "
+                     f"{total('mia_plugin_queued', plugin=plugin)} queued")
+            limit = values.get(('mia_plugin_concurrency_limit', (('plugin', plugin),)))
+            if limit is not None:
+                line += f", limit {limit}"
+                rate = values.get(('mia_plugin_rate_limit', (('plugin', plugin),)))
+                if rate:
+                    line += f" at {rate:.1f}/s"
+            lines.append(line)
+        lines.append(
+            f"CSV: {total('mia_csv_rows_read_total')} rows read in {total('mia_csv_read_seconds_total'):.1f} s, "
+            f"{total('mia_csv_rows_written_total')} written in {total('mia_csv_write_seconds_total'):.1f} s, "
+            f"{total('mia_pending_rows')} waiting for results, {total('mia_in_flight')} plugin runs in flight"
+        )
+        lines.append(f"Memo: {_format_ratio(total('mia_memo_lookups', result='hit'), total('mia_memo_lookups'))}, "
+                     f"result cache: {_format_ratio(total('mia_cache_lookups_total', result='hit'), total('mia_cache_lookups_total'))}")
+        agents = [dict(labels)['agent'] for name, labels in values if name == 'mia_agent_up']
+        if agents:
+            lines.append(f"Agents: {total('mia_agent_up')} of {len(agents)} connected, "
+                         f"{total('mia_agent_tasks')} tasks leased, {total('mia_remote_pending')} waiting, "
+                         f"{total('mia_remote_retries_total')} retried")
+        entity_classes = self.entity_class_counts()
+        if entity_classes:
+            lines.append(format_entity_classes(entity_classes))
+        return lines
+
+    def entity_class_counts(self):
+        """
+        {class: entities} classified so far, most frequent class first.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+        counts = {}
+        for (name, labels), value in counters.items():
+            if name == 'mia_entities_total':
+                entity_class = dict(labels).get('class')
+                counts[entity_class] = counts.get(entity_class, 0) + value
+        return dict(sorted(counts.items(), key=lambda item: -item[1]))
+
+
+def format_entity_classes(counts):
+    return "Entities: " + ', '.join(f"{count} {entity_class}" for entity_class, count in counts.items())
+
+
+def _format_seconds(seconds):
+    return f"{seconds * 1000:.0f} ms" if seconds < 1 else f"{seconds:.1f} s"
+
+
+def _format_ratio(hits, lookups):
+    return f"{hits / lookups:.0%} hits of {lookups}" if lookups else "no lookups"
+
+
+def _copy_histogram(histogram):
+    copy = Histogram(histogram.buckets)
+    copy.counts = list(histogram.counts)
+    copy.count = histogram.count
+    copy.sum = histogram.sum
+    return copy
+
+
+def _series(key, value):
+    name, labels = key
+    return {'name': name, 'labels': dict(labels), 'value': value}
+
+
+def _type_lines(name, kind):
+    lines = [f"# HELP {name} {HELP[name]}"] if name in HELP else []
+    return lines + [f"# TYPE {name} {kind}"]
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Shared by everything in the process, like the plugin registry
+metrics = Metrics()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=metrics.after_fork)
+
+
+def write_metrics(path, source=None):
+    """
+    Writes the metrics to path: JSON for a .json file, Prometheus text format otherwise.
+    Replaces the file atomically, so scrapers never see a partial file.
+    """
+    source = source if source is not None else metrics
+    if path.endswith('.json'):
+        text = json.dumps(source.to_json(), indent=2) + '\n'
+    else:
+        text = source.to_prometheus()
+    temp_file = f"{path}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temp_file, path)
+
+
+class MetricsExporter:
+    """
+    Publishes the metrics while a run is going on: rewrites a metrics file every interval
+    seconds and/or serves them over HTTP on 127.0.0.1:port, as Prometheus text on /metrics
+    and as JSON on /metrics.json.
+    """
+
+    def __init__(self, path=None, port=None, interval=METRICS_WRITE_INTERVAL, source=None):
+        self.path = path
+        self.port = port
+        self.interval = interval
+        self.source = source if source is not None else metrics
+        self._stop = threading.Event()
+        self._writer = None
+        self._server = None
+
+    def start(self):
+        if self.port is not None:
+            self._server = http.server.ThreadingHTTPServer(('127.0.0.1', self.port), _handler(self.source))
+            self._server.daemon_threads = True
+            self.port = self._server.server_address[1]  # Port 0 picks a free one
+            threading.Thread(target=self._server.serve_forever, name='metrics-http', daemon=True).start()
+            logging.info(f"Serving metrics on http://127.0.0.1:{self.port}/metrics")
+        if self.path is not None:
+            self._writer = threading.Thread(target=self._write_periodically, name='metrics-writer', daemon=True)
+            self._writer.start()
+        return self
+
+    def _write_periodically(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            write_metrics(self.path, self.source)
+        except OSError as e:
+            logging.error(f"Could not write metrics to {self.path}: {e}")
+
+    def stop(self):
+        """
+        Stops publishing; the metrics file gets a final write with the complete run.
+        """
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join()
+            self.write()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def _handler(source):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = source.to_prometheus(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, content_type = json.dumps(source.to_json()), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            data = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logging.debug(f"metrics http: {format % args}")
+
+    return MetricsHandler
@@ -0,0 +1,146 @@
+import functools
+import glob
+import ipaddress
+import os
+import re
+
+import yaml
+
+from core.plugins import BASE_DIR
+
+DEFAULT_PARSER = 'ipv4 address'
+
+# Memoised validation results per validator; cells of one export repeat the same entities a lot
+VALIDATION_CACHE_SIZE = 65536
+
+
+def _validate_ipv4(candidate):
+    return str(ipaddress.IPv4Address(candidate))
+
+
+def _format_ipv6(address):
+    # Keep IPv4-mapped addresses readable (::ffff:1.2.3.4 rather than ::ffff:102:304)
+    if address.ipv4_mapped is not None:
+        return f"::ffff:{address.ipv4_mapped}"
+    return str(address)
+
+
+def _validate_ipv6(candidate):
+    return _format_ipv6(ipaddress.IPv6Address(candidate))
+
+
+def _validate_ip(candidate):
+    address = ipaddress.ip_address(candidate)
+    return _format_ipv6(address) if address.version == 6 else str(address)
+
+
+def _validate_network(candidate):
+    # Host bits are allowed in the input ("10.1.2.3/8") and cleared in the entity
+    return str(ipaddress.ip_network(candidate, strict=False))
+
+
+# Parser YAMLs pick one of these with 'validate'. A validator returns the canonical
+# form of a candidate match or raises ValueError for matches that are not real entities.
+VALIDATORS = {
+    'ipv4': _validate_ipv4,
+    'ipv6': _validate_ipv6,
+    'ip': _validate_ip,
+    'network': _validate_network,
+}
+
+
+class Parser:
+    """
+    A parser YAML compiled once: the regex, an optional validator and an optional prefilter,
+    a set of characters of which every match contains at least one (e.g. "0123456789").
+    Parsers with a higher priority win when several of them match at the same position.
+    """
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.entity_type = config['entity_type']
+        self.pattern = config['regex']
+        self.regex = re.compile(self.pattern)
+        self.prefilter = config.get('prefilter') or ''
+        self.priority = config.get('priority', 0)
+        validate = config.get('validate')
+        self.validate = validate
+        if validate and validate not in VALIDATORS:
+            raise ValueError(f"Parser '{name}': unknown validator '{validate}', available: {', '.join(VALIDATORS)}")
+        self.validator = functools.lru_cache(maxsize=VALIDATION_CACHE_SIZE)(VALIDATORS[validate]) if validate else None
+
+    def __reduce__(self):
+        # Compiled again on unpickling, e.g. in shard processes
+        return Parser, (self.name, self.config)
+
+    def canonical(self, candidate):
+        """
+        Returns the validated entity for a candidate match, or None if it is not valid.
+        """
+        if self.validator is None:
+            return candidate
+        try:
+            return self.validator(candidate)
+        except ValueError:
+            return None
+
+
+class ParserSet:
+    """
+    Several parsers combined into a single alternation, so one scan of a cell finds the
+    entities of every parser, in the order they appear. Cells containing none of the
+    prefilter characters are skipped without running the regex.
+    """
+
+    def __init__(self, parsers):
+        if not parsers:
+            raise ValueError("No parsers selected")
+        self.parsers = sorted(parsers, key=lambda parser: -parser.priority)
+        self.regex = re.compile('|'.join(f'(?P<p{index}>{parser.pattern})' for index, parser in enumerate(self.parsers)))
+        self.by_group = {f'p{index}': parser for index, parser in enumerate(self.parsers)}
+        # A parser without prefilter can match anything, which turns prefiltering off
+        if all(parser.prefilter for parser in self.parsers):
+            chars = ''.join(sorted({char for parser in self.parsers for char in parser.prefilter}))
+            self.prefilter = re.compile(f'[{re.escape(chars)}]').search
+        else:
+            self.prefilter = None
+
+    def __reduce__(self):
+        return ParserSet, (self.parsers,)
+
+    def finditer(self, text):
+        """
+        Yields (parser, entity) for every valid match in text.
+        """
+        if self.prefilter is not None and self.prefilter(text) is None:
+            return
+        for match in self.regex.finditer(text):
+            parser = self.by_group[match.lastgroup]
+            entity = parser.canonical(match.group(match.lastgroup))
+            if entity is not None:
+                yield parser, entity
+
+    def findall(self, text):
+        return [entity for _, entity in self.finditer(text)]
+
+
+def load_parsers(parser_folder='parser'):
+    parsers = {}
+    parser_dir = os.path.join(BASE_DIR, parser_folder)
+    for yaml_file in sorted(glob.glob(os.path.join(parser_dir, '*.yaml'))):
+        with open(yaml_file, 'r') as file:
+            parser_config = yaml.safe_load(file)
+            name = os.path.basename(yaml_file).split('.')[0]
+            parsers[name] = Parser(name, parser_config)
+    return parsers
+
+
+def select_parsers(parsers, names):
+    """
+    Combines the named parsers into a ParserSet, raising ValueError for unknown names.
+    """
+    unknown = [name for name in names if name not in parsers]
+    if unknown:
+        raise ValueError(f"Unknown parser '{unknown[0]}', available: {', '.join(parsers)}")
+    return ParserSet([parsers[name] for name in dict.fromkeys(names)])
@@ -0,0 +1,333 @@
+import csv
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from core.classify import Classifier
+from core.dependencies import DependencyPlan
+from core.engine import PluginEngine
+from core.memo import ResultMemo
+from core.metrics import TRACE, metrics
+from core.plugins import BASE_DIR
+
+# Maximum number of plugin results kept in memory per analysis run
+MEMO_SIZE = 10000
+
+# Persistent result cache shared between runs
+DEFAULT_CACHE_FILE = os.path.join(BASE_DIR, 'results_cache.sqlite')
+
+# Size of the shared plugin thread pool and how many rows may wait for results before writing blocks
+MAX_WORKERS = 32
+MAX_PENDING_ROWS = 1000
+
+# Plugin runs submitted but not finished, over all files of a run
+MAX_IN_FLIGHT = 4096
+
+# Input files are read in large chunks, which matters for multi-GB exports
+READ_BUFFER_SIZE = 1024 * 1024
+
+# CSV row counts and I/O times are added to the shared metrics every this many rows
+METRICS_ROW_BATCH = 1000
+
+# Where the plugin result columns go
+COLUMN_LAYOUTS = {
+    'header': "After the header's columns (single pass)",
+    'prepend': "Before the input columns (single pass)",
+    'scan': "After the widest row (reads each file twice)",
+    'none': "No result columns, input rows unchanged (results go to a record sink)",
+}
+DEFAULT_COLUMN_LAYOUT = 'header'
+
+
+def open_csv(file_name):
+    return open(file_name, newline='', buffering=READ_BUFFER_SIZE)
+
+
+def find_max_columns(file_name):
+    max_cols = 0
+    with open_csv(file_name) as f:
+        reader = csv.reader(f)
+        for row in reader:
+            max_cols = max(max_cols, len(row))
+    return max_cols
+
+
+def format_plugin_result(plugin_result):
+    if isinstance(plugin_result, dict) and 'success' in plugin_result and 'result' in plugin_result:
+        if plugin_result['success'] or plugin_result.get('skipped'):
+            return str(plugin_result['result'])
+        else:
+            return f"Error: {plugin_result['result']}"
+    return "Invalid format"
+
+
+class CsvProcessor:
+    """
+    Reads CSV rows, runs the selected plugins on every entity the ParserSet finds through a PluginEngine
+    and writes each row with the plugin results appended, in input order.
+
+    The layout decides where result columns go: 'header' pads rows to the header's width
+    and appends the results, 'prepend' puts the results in front of the untouched input
+    columns, and 'scan' pads to the widest row of the file, which needs a full read of the
+    file before the first row can be processed. Result columns are at the same position in
+    every row: cells of rows wider than the padding are moved after the result columns.
+    'none' writes the input rows as they are, for runs
+    whose results go to a record sink only.
+
+    Has no GUI dependencies: the Qt CsvWorker and the headless CLI both drive it and get
+    progress through the optional callbacks:
+    - on_row(row, current_line) after a row has been written
+    - on_status(plugin_name, entity, current_line, cell_index) when a plugin run is scheduled
+
+    With a journal (a FileJournal), results of an interrupted run are replayed instead of
+    rerun, and new results are journaled.
+
+    With a record_sink (see core/records.py), every result is also written as a record of
+    its own, with the input (source), line, cell, entity and plugin it belongs to.
+
+    Every entity is classified once by the classifier (built-in classes only by default),
+    and only plugins whose entity_classes include its class run on it; the result cells of
+    the others stay empty. Entities per class are counted in the metrics.
+
+    Plugins requiring results of other plugins (requires in their YAML, see
+    core/dependencies.py) are scheduled after them for each entity, and skipped where a
+    requirement is not met.
+
+    Rows read and written, the time spent on CSV reading and writing and the rows waiting
+    for results are reported to the shared metrics.
+    """
+
+    def __init__(self, plugins, command_flags, parser_set, engine, on_row=None, on_status=None,
+                 layout=DEFAULT_COLUMN_LAYOUT, journal=None, classifier=None, record_sink=None):
+        if layout not in COLUMN_LAYOUTS:
+            raise ValueError(f"Unknown column layout: {layout}")
+        self.layout = layout
+        self.plugins = plugins
+        self.command_flags = command_flags
+        self.parser_set = parser_set
+        self.engine = engine
+        self.on_row = on_row
+        self.on_status = on_status
+        self.journal = journal
+        self.record_sink = record_sink
+        self.source = '-'  # Input named in records
+        self.classifier = classifier if classifier is not None else Classifier()
+        self.dependencies = DependencyPlan(plugins)
+        # {entity class: [(plugin index, plugin name)]}, filled on first sight of each class
+        self.class_plugins = {}
+        self.max_input_cols = None
+        self.infile = None
+        # Not yet published to the metrics
+        self.rows_read = 0
+        self.rows_written = 0
+        self.read_seconds = 0.0
+        self.write_seconds = 0.0
+        self.class_counts = {}
+
+    def process_file(self, file_name, writer, write_headers=True, flush=None):
+        self.max_input_cols = find_max_columns(file_name) if self.layout == 'scan' else None
+        self.source = file_name
+        with open_csv(file_name) as infile:
+            self.infile = infile
+            try:
+                self.process_csv(csv.reader(infile), writer, write_headers, flush)
+            finally:
+                self.infile = None
+
+    def read_position(self):
+        """
+        Returns how many bytes of the file in process_file have been read, or None.
+        Exact to a few KiB, which is plenty for progress reporting from another thread.
+        """
+        infile = self.infile
+        if infile is None:
+            return None
+        try:
+            return infile.buffer.tell()
+        except (ValueError, OSError):
+            return None
+
+    def process_csv(self, reader, writer, write_headers=True, flush=None, header=True):
+        """
+        Processes all rows of reader, or those read before the engine was cancelled. flush,
+        if given, is called after every written row, so streamed output reaches the consumer
+        right away. With header=False, e.g. for a shard of a file, the first row is data and
+        max_input_cols has to be set already.
+        """
+        headers = next(reader, None) if header else None  # Read the header row if it exists
+        if self.max_input_cols is None:
+            # Width not known from a pre-scan, use the header's
+            self.max_input_cols = len(headers) if headers else 0
+        if write_headers:
+            self.update_headers(headers, writer)
+
+        # Rows are submitted ahead while earlier rows wait for their plugin results,
+        # but always written in input order
+        pending_rows = deque()
+        collect_pending = lambda: [('mia_pending_rows', {}, len(pending_rows))]
+        metrics.add_collector(collect_pending)
+        # Checked once, so per-row logging costs nothing unless -vv asked for it
+        log_rows = logging.getLogger().isEnabledFor(TRACE)
+        try:
+            started = time.perf_counter()
+            for current_line, row in enumerate(reader, start=1 if headers or not header else 0):
+                if self.engine.cancelled:
+                    # Rows read so far are written with the results they got; the rest is left out
+                    logging.warning(f"Analysis cancelled, stopping before line {current_line}")
+                    break
+                self.read_seconds += time.perf_counter() - started
+                self.rows_read += 1
+                if log_rows:
+                    logging.log(TRACE, f"Processing line {current_line}: {row}")
+                pending_rows.append((current_line, *self.process_row(row, current_line)))
+                while pending_rows and (len(pending_rows) >= MAX_PENDING_ROWS or self.row_done(pending_rows[0][2])):
+                    if not self.row_done(pending_rows[0][2]):
+                        # About to block on the oldest row, so start its batches instead of waiting for them to fill
+                        self.engine.flush_batches()
+                    self.write_row(writer, *pending_rows.popleft(), flush)
+                if self.rows_read >= METRICS_ROW_BATCH:
+                    self.publish_metrics()
+                started = time.perf_counter()
+
+            # No more rows will arrive, so don't wait for partially filled batches to time out
+            self.engine.flush_batches()
+            while pending_rows:
+                self.write_row(writer, *pending_rows.popleft(), flush)
+        finally:
+            metrics.remove_collector(collect_pending)
+            self.publish_metrics()
+
+    def publish_metrics(self):
+        metrics.inc('mia_csv_rows_read_total', self.rows_read)
+        metrics.inc('mia_csv_rows_written_total', self.rows_written)
+        metrics.inc('mia_csv_read_seconds_total', self.read_seconds)
+        metrics.inc('mia_csv_write_seconds_total', self.write_seconds)
+        for entity_class, count in self.class_counts.items():
+            metrics.inc('mia_entities_total', count, **{'class': entity_class})
+        self.rows_read = self.rows_written = 0
+        self.read_seconds = self.write_seconds = 0.0
+        self.class_counts = {}
+
+    @staticmethod
+    def row_done(tasks):
+        return all(future.done() for _, future, _ in tasks)
+
+    def write_row(self, writer, current_line, row, tasks, flush=None):
+        # Tasks are in match order, so later matches in a row overwrite earlier ones as before
+        for result_index, future, source in tasks:
+            if result_index is not None:
+                row[result_index] = format_plugin_result(future.result())
+            if source is not None:
+                self.add_record(current_line, source, future.result())
+        started = time.perf_counter()
+        writer.writerow(row)
+        if flush is not None:
+            flush()
+        self.write_seconds += time.perf_counter() - started
+        self.rows_written += 1
+        if self.on_row is not None:
+            self.on_row(row, current_line)
+
+    def add_record(self, current_line, source, plugin_result):
+        cell_index, entity, entity_class, plugin_name = source
+        if isinstance(plugin_result, dict) and 'success' in plugin_result and 'result' in plugin_result:
+            success, text = bool(plugin_result['success']), str(plugin_result['result'])
+        else:
+            success, text = False, "Invalid format"
+        self.record_sink.add((self.source, current_line, cell_index, entity, entity_class, plugin_name,
+                              self.command_flags.get(plugin_name, ''), success, text))
+
+    def update_headers(self, headers, writer):
+        if headers and self.layout == 'none':
+            writer.writerow(headers)
+        elif headers:
+            plugin_headers = [f"{plugin_name} ({self.command_flags.get(plugin_name, '')})" for plugin_name in self.plugins]
+            if self.layout == 'prepend':
+                writer.writerow(plugin_headers + headers)
+                return
+            headers += [''] * (self.max_input_cols - len(headers))  # Pad headers if needed
+            writer.writerow(headers + plugin_headers)
+
+    def process_row(self, row, current_line):
+        """
+        Pads the row and schedules all plugin runs for its matches.
+        Returns the row and a list of (result_index, future, record source) tasks.
+        """
+        cells = row
+        if self.layout == 'none':
+            results_start = None
+        elif self.layout == 'prepend':
+            results_start = 0
+            row = [''] * len(self.plugins) + cells
+        else:
+            # Results always start at the padded width; cells beyond it follow the result columns
+            results_start = self.max_input_cols
+            row = (cells[:results_start] + [''] * (results_start - len(cells)) + [''] * len(self.plugins)
+                   + cells[results_start:])
+
+        tasks = []
+        for cell_index, cell in enumerate(cells):
+            for match in self.parser_set.findall(cell):
+                entity_class = self.classifier.classify(match)
+                self.class_counts[entity_class] = self.class_counts.get(entity_class, 0) + 1
+                eligible = self.class_plugins.get(entity_class)
+                if eligible is None:
+                    eligible = self.class_plugins[entity_class] = self.eligible_plugins(entity_class)
+                # The match's runs by plugin, for the plugins requiring them
+                futures = {} if self.dependencies.gated else None
+                for plugin_index, plugin_name in eligible:
+                    result_index = results_start + plugin_index if results_start is not None else None
+                    if self.on_status is not None:
+                        self.on_status(plugin_name, match, current_line, cell_index)
+                    source = (cell_index, match, entity_class, plugin_name) if self.record_sink is not None else None
+                    if futures is None:
+                        future = self.submit_task(plugin_name, match, current_line)
+                    else:
+                        after = self.dependencies.gate(plugin_name, futures)
+                        future = futures[plugin_name] = self.submit_task(plugin_name, match, current_line, after)
+                    tasks.append((result_index, future, source))
+
+        return row, tasks
+
+    def eligible_plugins(self, entity_class):
+        # Required plugins come first, so their runs exist when the plugins requiring them are scheduled
+        columns = {plugin_name: plugin_index for plugin_index, plugin_name in enumerate(self.plugins)}
+        return [(columns[plugin_name], plugin_name) for plugin_name in self.dependencies.order
+                if self.plugins[plugin_name].get('entity_classes') is None
+                or entity_class in self.plugins[plugin_name]['entity_classes']]
+
+    def submit_plugin(self, plugin_name, entity, after=None):
+        return self.engine.submit(plugin_name, entity, self.command_flags.get(plugin_name, ""), after)
+
+    def submit_task(self, plugin_name, entity, current_line, after=None):
+        if self.journal is None:
+            return self.submit_plugin(plugin_name, entity, after)
+        result = self.journal.lookup(current_line, plugin_name, entity)
+        if result is not None:
+            future = Future()
+            future.set_result(result)
+            return future
+        # The row only sees the result once it is journaled
+        journaled = Future()
+        self.submit_plugin(plugin_name, entity, after).add_done_callback(
+            lambda done: self.journal_result(current_line, plugin_name, entity, done, journaled)
+        )
+        return journaled
+
+    def journal_result(self, current_line, plugin_name, entity, source, journaled):
+        exception = source.exception()
+        if exception is not None:
+            journaled.set_exception(exception)
+            return
+        try:
+            self.journal.record(current_line, plugin_name, entity, source.result())
+        except Exception as e:
+            # Losing resumability is no reason to lose the result
+            logging.error(f"Journaling {plugin_name} result for {entity} failed: {e}")
+        journaled.set_result(source.result())
+
+
+def create_engine(plugins, cache=None, max_workers=MAX_WORKERS, max_in_flight=MAX_IN_FLIGHT, remote=None):
+    return PluginEngine(plugins, ResultMemo(MEMO_SIZE), cache, max_workers, max_in_flight, remote)
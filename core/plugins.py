@@ -0,0 +1,467 @@
+import asyncio
+import glob
+import importlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future
+
+import yaml
+
+from core.dependencies import DependencyError, parse_requirement
+from core.metrics import metrics
+from core.result_cache import parse_ttl
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Settings read from each plugin's YAML file and their defaults
+PLUGIN_SETTINGS = {
+    'exec_order': 0,
+    'cache_ttl': 0,
+    'max_concurrency': None,
+    'batch_size': 1,
+    'batch_latency': 0.5,
+    'adaptive': True,
+    'max_rate': None,
+    'entity_classes': None,  # Classes of entities the plugin runs on (see core/classify.py), None for all
+    'requires': None,  # Conditions on other plugins' results for the entity (see core/dependencies.py)
+    'conditions': None,  # {name: regex} conditions on this plugin's results other plugins can require
+    'timeout': None,  # Seconds a run (or batch) may take before it counts as timed out, None for no limit
+}
+
+# Types of the manifest keys the application understands; plugins may add their own keys
+MANIFEST_SCHEMA = {
+    'ui_descriptor': (str,),
+    'plugin_base_name': (str,),
+    'description': (str,),
+    'eligible_parsers': (list,),
+    'exec_order': (int,),
+    'cache_ttl': (int, float, str),
+    'max_concurrency': (int, type(None)),
+    'batch_size': (int,),
+    'batch_latency': (int, float),
+    'adaptive': (bool,),
+    'max_rate': (int, float, type(None)),
+    'entity_classes': (list, type(None)),
+    'requires': (list, type(None)),
+    'conditions': (dict, type(None)),
+    'timeout': (int, float, type(None)),
+}
+
+MANIFEST_CACHE_VERSION = 1
+
+
+class ManifestError(ValueError):
+    """
+    A plugin YAML that does not match MANIFEST_SCHEMA.
+    """
+
+
+def validate_manifest(name, manifest):
+    """
+    Checks a parsed plugin YAML against MANIFEST_SCHEMA and the value ranges of its settings.
+    """
+    if not isinstance(manifest, dict):
+        raise ManifestError(f"Plugin {name}: manifest is not a mapping")
+    for key, types in MANIFEST_SCHEMA.items():
+        value = manifest.get(key)
+        if key in manifest and (not isinstance(value, types) or (isinstance(value, bool) and bool not in types)):
+            expected = ' or '.join('null' if t is type(None) else t.__name__ for t in types)
+            raise ManifestError(f"Plugin {name}: {key} must be {expected}, got {value!r}")
+    try:
+        parse_ttl(manifest.get('cache_ttl'))
+    except ValueError as e:
+        raise ManifestError(f"Plugin {name}: {e}")
+    if manifest.get('max_concurrency') is not None and manifest['max_concurrency'] < 1:
+        raise ManifestError(f"Plugin {name}: max_concurrency must be at least 1")
+    if manifest.get('batch_size', 1) < 1:
+        raise ManifestError(f"Plugin {name}: batch_size must be at least 1")
+    if manifest.get('batch_latency', 0) < 0:
+        raise ManifestError(f"Plugin {name}: batch_latency must not be negative")
+    if manifest.get('max_rate') is not None and manifest['max_rate'] <= 0:
+        raise ManifestError(f"Plugin {name}: max_rate must be positive")
+    if manifest.get('timeout') is not None and manifest['timeout'] <= 0:
+        raise ManifestError(f"Plugin {name}: timeout must be positive")
+    if not all(isinstance(entity_class, str) for entity_class in manifest.get('entity_classes') or []):
+        raise ManifestError(f"Plugin {name}: entity_classes must be a list of class names")
+    for spec in manifest.get('requires') or []:
+        if not isinstance(spec, str):
+            raise ManifestError(f"Plugin {name}: requires must be a list of conditions, got {spec!r}")
+        try:
+            parse_requirement(spec)
+        except DependencyError as e:
+            raise ManifestError(f"Plugin {name}: requires {e}")
+    for condition, pattern in (manifest.get('conditions') or {}).items():
+        if not isinstance(pattern, str):
+            raise ManifestError(f"Plugin {name}: condition {condition} must be a regular expression")
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise ManifestError(f"Plugin {name}: condition {condition}: {e}")
+    return manifest
+
+
+class PluginEntryPoints:
+    """
+    The callables of an imported plugin module, resolved once.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.run = getattr(module, 'run', None)
+        self.run_async = getattr(module, 'run_async', None)
+        self.run_batch = getattr(module, 'run_batch', None)
+        if not callable(self.run) and self.run_async is None:
+            raise ManifestError(f"Plugin {module.__name__} has no run(entity, command_flag) function")
+        if self.run_async is not None and not asyncio.iscoroutinefunction(self.run_async):
+            raise ManifestError(f"Plugin {module.__name__}: run_async must be an async function")
+        if self.run_batch is None:
+            self.batch_mode = None
+        elif asyncio.iscoroutinefunction(self.run_batch):
+            self.batch_mode = 'async'
+        elif callable(self.run_batch):
+            self.batch_mode = 'sync'
+        else:
+            raise ManifestError(f"Plugin {module.__name__}: run_batch must be a function")
+
+
+class PluginRegistry:
+    """
+    Plugin manifests and entry points of one plugin folder.
+
+    Manifests (the plugin YAMLs) are validated and cached by path, modification time and
+    size, in memory and in <plugin folder>/__pycache__/manifests.json, so only changed YAMLs
+    are parsed again. Plugin modules are imported on first use, i.e. when a run actually
+    selects them, and their entry points are resolved once.
+    """
+
+    def __init__(self, plugin_folder='plugins'):
+        self.plugin_folder = plugin_folder
+        self.plugin_dir = os.path.join(BASE_DIR, plugin_folder)
+        self.cache_file = os.path.join(self.plugin_dir, '__pycache__', 'manifests.json')
+        self._manifests = None
+        self._entry_points = {}
+        self._lock = threading.Lock()
+
+    def manifest(self, plugin_base_name):
+        """
+        Returns the validated YAML of a plugin, or an empty dict if it has none.
+        """
+        yaml_file = os.path.join(self.plugin_dir, plugin_base_name + '.yaml')
+        try:
+            stat = os.stat(yaml_file)
+        except OSError:
+            return {}
+        key = [stat.st_mtime_ns, stat.st_size]
+        with self._lock:
+            if self._manifests is None:
+                self._manifests = self._read_cache()
+            cached = self._manifests.get(plugin_base_name)
+            if cached is not None and cached['key'] == key:
+                return cached['manifest']
+        with open(yaml_file, 'r') as file:
+            manifest = validate_manifest(plugin_base_name, yaml.safe_load(file) or {})
+        with self._lock:
+            self._manifests[plugin_base_name] = {'key': key, 'manifest': manifest}
+            self._write_cache()
+        return manifest
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                cache = json.load(f)
+            if cache.get('version') == MANIFEST_CACHE_VERSION:
+                return cache['manifests']
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+        return {}
+
+    def _write_cache(self):
+        # Best effort; a read-only install just parses the YAMLs every start
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            temp_file = self.cache_file + '.tmp'
+            with open(temp_file, 'w') as f:
+                json.dump({'version': MANIFEST_CACHE_VERSION, 'manifests': self._manifests}, f)
+            os.replace(temp_file, self.cache_file)
+        except (OSError, TypeError, ValueError) as e:
+            logging.debug(f"Could not write plugin manifest cache: {e}")
+
+    def load(self):
+        """
+        Returns {plugin_base_name: plugin dict} for every plugin module in the folder, sorted
+        by exec_order. Nothing is imported; plugins with an invalid manifest are skipped.
+        """
+        plugins = {}
+        for py_file in sorted(glob.glob(os.path.join(self.plugin_dir, '*.py'))):
+            plugin_base_name = os.path.basename(py_file)[:-3]
+            plugin_path = os.path.relpath(py_file, BASE_DIR)
+            plugin_name = plugin_path.replace(os.sep, '.')[:-3]
+
+            # Read the plugin settings from the corresponding YAML file
+            try:
+                config = self.manifest(plugin_base_name)
+            except (ManifestError, yaml.YAMLError) as e:
+                logging.error(f"Skipping plugin {plugin_base_name}: {e}")
+                continue
+
+            plugin = {'type': 'python', 'name': plugin_name}
+            for setting, default in PLUGIN_SETTINGS.items():
+                plugin[setting] = config.get(setting, default)
+            plugin['cache_ttl'] = parse_ttl(plugin['cache_ttl'])
+            plugins[plugin_base_name] = plugin
+
+        # Sort plugins based on exec_order
+        return dict(sorted(plugins.items(), key=lambda item: item[1]['exec_order']))
+
+    def entry_points(self, plugin):
+        """
+        Imports the plugin's module on first use and returns its PluginEntryPoints.
+        """
+        entry_points = self._entry_points.get(plugin['name'])
+        if entry_points is None:
+            entry_points = PluginEntryPoints(importlib.import_module(plugin['name']))
+            if plugin.get('batch_size', 1) > 1 and entry_points.batch_mode is None:
+                logging.warning(f"Plugin {plugin['name']} sets batch_size but has no run_batch, running entities one by one")
+            self._entry_points[plugin['name']] = entry_points
+        return entry_points
+
+
+registry = PluginRegistry()
+if hasattr(os, 'register_at_fork'):
+    # A process forked while plugin threads hold the lock would never get it
+    os.register_at_fork(after_in_child=lambda: setattr(registry, '_lock', threading.Lock()))
+
+
+def plugin_config(plugin_base_name, plugin_folder='plugins'):
+    """
+    Returns the parsed YAML of a plugin, or an empty dict if it has none.
+    Lets plugins read their own settings.
+    """
+    if plugin_folder == registry.plugin_folder:
+        return registry.manifest(plugin_base_name)
+    return PluginRegistry(plugin_folder).manifest(plugin_base_name)
+
+
+def load_plugins(plugin_folder='plugins'):
+    if plugin_folder == registry.plugin_folder:
+        return registry.load()
+    return PluginRegistry(plugin_folder).load()
+
+
+def supports_async(plugin):
+    """
+    True if the plugin module exposes an `async def run_async(entity, command_flag)`.
+    """
+    if plugin['type'] != 'python':
+        return False
+    try:
+        return registry.entry_points(plugin).run_async is not None
+    except Exception:
+        return False
+
+
+def batch_mode(plugin):
+    """
+    'async' or 'sync' if the plugin module exposes run_batch(entities, command_flag), else None.
+    """
+    if plugin['type'] != 'python':
+        return None
+    try:
+        return registry.entry_points(plugin).batch_mode
+    except Exception:
+        return None
+
+
+def plugin_label(plugin):
+    """
+    The plugin's base name, as used in metrics.
+    """
+    return plugin['name'].rsplit('.', 1)[-1]
+
+
+def _cached_result(plugin, entity, command_flag, cache):
+    if cache is None:
+        return None
+    cached = cache.get(plugin['name'], entity, command_flag or "")
+    metrics.inc('mia_cache_lookups_total', plugin=plugin_label(plugin), result='miss' if cached is None else 'hit')
+    return cached
+
+
+def _record_call(plugin, started, outcome, entities=1):
+    label = plugin_label(plugin)
+    metrics.observe('mia_plugin_latency_seconds', time.perf_counter() - started, plugin=label)
+    metrics.inc('mia_plugin_calls_total', plugin=label, outcome=outcome)
+    metrics.inc('mia_plugin_entities_total', entities, plugin=label)
+
+
+def result_outcome(result):
+    """
+    'success', 'failure' or 'throttled' for a result dict. Plugins mark results refused by
+    an upstream for rate limiting with 'throttled': True. For a batch's {entity: result}
+    dict, throttled wins over success, success over failure.
+    """
+    if 'success' in result:
+        if result.get('throttled'):
+            return 'throttled'
+        return 'success' if result['success'] else 'failure'
+    outcomes = {result_outcome(entity_result) for entity_result in result.values()}
+    for outcome in ('throttled', 'success'):
+        if outcome in outcomes:
+            return outcome
+    return 'failure'
+
+
+def _checked_result(plugin, entity, command_flag, cache, result):
+    if isinstance(result, dict) and 'success' in result and 'result' in result:
+        if cache is not None and result['success']:
+            cache.put(plugin['name'], entity, command_flag or "", result, plugin.get('cache_ttl', 0))
+        return result
+    raise ValueError("Plugin returned data in an unexpected format")
+
+
+def execute_plugin(plugin, entity, command_flag=None, cache=None):
+    cached = _cached_result(plugin, entity, command_flag, cache)
+    if cached is not None:
+        return cached
+    started = time.perf_counter()
+    try:
+        if plugin['type'] == 'python':
+            result = registry.entry_points(plugin).run(entity, command_flag)
+            result = _checked_result(plugin, entity, command_flag, cache, result)
+            _record_call(plugin, started, result_outcome(result))
+            return result
+    except Exception as e:
+        _record_call(plugin, started, 'error')
+        logging.error(f"Error executing plugin {plugin['name']} for entity {entity}: {e}")
+        return {'success': False, 'result': str(e)}
+
+
+async def execute_plugin_async(plugin, entity, command_flag=None, cache=None):
+    """
+    Coroutine counterpart of execute_plugin for plugins that expose run_async.
+    """
+    cached = _cached_result(plugin, entity, command_flag, cache)
+    if cached is not None:
+        return cached
+    started = time.perf_counter()
+    try:
+        result = await registry.entry_points(plugin).run_async(entity, command_flag)
+        result = _checked_result(plugin, entity, command_flag, cache, result)
+        _record_call(plugin, started, result_outcome(result))
+        return result
+    except Exception as e:
+        _record_call(plugin, started, 'error')
+        logging.error(f"Error executing plugin {plugin['name']} for entity {entity}: {e}")
+        return {'success': False, 'result': str(e)}
+
+
+async def run_each_async(run_async, entities, command_flag=None):
+    """
+    Helper for run_batch implementations: runs run_async concurrently for each entity.
+    An exception only fails its own entity, not the whole batch.
+    """
+    answers = await asyncio.gather(*(run_async(entity, command_flag) for entity in entities), return_exceptions=True)
+    return {
+        entity: {'success': False, 'result': str(answer)} if isinstance(answer, Exception) else answer
+        for entity, answer in zip(entities, answers)
+    }
+
+
+def _split_cached(plugin, entities, command_flag, cache):
+    results = {}
+    missing = []
+    for entity in entities:
+        cached = _cached_result(plugin, entity, command_flag, cache)
+        if cached is not None:
+            results[entity] = cached
+        else:
+            missing.append(entity)
+    return results, missing
+
+
+def _checked_batch(plugin, entities, command_flag, cache, batch_result, results):
+    if not isinstance(batch_result, dict):
+        raise ValueError("Plugin returned data in an unexpected format")
+    for entity in entities:
+        if entity in batch_result:
+            try:
+                results[entity] = _checked_result(plugin, entity, command_flag, cache, batch_result[entity])
+            except ValueError as e:
+                results[entity] = {'success': False, 'result': str(e)}
+        else:
+            results[entity] = {'success': False, 'result': "No result returned by batch run"}
+    return results
+
+
+def _failed_batch(plugin, entities, results, error):
+    logging.error(f"Error executing plugin {plugin['name']} for batch of {len(entities)} entities: {error}")
+    for entity in entities:
+        results[entity] = {'success': False, 'result': str(error)}
+    return results
+
+
+def execute_plugin_remote(plugin, entities, command_flag, cache, remote):
+    """
+    Sends a plugin run on all entities without a cached result to the agents of a
+    RemoteWorkers (see core/remote.py). Returns a Future of a dict mapping every entity
+    to a result dict.
+    """
+    future = Future()
+    results, missing = _split_cached(plugin, entities, command_flag, cache)
+    if not missing:
+        future.set_result(results)
+        return future
+    started = time.perf_counter()
+
+    def finish(done):
+        try:
+            checked = _checked_batch(plugin, missing, command_flag, cache, done.result(), results)
+            _record_call(plugin, started, result_outcome({entity: checked[entity] for entity in missing}), len(missing))
+        except Exception as e:
+            _record_call(plugin, started, 'error', len(missing))
+            checked = _failed_batch(plugin, missing, results, e)
+        future.set_result(checked)
+
+    remote.submit(plugin_label(plugin), missing, command_flag).add_done_callback(finish)
+    return future
+
+
+def execute_plugin_batch(plugin, entities, command_flag=None, cache=None):
+    """
+    Runs a plugin's run_batch on all entities without a cached result.
+    Returns a dict mapping every entity to a result dict.
+    """
+    results, missing = _split_cached(plugin, entities, command_flag, cache)
+    if not missing:
+        return results
+    started = time.perf_counter()
+    try:
+        batch_result = registry.entry_points(plugin).run_batch(missing, command_flag)
+        results = _checked_batch(plugin, missing, command_flag, cache, batch_result, results)
+        _record_call(plugin, started, result_outcome({entity: results[entity] for entity in missing}), len(missing))
+        return results
+    except Exception as e:
+        _record_call(plugin, started, 'error', len(missing))
+        return _failed_batch(plugin, missing, results, e)
+
+
+async def execute_plugin_batch_async(plugin, entities, command_flag=None, cache=None):
+    """
+    Coroutine counterpart of execute_plugin_batch for plugins with an async run_batch.
+    """
+    results, missing = _split_cached(plugin, entities, command_flag, cache)
+    if not missing:
+        return results
+    started = time.perf_counter()
+    try:
+        batch_result = await registry.entry_points(plugin).run_batch(missing, command_flag)
+        results = _checked_batch(plugin, missing, command_flag, cache, batch_result, results)
+        _record_call(plugin, started, result_outcome({entity: results[entity] for entity in missing}), len(missing))
+        return results
+    except Exception as e:
+        _record_call(plugin, started, 'error', len(missing))
+        return _failed_batch(plugin, missing, results, e)
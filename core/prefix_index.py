@@ -0,0 +1,59 @@
+import ipaddress
+
+
+class PrefixIndex:
+    """
+    Longest-prefix-match index over IPv4 and IPv6 networks.
+
+    Networks are stored in one hash table per (IP version, prefix length), keyed by the
+    network address as an integer. A lookup masks the address once per prefix length in
+    use, longest first, so its cost depends on the number of distinct prefix lengths and
+    not on the number of stored networks.
+    """
+
+    def __init__(self, entries=None):
+        self._tables = {4: {}, 6: {}}
+        self._lengths = {4: [], 6: []}
+        self._count = 0
+        if isinstance(entries, dict):
+            entries = entries.items()
+        for network, value in entries or ():
+            self.insert(network, value)
+
+    def insert(self, network, value):
+        network = ipaddress.ip_network(network, strict=False)
+        tables = self._tables[network.version]
+        table = tables.get(network.prefixlen)
+        if table is None:
+            table = tables[network.prefixlen] = {}
+            self._lengths[network.version] = sorted(tables, reverse=True)
+        if int(network.network_address) not in table:
+            self._count += 1
+        table[int(network.network_address)] = value
+
+    def lookup(self, address):
+        """
+        Returns (network, value) of the most specific stored network containing address,
+        or None.
+        """
+        address = ipaddress.ip_address(address)
+        version = address.version
+        value = int(address)
+        bits = address.max_prefixlen
+        tables = self._tables[version]
+        for prefixlen in self._lengths[version]:
+            key = value >> (bits - prefixlen) << (bits - prefixlen) if prefixlen else 0
+            if key in tables[prefixlen]:
+                network = ipaddress.ip_network((key, prefixlen))
+                return network, tables[prefixlen][key]
+        return None
+
+    def get(self, address, default=None):
+        match = self.lookup(address)
+        return match[1] if match is not None else default
+
+    def __contains__(self, address):
+        return self.lookup(address) is not None
+
+    def __len__(self):
+        return self._count
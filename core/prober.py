@@ -0,0 +1,217 @@
+import asyncio
+import ipaddress
+import itertools
+import logging
+import os
+import socket
+import struct
+import time
+
+from core.ratelimit import TokenBucket
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ECHO_REPLY = 129
+
+DEFAULT_TCP_PORTS = (80, 443, 22)
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def _open_icmp_socket(family):
+    """
+    Opens an ICMP socket for the address family: an unprivileged datagram ("ping") socket
+    if the kernel allows it (net.ipv4.ping_group_range), otherwise a raw socket, which
+    requires root or CAP_NET_RAW. Returns (socket, is_raw) or (None, False).
+    """
+    protocol = socket.IPPROTO_ICMP if family == socket.AF_INET else socket.IPPROTO_ICMPV6
+    for kind, is_raw in ((socket.SOCK_DGRAM, False), (socket.SOCK_RAW, True)):
+        try:
+            sock = socket.socket(family, kind, protocol)
+        except (PermissionError, OSError):
+            continue
+        sock.setblocking(False)
+        try:
+            # Replies to a large sweep arrive in bursts
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        except OSError:
+            pass
+        return sock, is_raw
+    return None, False
+
+
+class _IcmpChannel:
+    """
+    One ICMP socket shared by all probes of an address family. Echo requests are matched
+    to replies by (source address, sequence number).
+    """
+
+    def __init__(self, loop, family, sock, is_raw):
+        self.loop = loop
+        self.family = family
+        self.sock = sock
+        self.is_raw = is_raw
+        self.identifier = os.getpid() & 0xffff
+        self._sequence = itertools.cycle(range(1, 0x10000))
+        self._waiting = {}
+        loop.add_reader(sock.fileno(), self._on_readable)
+
+    def _packet(self, sequence):
+        payload = struct.pack('!d', time.monotonic()) + b'mass_ip_analysis'
+        request = ICMP_ECHO_REQUEST if self.family == socket.AF_INET else ICMPV6_ECHO_REQUEST
+        header = struct.pack('!BBHHH', request, 0, 0, self.identifier, sequence)
+        if self.family == socket.AF_INET6:
+            # The kernel fills in the ICMPv6 checksum
+            return header + payload
+        checksum = _checksum(header + payload)
+        return struct.pack('!BBHHH', request, 0, checksum, self.identifier, sequence) + payload
+
+    async def echo(self, ip, timeout):
+        """
+        Sends one echo request and returns the round-trip time in seconds, or None on timeout.
+        """
+        sequence = next(self._sequence)
+        key = (ip, sequence)
+        future = self.loop.create_future()
+        self._waiting[key] = future
+        sent = time.monotonic()
+        try:
+            await self.loop.sock_sendto(self.sock, self._packet(sequence), (ip, 0))
+            await asyncio.wait_for(future, timeout)
+            return time.monotonic() - sent
+        except (asyncio.TimeoutError, OSError):
+            return None
+        finally:
+            self._waiting.pop(key, None)
+
+    def _on_readable(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.debug(f"ICMP receive failed: {e}")
+                return
+            if self.is_raw and self.family == socket.AF_INET:
+                data = data[(data[0] & 0x0f) * 4:]  # Raw IPv4 sockets include the IP header
+            if len(data) < 8:
+                continue
+            kind, _, _, identifier, sequence = struct.unpack('!BBHHH', data[:8])
+            if kind not in (ICMP_ECHO_REPLY, ICMPV6_ECHO_REPLY):
+                continue
+            # Datagram sockets get their identifier rewritten by the kernel and only see their own replies
+            if self.is_raw and identifier != self.identifier:
+                continue
+            source = str(ipaddress.ip_address(address[0].split('%')[0]))
+            future = self._waiting.get((source, sequence))
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+
+class Prober:
+    """
+    Concurrent reachability prober. Each target gets ICMP echo requests when an ICMP
+    socket can be opened, otherwise (or with method='tcp') TCP connects to the given
+    ports, where both an accepted and a refused connection count as the host being up.
+
+    `rate` limits probes per second across all targets, `max_in_flight` limits how many
+    targets are probed at once, and `timeout` is the wait per attempt in seconds.
+    Must be created and used on one event loop.
+    """
+
+    def __init__(self, method='auto', tcp_ports=DEFAULT_TCP_PORTS, timeout=1.0, retries=1,
+                 rate=500, max_in_flight=1024):
+        if method not in ('auto', 'icmp', 'tcp'):
+            raise ValueError(f"Unknown probe method: {method}")
+        self.method = method
+        self.tcp_ports = tuple(tcp_ports)
+        self.timeout = timeout
+        self.retries = retries
+        self._limiter = TokenBucket(rate, burst=max(1, int(rate or 1) // 10))
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._channels = {}
+
+    def _channel(self, family):
+        if family not in self._channels:
+            channel = None
+            if self.method != 'tcp':
+                sock, is_raw = _open_icmp_socket(family)
+                if sock is not None:
+                    channel = _IcmpChannel(asyncio.get_running_loop(), family, sock, is_raw)
+                elif self.method == 'icmp':
+                    raise PermissionError("No ICMP socket available; run as root or allow ping sockets")
+                else:
+                    logging.debug("No ICMP socket available, falling back to TCP connect probes")
+            self._channels[family] = channel
+        return self._channels[family]
+
+    async def probe(self, ip):
+        """
+        Returns (up, rtt_seconds, method) for one address.
+        """
+        ip = str(ipaddress.ip_address(ip))
+        family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+        async with self._in_flight:
+            channel = self._channel(family)
+            for _ in range(self.retries + 1):
+                await self._limiter.acquire()
+                if channel is not None:
+                    rtt = await channel.echo(ip, self.timeout)
+                    method = 'icmp'
+                else:
+                    rtt = await self._tcp_probe(ip)
+                    method = 'tcp'
+                if rtt is not None:
+                    return True, rtt, method
+            return False, None, method
+
+    async def probe_many(self, ips):
+        """
+        Probes all addresses concurrently and returns {ip: (up, rtt_seconds, method)}.
+        """
+        results = await asyncio.gather(*(self.probe(ip) for ip in ips))
+        return dict(zip(ips, results))
+
+    async def _tcp_probe(self, ip):
+        started = time.monotonic()
+        attempts = [asyncio.ensure_future(self._tcp_connect(ip, port)) for port in self.tcp_ports]
+        try:
+            for attempt in asyncio.as_completed(attempts, timeout=self.timeout):
+                if await attempt:
+                    return time.monotonic() - started
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+        return None
+
+    @staticmethod
+    async def _tcp_connect(ip, port):
+        try:
+            _, writer = await asyncio.open_connection(ip, port)
+        except ConnectionRefusedError:
+            return True  # A reset still proves the host is there
+        except OSError:
+            return False
+        writer.close()
+        return True
+
+    def close(self):
+        for channel in self._channels.values():
+            if channel is not None:
+                channel.close()
+        self._channels.clear()
@@ -0,0 +1,157 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Asyncio token bucket: on average `rate` acquisitions per second, with bursts of up to
+    `burst`. Waiting callers sleep on the event loop instead of blocking a thread.
+    A rate of 0 or None disables limiting.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self):
+        """
+        Reserves one token and returns how many seconds the caller has to wait for it.
+        """
+        now = time.monotonic()
+        wait = max(0.0, self._blocked_until - now)
+        if not self.rate:
+            return wait
+        self._refill(now)
+        self._tokens -= 1
+        if self._tokens < 0:
+            wait = max(wait, -self._tokens / self.rate)
+        return wait
+
+    async def acquire(self):
+        wait = self.delay()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Holds back all acquisitions for the given time, e.g. after the upstream throttled us.
+        """
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def set_rate(self, rate):
+        """
+        Changes the rate; tokens collected so far are kept.
+        """
+        now = time.monotonic()
+        if self.rate:
+            self._refill(now)
+        else:
+            self._tokens = min(self._tokens, float(self.burst))
+        self._updated = now
+        self.rate = rate
+
+
+class AimdController:
+    """
+    Additive-increase/multiplicative-decrease control of one plugin's concurrency and
+    request rate, driven by the outcomes of its runs.
+
+    A throttled outcome multiplies the concurrency limit by decrease, once per round: only
+    runs started after the last decrease can cause the next one, so a burst of throttled
+    answers counts as one signal. Every successful outcome adds 1/limit, about one more
+    task per round of completions. Failed outcomes (e.g. a host that is down) change nothing.
+
+    Throttling at the lowest concurrency means the upstream limits requests per second, so
+    the request rate is limited from there on: it is cut by decrease on throttling, at most
+    once per RATE_COOLDOWN seconds as such limits tend to be per-second windows that refuse
+    everything until they end, and grows by a tenth of its cut level per second. Without a max_rate ceiling, pacing stops
+    once the rate reaches twice the level it was throttled at.
+
+    Not thread-safe; the engine calls it under its lock.
+    """
+
+    RATE_RECOVERY = 0.1
+    RATE_COOLDOWN = 1.0
+
+    def __init__(self, max_concurrency, max_rate=None, min_concurrency=1, decrease=0.5, min_rate=0.1):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.concurrency = float(max_concurrency)
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.decrease = decrease
+        self.bucket = TokenBucket(max_rate)
+        self.throttled = 0
+        now = time.monotonic()
+        self._last_decrease = float('-inf')
+        self._last_rate_decrease = float('-inf')
+        self._last_increase = now
+        self._rate_step = 0.0
+        self._release_rate = None
+        # Successful runs in the current and the previous second
+        self._second = int(now)
+        self._successes = 0
+        self._previous_successes = 0
+
+    @property
+    def limit(self):
+        return max(self.min_concurrency, int(self.concurrency))
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def delay(self):
+        """
+        Reserves a start and returns how many seconds it has to wait for the current rate.
+        """
+        return self.bucket.delay()
+
+    def record(self, outcome, started=None):
+        """
+        Feeds the outcome of a run started at time.monotonic() started: 'success',
+        'failure' or 'throttled'.
+        """
+        now = time.monotonic()
+        if int(now) != self._second:
+            self._previous_successes = self._successes if int(now) == self._second + 1 else 0
+            self._second = int(now)
+            self._successes = 0
+        if outcome == 'throttled':
+            self.throttled += 1
+            if started is None or started > self._last_decrease:
+                self._decrease(now)
+        elif outcome == 'success':
+            self._successes += 1
+            if self.concurrency < self.max_concurrency:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.limit)
+            if self.rate:
+                rate = self.rate + self._rate_step * (now - self._last_increase)
+                if self.max_rate is not None:
+                    rate = min(self.max_rate, rate)
+                elif rate >= self._release_rate:
+                    rate = None  # Well past the throttled level, stop pacing
+                self.bucket.set_rate(rate)
+            self._last_increase = now
+
+    def _decrease(self, now):
+        at_floor = self.limit <= self.min_concurrency
+        self._last_decrease = now
+        self.concurrency = max(self.min_concurrency, self.concurrency * self.decrease)
+        if (at_floor or self.rate != self.max_rate) and now - self._last_rate_decrease >= self.RATE_COOLDOWN:
+            self._last_rate_decrease = now
+            # What got through during the last second is what the upstream tolerates
+            current = self.rate or max(self._successes, self._previous_successes)
+            rate = max(self.min_rate, current * self.decrease)
+            self._rate_step = max(self.min_rate, rate * self.RATE_RECOVERY)
+            # Nothing may have got through yet, and a release rate of 0 would end pacing at once
+            self._release_rate = 2 * max(current, rate)
+            self.bucket.set_rate(rate)
+        self._last_increase = now
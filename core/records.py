@@ -0,0 +1,131 @@
+"""
+Structured result output: one record per (input row, entity, plugin) instead of result text
+in CSV cells, written to SQLite or JSON Lines. Every match of a cell gets its own records,
+and multi-line results stay intact.
+
+    sqlite3 results.sqlite "SELECT entity, result FROM results WHERE plugin = 'whois' AND success"
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+# Fields of a record, in the order CsvProcessor passes them
+RECORD_FIELDS = ('input', 'line', 'cell', 'entity', 'class', 'plugin', 'flags', 'success', 'result')
+
+# Records buffered before they are written in one transaction (or one write)
+RECORD_BATCH_SIZE = 1000
+
+
+class RecordSink:
+    """
+    Buffers records from any thread and writes them in batches.
+    Subclasses implement _write(records) and _close().
+    """
+
+    def __init__(self, path, batch_size=RECORD_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.records = 0
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self._pending.append(record)
+            if len(self._pending) >= self.batch_size:
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._pending:
+            return
+        self._write(self._pending)
+        self.records += len(self._pending)
+        self._pending = []
+
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            self._close()
+        logging.debug(f"Wrote {self.records} result records to {self.path}")
+
+
+class SqliteRecordSink(RecordSink):
+    """
+    Records in the results table of a new SQLite database. The indexes on entity and plugin
+    are created on close, which is faster than keeping them up to date while loading.
+    """
+
+    def __init__(self, path, batch_size=RECORD_BATCH_SIZE):
+        super().__init__(path, batch_size)
+        # Replaced like a CSV output file
+        for stale in (path, path + '-wal', path + '-shm'):
+            if os.path.exists(stale):
+                os.remove(stale)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE results ('
+            ' input TEXT NOT NULL,'
+            ' line INTEGER NOT NULL,'
+            ' cell INTEGER NOT NULL,'
+            ' entity TEXT NOT NULL,'
+            ' class TEXT NOT NULL,'
+            ' plugin TEXT NOT NULL,'
+            ' flags TEXT NOT NULL,'
+            ' success INTEGER NOT NULL,'
+            ' result TEXT NOT NULL)'
+        )
+        self._conn.commit()
+
+    def _write(self, records):
+        with self._conn:
+            self._conn.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', records)
+
+    def _close(self):
+        with self._conn:
+            self._conn.execute('CREATE INDEX idx_results_entity ON results (entity)')
+            self._conn.execute('CREATE INDEX idx_results_plugin ON results (plugin)')
+            self._conn.execute('CREATE INDEX idx_results_row ON results (input, line)')
+        self._conn.close()
+
+
+class JsonlRecordSink(RecordSink):
+    """
+    Records as JSON objects, one per line, appended as they come.
+    """
+
+    def __init__(self, path, batch_size=RECORD_BATCH_SIZE):
+        super().__init__(path, batch_size)
+        self._file = open(path, 'w', encoding='utf-8')
+
+    def _write(self, records):
+        self._file.write(''.join(json.dumps(dict(zip(RECORD_FIELDS, record)), ensure_ascii=False) + '\n'
+                                 for record in records))
+
+    def _close(self):
+        self._file.close()
+
+
+RECORD_FORMATS = {
+    '.sqlite': SqliteRecordSink,
+    '.sqlite3': SqliteRecordSink,
+    '.db': SqliteRecordSink,
+    '.jsonl': JsonlRecordSink,
+}
+
+
+def open_record_sink(path):
+    """
+    Opens the sink for a path by its extension, raising ValueError for unknown ones.
+    """
+    sink = RECORD_FORMATS.get(os.path.splitext(path)[1].lower())
+    if sink is None:
+        raise ValueError(f"Unknown record format of {path}, use one of: {', '.join(RECORD_FORMATS)}")
+    return sink(path)
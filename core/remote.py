@@ -0,0 +1,447 @@
+"""
+Distributed plugin runs: a coordinator sends plugin tasks to agents on other hosts (or in
+other processes) over TCP, so their sockets, CPUs and source addresses add up. An agent is
+the plugins of its host behind a small server, run with
+
+    python3 -m core.remote --listen 0.0.0.0:7400 --token SECRET
+
+The protocol is JSON, one message per line. The coordinator opens a connection with
+{"op": "hello", "token", "plugins"} and the agent answers {"op": "hello", "missing", "slots"},
+or with an "error". Tasks are {"op": "run", "id", "plugin", "flag", "entities"}, answered by
+{"op": "result", "id", "results": {entity: result dict}} in any order. Agents send
+{"op": "heartbeat"} every HEARTBEAT_INTERVAL seconds.
+
+A task is leased to one agent at a time, and the lease is renewed by everything the agent
+sends. The tasks of an agent whose connection breaks, or that has not been heard of for
+LEASE_SECONDS, are sent to the other agents, up to MAX_ATTEMPTS times in all. Lost agents
+are reconnected every RECONNECT_INTERVAL seconds.
+"""
+import argparse
+import hmac
+import itertools
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from core.engine import PluginEngine
+from core.memo import ResultMemo
+from core.metrics import configure_logging, metrics
+from core.pipeline import MAX_IN_FLIGHT, MAX_WORKERS
+from core.plugins import load_plugins
+
+DEFAULT_AGENT_PORT = 7400
+
+HEARTBEAT_INTERVAL = 2.0
+LEASE_SECONDS = 10.0
+MAX_ATTEMPTS = 3
+RECONNECT_INTERVAL = 5.0
+CONNECT_TIMEOUT = 5.0
+
+# Tasks waiting for an agent fail once none has been connected for this long
+NO_AGENT_TIMEOUT = 30.0
+
+# Tasks an agent accepts at a time, unless --slots says otherwise
+DEFAULT_AGENT_SLOTS = 256
+
+
+def parse_address(address, default_port=DEFAULT_AGENT_PORT):
+    """
+    Splits HOST[:PORT] into (host, port), raising ValueError for an invalid port.
+    """
+    host, separator, port = address.rpartition(':')
+    if not separator or host.endswith(':'):
+        # No port, or a bare IPv6 address
+        return address.strip('[]'), default_port
+    try:
+        return host.strip('[]'), int(port)
+    except ValueError:
+        raise ValueError(f"Invalid agent address: {address}")
+
+
+def encode_message(message):
+    return (json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+def failed_results(entities, reason):
+    return {entity: {'success': False, 'result': reason} for entity in entities}
+
+
+class RemoteTask:
+    """
+    One plugin run on a list of entities, resolved with {entity: result dict}.
+    """
+
+    def __init__(self, task_id, plugin_name, command_flag, entities):
+        self.id = task_id
+        self.plugin_name = plugin_name
+        self.command_flag = command_flag
+        self.entities = entities
+        self.attempts = 0
+        self.future = Future()
+
+    def message(self):
+        return {'op': 'run', 'id': self.id, 'plugin': self.plugin_name, 'flag': self.command_flag,
+                'entities': self.entities}
+
+
+class AgentConnection:
+    """
+    The coordinator's connection to one agent and the tasks leased to it.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.label = f"{address[0]}:{address[1]}"
+        self.sock = None
+        self.reader = None
+        self.slots = 0
+        self.tasks = {}
+        self.last_seen = 0.0
+        self.down_since = time.monotonic()
+        self._send_lock = threading.Lock()
+
+    def connect(self, token, plugin_names):
+        sock = socket.create_connection(self.address, CONNECT_TIMEOUT)
+        try:
+            reader = sock.makefile('rb')
+            sock.sendall(encode_message({'op': 'hello', 'token': token, 'plugins': plugin_names}))
+            line = reader.readline()
+            reply = json.loads(line) if line else {}
+            if reply.get('op') != 'hello' or reply.get('error'):
+                raise ConnectionError(reply.get('error') or "no answer to hello")
+            if reply.get('missing'):
+                raise ConnectionError(f"plugins not installed: {', '.join(reply['missing'])}")
+            sock.settimeout(None)
+        except BaseException:
+            sock.close()
+            raise
+        self.sock, self.reader, self.slots = sock, reader, max(1, int(reply.get('slots') or 1))
+        self.last_seen = time.monotonic()
+        return sock
+
+    def send(self, message):
+        with self._send_lock:
+            self.sock.sendall(encode_message(message))
+
+
+class RemoteWorkers:
+    """
+    The coordinator: queues plugin tasks and leases them to the agents with the fewest tasks
+    relative to their slots. submit() returns a Future of {entity: result dict}; tasks that
+    exhausted their attempts, or found no agent, resolve with failed results.
+    """
+
+    def __init__(self, addresses, plugin_names, token=None):
+        self.agents = [AgentConnection(parse_address(address)) for address in addresses]
+        self.plugin_names = list(plugin_names)
+        self.token = token
+        self._pending = deque()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stopped = threading.Event()
+        self._no_agent_since = None
+        self._monitor = None
+
+    @property
+    def agent_count(self):
+        return len(self.agents)
+
+    def start(self):
+        """
+        Connects to all agents; raises ConnectionError if none can be reached.
+        """
+        errors = [error for error in map(self._connect, self.agents) if error is not None]
+        if len(errors) == len(self.agents):
+            raise ConnectionError(f"No agent reachable: {'; '.join(errors)}")
+        metrics.add_collector(self.collect_metrics)
+        self._monitor = threading.Thread(target=self._watch, name='agent-monitor', daemon=True)
+        self._monitor.start()
+        return self
+
+    def _connect(self, agent):
+        """
+        Returns None once connected, otherwise the error.
+        """
+        try:
+            sock = agent.connect(self.token, self.plugin_names)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Cannot connect to agent {agent.label}: {e}")
+            return f"{agent.label}: {e}"
+        logging.debug(f"Connected to agent {agent.label} ({agent.slots} slots)")
+        threading.Thread(target=self._read, args=(agent, sock, agent.reader), name=f"agent-{agent.label}",
+                         daemon=True).start()
+        self._dispatch()
+        return None
+
+    def collect_metrics(self):
+        with self._lock:
+            gauges = [('mia_remote_pending', {}, len(self._pending))]
+            for agent in self.agents:
+                gauges.append(('mia_agent_up', {'agent': agent.label}, int(agent.sock is not None)))
+                gauges.append(('mia_agent_tasks', {'agent': agent.label}, len(agent.tasks)))
+        return gauges
+
+    def submit(self, plugin_name, entities, command_flag=""):
+        task = RemoteTask(next(self._ids), plugin_name, command_flag or "", list(entities))
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The coordinator has been closed")
+            self._pending.append(task)
+        self._dispatch()
+        return task.future
+
+    def _dispatch(self):
+        sends = []
+        with self._lock:
+            while self._pending:
+                free = [agent for agent in self.agents if agent.sock is not None and len(agent.tasks) < agent.slots]
+                if not free:
+                    break
+                agent = min(free, key=lambda agent: len(agent.tasks) / agent.slots)
+                task = self._pending.popleft()
+                task.attempts += 1
+                agent.tasks[task.id] = task
+                sends.append((agent, agent.sock, task))
+        for agent, sock, task in sends:
+            try:
+                agent.send(task.message())
+            except (OSError, AttributeError) as e:
+                # AttributeError: the connection was dropped by another thread meanwhile
+                self._lost(agent, sock, e)
+
+    def _read(self, agent, sock, reader):
+        error = "connection closed"
+        try:
+            for line in reader:
+                message = json.loads(line)
+                with self._lock:
+                    agent.last_seen = time.monotonic()
+                    task = agent.tasks.pop(message.get('id'), None) if message.get('op') == 'result' else None
+                if task is not None:
+                    task.future.set_result(message.get('results') or {})
+                    self._dispatch()
+        except (OSError, ValueError) as e:
+            error = e
+        self._lost(agent, sock, error)
+
+    def _lost(self, agent, sock, error):
+        with self._lock:
+            if agent.sock is not sock:
+                return  # Already handled
+            agent.sock = None
+            agent.down_since = time.monotonic()
+            tasks = list(agent.tasks.values())
+            agent.tasks.clear()
+            failed = [task for task in tasks if self._closed or task.attempts >= MAX_ATTEMPTS]
+            retried = [task for task in tasks if task not in failed]
+            # Retried ahead of newer tasks, in their original order
+            self._pending.extendleft(reversed(retried))
+        try:
+            sock.close()
+        except OSError:
+            pass
+        if self._closed:
+            for task in failed:
+                task.future.set_result(failed_results(task.entities, "Coordinator closed"))
+            return
+        logging.warning(f"Lost agent {agent.label} ({error}), {len(retried)} tasks sent to other agents, "
+                        f"{len(failed)} failed")
+        if retried:
+            metrics.inc('mia_remote_retries_total', len(retried))
+        for task in failed:
+            task.future.set_result(failed_results(task.entities, f"Agent {agent.label} lost after {task.attempts} attempts"))
+        self._dispatch()
+
+    def _watch(self):
+        while not self._stopped.wait(1.0):
+            now = time.monotonic()
+            for agent in self.agents:
+                with self._lock:
+                    sock = agent.sock
+                    expired = sock is not None and now - agent.last_seen > LEASE_SECONDS
+                    reconnect = sock is None and now - agent.down_since >= RECONNECT_INTERVAL
+                    if reconnect:
+                        agent.down_since = now
+                if expired:
+                    self._lost(agent, sock, f"lease expired, nothing heard for {LEASE_SECONDS:.0f} s")
+                elif reconnect:
+                    self._connect(agent)
+            with self._lock:
+                if any(agent.sock is not None for agent in self.agents):
+                    self._no_agent_since = None
+                elif self._no_agent_since is None:
+                    self._no_agent_since = now
+                stale = []
+                if self._no_agent_since is not None and now - self._no_agent_since > NO_AGENT_TIMEOUT:
+                    stale = list(self._pending)
+                    self._pending.clear()
+            for task in stale:
+                task.future.set_result(failed_results(task.entities, "No agent reachable"))
+
+    def close(self):
+        """
+        Disconnects from all agents; tasks not answered yet fail.
+        """
+        with self._lock:
+            self._closed = True
+            stale = list(self._pending)
+            self._pending.clear()
+            connections = [(agent, agent.sock) for agent in self.agents if agent.sock is not None]
+        self._stopped.set()
+        metrics.remove_collector(self.collect_metrics)
+        for agent, sock in connections:
+            self._lost(agent, sock, "closed")
+        for task in stale:
+            task.future.set_result(failed_results(task.entities, "Coordinator closed"))
+
+
+class AgentServer(socketserver.ThreadingTCPServer):
+    """
+    Serves plugin tasks of coordinators through a PluginEngine of this host's plugins.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, engine, token=None, slots=DEFAULT_AGENT_SLOTS):
+        self.engine = engine
+        self.token = token
+        self.slots = slots
+        super().__init__(address, AgentHandler)
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    """
+    One coordinator connection: hello, then run messages until it disconnects.
+    """
+
+    def setup(self):
+        super().setup()
+        self.send_lock = threading.Lock()
+        self.closed = threading.Event()
+
+    def send(self, message):
+        try:
+            with self.send_lock:
+                self.wfile.write(encode_message(message))
+                self.wfile.flush()
+        except (OSError, ValueError):
+            # The coordinator went away; it sends the tasks elsewhere
+            self.closed.set()
+
+    def handle(self):
+        server = self.server
+        peer = f"{self.client_address[0]}:{self.client_address[1]}"
+        try:
+            hello = json.loads(self.rfile.readline() or b'{}')
+        except ValueError:
+            return
+        if hello.get('op') != 'hello':
+            return
+        if server.token and not hmac.compare_digest(str(hello.get('token') or ''), server.token):
+            logging.warning(f"Refused coordinator {peer}: invalid token")
+            self.send({'op': 'hello', 'error': 'invalid token'})
+            return
+        missing = [name for name in hello.get('plugins') or [] if name not in server.engine.plugins]
+        self.send({'op': 'hello', 'missing': missing, 'slots': server.slots})
+        if missing:
+            return
+        logging.info(f"Coordinator {peer} connected")
+        threading.Thread(target=self.beat, name=f"heartbeat-{peer}", daemon=True).start()
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                if message.get('op') == 'run':
+                    self.run_task(message)
+        except (OSError, ValueError) as e:
+            logging.debug(f"Connection of coordinator {peer} failed: {e}")
+        finally:
+            self.closed.set()
+            logging.info(f"Coordinator {peer} disconnected")
+
+    def beat(self):
+        while not self.closed.wait(HEARTBEAT_INTERVAL):
+            self.send({'op': 'heartbeat'})
+
+    def run_task(self, message):
+        engine = self.server.engine
+        entities = message.get('entities') or []
+        plugin_name = message.get('plugin')
+        if plugin_name not in engine.plugins or not entities:
+            self.send({'op': 'result', 'id': message.get('id'),
+                       'results': failed_results(entities, f"Plugin {plugin_name} is not installed on this agent")})
+            return
+        futures = [engine.submit(plugin_name, entity, message.get('flag') or "") for entity in entities]
+        # The coordinator batched the entities already
+        engine.flush_batches()
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            results = {}
+            for entity, future in zip(entities, futures):
+                try:
+                    results[entity] = future.result()
+                except Exception as e:
+                    results[entity] = {'success': False, 'result': str(e)}
+            self.send({'op': 'result', 'id': message.get('id'), 'results': results})
+
+        for future in futures:
+            future.add_done_callback(done)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs plugin tasks for coordinators started with --agents.")
+    parser.add_argument('--listen', default=f'127.0.0.1:{DEFAULT_AGENT_PORT}', metavar='HOST:PORT',
+                        help=f'Address to accept coordinators on (default: 127.0.0.1:{DEFAULT_AGENT_PORT})')
+    parser.add_argument('--token', default=os.environ.get('MIA_AGENT_TOKEN'),
+                        help='Shared secret coordinators must present (default: $MIA_AGENT_TOKEN)')
+    parser.add_argument('--slots', type=int, default=DEFAULT_AGENT_SLOTS,
+                        help=f'Tasks accepted at a time from each coordinator (default: {DEFAULT_AGENT_SLOTS})')
+    parser.add_argument('--max-workers', type=int, default=MAX_WORKERS,
+                        help=f'Size of the plugin thread pool (default: {MAX_WORKERS})')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT,
+                        help=f'Maximum number of plugin runs in flight (default: {MAX_IN_FLIGHT})')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='Log debug output to stderr')
+    args = parser.parse_args(argv)
+    configure_logging(args.verbose, sys.stderr)
+    try:
+        address = parse_address(args.listen)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # No memo: an agent outlives runs, and the coordinators keep memo and result cache
+    engine = PluginEngine(load_plugins('plugins'), ResultMemo(0), None, args.max_workers, args.max_in_flight)
+    try:
+        server = AgentServer(address, engine, args.token, args.slots)
+    except OSError as e:
+        engine.shutdown(wait=False)
+        parser.error(f"cannot listen on {args.listen}: {e}")
+    host, port = server.server_address[:2]
+    if not args.token and host not in ('127.0.0.1', '::1', 'localhost'):
+        logging.warning("Listening without --token: anyone who can connect can run the plugins on this host")
+    print(f"Agent listening on {host}:{port} with plugins: {', '.join(engine.plugins)}", file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.shutdown(wait=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+CACHE_MODES = {
+    'use': "Use cache",
+    'refresh': "Refresh stale only",
+    'bypass': "Bypass cache",
+}
+
+_TTL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_ttl(value):
+    """
+    Converts a TTL from a plugin YAML into seconds.
+    Accepts plain numbers (seconds) or strings like '30m', '12h', '7d'.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return max(0, int(value))
+    match = re.fullmatch(r'\s*(\d+)\s*([smhdw]?)\s*', str(value))
+    if not match:
+        raise ValueError(f"Invalid cache_ttl: {value}")
+    return int(match.group(1)) * _TTL_UNITS[match.group(2) or 's']
+
+
+class ResultCache:
+    """
+    Persistent SQLite store of plugin results shared between runs.
+
+    Modes:
+    - 'use': return any cached result, regardless of its age.
+    - 'refresh': return results that are still within the plugin's TTL, rerun expired ones.
+    - 'bypass': never read from the cache, but still store fresh results.
+
+    Writes are queued and committed in batches. When the live database size exceeds
+    max_size_mb, the oldest entries are evicted.
+    """
+
+    def __init__(self, path, mode='refresh', batch_size=200, max_size_mb=512):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.batch_size = batch_size
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self._pending = []
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            ' plugin TEXT NOT NULL,'
+            ' entity TEXT NOT NULL,'
+            ' command_flag TEXT NOT NULL,'
+            ' result TEXT NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' expires_at REAL NOT NULL,'
+            ' PRIMARY KEY (plugin, entity, command_flag))'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_results_entity ON results (entity)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_results_created ON results (created_at)')
+        self._conn.commit()
+
+    def get(self, plugin_name, entity, command_flag):
+        if self.mode == 'bypass':
+            return None
+        with self._lock:
+            for pending in reversed(self._pending):
+                if pending[:3] == (plugin_name, entity, command_flag):
+                    return json.loads(pending[3])
+            row = self._conn.execute(
+                'SELECT result, expires_at FROM results WHERE plugin = ? AND entity = ? AND command_flag = ?',
+                (plugin_name, entity, command_flag)
+            ).fetchone()
+        if row is None:
+            return None
+        result, expires_at = row
+        if self.mode == 'refresh' and expires_at < time.time():
+            return None
+        return json.loads(result)
+
+    def put(self, plugin_name, entity, command_flag, result, ttl):
+        if ttl <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            self._pending.append((plugin_name, entity, command_flag, json.dumps(result), now, now + ttl))
+            if len(self._pending) >= self.batch_size:
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._pending:
+            return
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO results (plugin, entity, command_flag, result, created_at, expires_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                self._pending
+            )
+        logging.debug(f"Result cache: committed {len(self._pending)} entries")
+        self._pending = []
+        self._evict_locked()
+
+    def _evict_locked(self):
+        page_size = self._conn.execute('PRAGMA page_size').fetchone()[0]
+        while True:
+            page_count = self._conn.execute('PRAGMA page_count').fetchone()[0]
+            free_pages = self._conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if (page_count - free_pages) * page_size <= self.max_size_bytes:
+                return
+            total = self._conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            if total == 0:
+                return
+            # Drop the oldest tenth of the cache per pass
+            with self._conn:
+                self._conn.execute(
+                    'DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY created_at LIMIT ?)',
+                    (max(1, total // 10),)
+                )
+            logging.debug(f"Result cache: evicted {max(1, total // 10)} old entries")
+
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            self._conn.close()
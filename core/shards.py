@@ -0,0 +1,313 @@
+"""
+Sharded processing of large input files on several CPU cores.
+
+A file is split at record boundaries into byte ranges (shards), which a pool of processes
+runs through their own CsvProcessor and PluginEngine. Every shard writes a part file; the
+parts are appended to the output in input order, so the output is the same as that of a
+single-process run. Memo, concurrency caps and adaptive rate control are per process; the
+persistent result cache is shared through its SQLite file.
+"""
+import csv
+import io
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from multiprocessing.util import Finalize
+
+from core.metrics import LOG_FORMAT, metrics
+from core.pipeline import READ_BUFFER_SIZE, CsvProcessor, create_engine, find_max_columns, open_csv
+from core.result_cache import ResultCache
+
+# Files below this size are processed in one piece; starting processes costs more than it saves
+SHARD_MIN_BYTES = 32 * 1024 * 1024
+
+# Chunk size of the scan for record boundaries
+SCAN_CHUNK_BYTES = 4 * 1024 * 1024
+
+# Shard processes publish their progress every this many rows; the parent polls it this often
+PROGRESS_ROW_BATCH = 500
+PROGRESS_INTERVAL = 0.5
+
+
+def record_ends(path, offsets):
+    """
+    For each offset (ascending), the position just after the first record end at or after
+    it: a newline outside a quoted field, which is told by the number of quotes before it
+    being even. The file size where no record end follows.
+    """
+    ends = []
+    pending = list(offsets)
+    quotes = 0  # Quote characters before the current chunk
+    position = 0
+    with open(path, 'rb') as f:
+        while pending:
+            chunk = f.read(SCAN_CHUNK_BYTES)
+            if not chunk:
+                break
+            while pending:
+                start = max(pending[0] - position, 0)
+                if start >= len(chunk):
+                    break
+                parity = quotes + chunk.count(b'"', 0, start)
+                newline = chunk.find(b'\n', start)
+                while newline != -1:
+                    parity += chunk.count(b'"', start, newline)
+                    if parity % 2 == 0:
+                        break
+                    start = newline
+                    newline = chunk.find(b'\n', newline + 1)
+                if newline == -1:
+                    break  # Look on in the next chunk
+                ends.append(position + newline + 1)
+                pending.pop(0)
+            quotes += chunk.count(b'"')
+            position += len(chunk)
+    size = os.path.getsize(path)
+    return ends + [size] * len(pending)
+
+
+def shard_ranges(path, shards):
+    """
+    Returns (header end, [(start, end)]): byte ranges of about equal size covering all
+    records after the header row.
+    """
+    size = os.path.getsize(path)
+    ends = record_ends(path, [0] + [size * index // shards for index in range(1, shards)])
+    header_end = ends[0]
+    bounds = [header_end] + [max(end, header_end) for end in ends[1:]] + [size]
+    return header_end, [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Raw reader of length bytes of a file from its current position.
+    """
+
+    def __init__(self, raw, length):
+        self.raw = raw
+        self.remaining = length
+        self.consumed = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        count = self.raw.readinto(memoryview(buffer)[:size])
+        self.remaining -= count
+        self.consumed += count
+        return count
+
+
+# State of a shard process, set up once by _init_process
+_process = {}
+
+
+def _init_process(settings, progress, cancelled):
+    # Started afresh, so without the parent's logging setup
+    logging.basicConfig(level=settings['log_level'], format=LOG_FORMAT)
+    logging.getLogger().setLevel(settings['log_level'])
+    cache = None
+    if settings['cache_file'] is not None:
+        cache = ResultCache(settings['cache_file'], settings['cache_mode'])
+    engine = create_engine(settings['plugins'], cache, settings['max_workers'], settings['max_in_flight'])
+    _process.update(settings, engine=engine, progress=progress)
+
+    def cancel():
+        cancelled.wait()
+        engine.cancel()
+
+    # The running shard stops reading and its pending plugin runs resolve as cancelled
+    threading.Thread(target=cancel, name='shard-cancel', daemon=True).start()
+
+    def shutdown():
+        engine.shutdown()
+        if cache is not None:
+            cache.close()
+
+    # Pool processes end without running atexit handlers, but with multiprocessing's finalizers
+    Finalize(None, shutdown, exitpriority=10)
+
+
+def run_shard(path, start, end, slot, part_path, max_input_cols):
+    """
+    Processes the records in [start, end) of path into part_path, in a shard process.
+    Returns (rows, counters, histograms) of the shard.
+    """
+    progress = _process['progress']
+    metrics.reset()
+    rows = [0]
+    with open(path, 'rb', buffering=0) as raw:
+        raw.seek(start)
+        reader = RangeReader(raw, end - start)
+
+        def on_row(row, current_line):
+            rows[0] += 1
+            if rows[0] % PROGRESS_ROW_BATCH == 0:
+                progress[2 * slot], progress[2 * slot + 1] = reader.consumed, rows[0]
+
+        processor = CsvProcessor(_process['plugins'], _process['command_flags'], _process['parser_set'],
+                                 _process['engine'], on_row=on_row, layout=_process['layout'],
+                                 classifier=_process['classifier'])
+        processor.max_input_cols = max_input_cols
+        infile = io.TextIOWrapper(io.BufferedReader(reader, READ_BUFFER_SIZE), newline='')
+        with open(part_path, 'w', newline='') as outfile:
+            processor.process_csv(csv.reader(infile), csv.writer(outfile), write_headers=False, header=False)
+    if _process['engine'].cache is not None:
+        _process['engine'].cache.flush()
+    progress[2 * slot], progress[2 * slot + 1] = end - start, rows[0]
+    counters, histograms, _ = metrics.snapshot()
+    return rows[0], counters, histograms
+
+
+class ShardPool:
+    """
+    The processes running the shards of a JobScheduler run. Each process sets up its own
+    engine for the run's plugins once. slots is the most shards the run can have; each
+    shard reports bytes and rows done through its slot of a shared array. cancel() cancels
+    the engines of all processes.
+    """
+
+    def __init__(self, processes, slots, plugins, command_flags, parser_set, engine, layout, classifier):
+        cache = engine.cache
+        settings = {
+            'plugins': plugins, 'command_flags': command_flags, 'parser_set': parser_set,
+            'layout': layout, 'classifier': classifier,
+            'cache_file': cache.path if cache is not None else None,
+            'cache_mode': cache.mode if cache is not None else None,
+            'max_workers': engine.max_workers, 'max_in_flight': engine.max_in_flight,
+            'log_level': logging.getLogger().level,
+        }
+        # Not forked from this process: its plugin, sink and engine threads may hold locks
+        # that would stay locked in the child. A fork server starts from a clean process.
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        self.processes = processes
+        self.progress = context.Array('q', 2 * slots, lock=False)
+        self.cancelled = context.Event()
+        self.part_dir = tempfile.mkdtemp(prefix='mia-shards-')
+        self._next_slot = 0
+        self._lock = threading.Lock()
+        self._executor = ProcessPoolExecutor(processes, mp_context=context, initializer=_init_process,
+                                             initargs=(settings, self.progress, self.cancelled))
+
+    def take_slots(self, count):
+        with self._lock:
+            first = self._next_slot
+            if first + count > len(self.progress) // 2:
+                raise RuntimeError("No progress slots left for more shards")
+            self._next_slot = first + count
+        return range(first, first + count)
+
+    def submit(self, path, start, end, slot, max_input_cols):
+        part_path = os.path.join(self.part_dir, f"{slot}.csv")
+        return part_path, self._executor.submit(run_shard, path, start, end, slot, part_path, max_input_cols)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(self.part_dir, ignore_errors=True)
+
+
+class OutputFile:
+    """
+    csv.writer lookalike for an output file that parts can also be appended to.
+    """
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.writer = csv.writer(outfile)
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def append_file(self, path):
+        with open(path, newline='') as part:
+            shutil.copyfileobj(part, self.outfile)
+
+
+class ShardedFile:
+    """
+    Processes one input file in shards on a ShardPool, in place of a CsvProcessor. The header
+    is written by processor, which is only used for that. The writer needs an append_file(path)
+    method besides writerow (a SinkChannel or an OutputFile).
+
+    Callbacks, from the thread calling process_file:
+    - on_row(row, current_line) for every row, read back from the parts (only if given)
+    - on_progress(rows) with the rows written so far by all shards
+    """
+
+    def __init__(self, pool, processor, on_row=None, on_progress=None):
+        self.pool = pool
+        self.processor = processor
+        self.on_row = on_row
+        self.on_progress = on_progress
+        self.header_end = None
+        self.slots = ()
+
+    def read_position(self):
+        """
+        Bytes of the file processed by all shards together, or None before they start.
+        """
+        if self.header_end is None:
+            return None
+        return self.header_end + sum(self.pool.progress[2 * slot] for slot in self.slots)
+
+    def rows_done(self):
+        return sum(self.pool.progress[2 * slot + 1] for slot in self.slots)
+
+    def process_file(self, file_name, writer, write_headers=True, flush=None):
+        processor = self.processor
+        header_end, ranges = shard_ranges(file_name, self.pool.processes)
+        with open_csv(file_name) as infile:
+            headers = next(csv.reader(infile), None)
+        if processor.layout == 'scan':
+            processor.max_input_cols = find_max_columns(file_name)
+        else:
+            processor.max_input_cols = len(headers) if headers else 0
+        if write_headers:
+            processor.update_headers(headers, writer)
+
+        logging.debug(f"Processing {file_name} in {len(ranges)} shards")
+        self.slots = self.pool.take_slots(len(ranges))
+        self.header_end = header_end
+        shards = [self.pool.submit(file_name, start, end, slot, processor.max_input_cols)
+                  for slot, (start, end) in zip(self.slots, ranges)]
+        current_line = 1 if headers else 0
+        try:
+            # Parts are appended in order as soon as all earlier ones are done
+            for part_path, future in shards:
+                while not processor.engine.cancelled:
+                    try:
+                        rows, counters, histograms = future.result(timeout=PROGRESS_INTERVAL)
+                        break
+                    except TimeoutError:
+                        if self.on_progress is not None:
+                            self.on_progress(self.rows_done())
+                if processor.engine.cancelled:
+                    # Running shards drain their cancelled engines, shards not started are cancelled below
+                    logging.warning(f"Analysis cancelled, {file_name} keeps the shards done so far")
+                    self.pool.cancel()
+                    break
+                metrics.merge(counters, histograms)
+                writer.append_file(part_path)
+                if self.on_row is not None:
+                    with open(part_path, newline='') as part:
+                        for row in csv.reader(part):
+                            self.on_row(row, current_line)
+                            current_line += 1
+                if flush is not None:
+                    flush()
+                if self.on_progress is not None:
+                    self.on_progress(self.rows_done())
+        finally:
+            for _, future in shards:
+                future.cancel()
@@ -0,0 +1,307 @@
+import asyncio
+import ipaddress
+import logging
+import random
+import re
+import threading
+
+from core.metrics import metrics
+from core.prefix_index import PrefixIndex
+from core.ratelimit import TokenBucket
+
+IANA = 'whois.iana.org'
+ARIN = 'whois.arin.net'
+RIPE = 'whois.ripe.net'
+APNIC = 'whois.apnic.net'
+LACNIC = 'whois.lacnic.net'
+AFRINIC = 'whois.afrinic.net'
+
+# First octets of the IANA IPv4 address space registry, grouped by the RIR whose whois
+# server is authoritative. Legacy space administered by an RIR is listed under that RIR.
+# Anything missing goes to IANA, and referrals correct outdated entries.
+_IPV4_SLASH8 = {
+    APNIC: '1 14 27 36 39 42 43 49 58-61 101 103 106 110-126 133 150 153 163 171 175 180 182 183 '
+           '202 203 210 211 218-223',
+    RIPE: '2 5 25 31 37 46 51 53 57 62 77-95 109 141 145 151 176 178 185 188 193-195 212 213 217',
+    ARIN: '3 4 6-9 11-13 15-24 26 28-30 32-35 38 40 44 45 47 48 50 52 54-56 63-76 96-100 104 107 108 '
+          '128-132 134-140 142-144 146-149 152 155-162 164-170 172-174 184 192 198 199 204-209 214-216',
+    LACNIC: '177 179 181 186 187 189-191 200 201',
+    AFRINIC: '41 102 105 154 196 197',
+}
+
+_IPV6_ALLOCATIONS = {
+    '2001:200::/23': APNIC, '2001:400::/23': ARIN, '2001:600::/23': RIPE, '2001:800::/22': RIPE,
+    '2001:c00::/23': APNIC, '2001:1200::/23': LACNIC, '2001:1400::/22': RIPE, '2001:4200::/23': AFRINIC,
+    '2001:4400::/23': APNIC, '2001:4800::/23': ARIN, '2001:4a00::/23': RIPE, '2001:4c00::/23': RIPE,
+    '2001:5000::/20': RIPE, '2001:8000::/19': APNIC, '2001:a000::/20': APNIC, '2001:b000::/20': APNIC,
+    '2003::/18': RIPE, '2400::/12': APNIC, '2600::/12': ARIN, '2610::/23': ARIN, '2620::/23': ARIN,
+    '2800::/12': LACNIC, '2a00::/12': RIPE, '2c00::/12': AFRINIC,
+}
+
+# Refusals for querying too fast: RIPE/APNIC/AFRINIC '%ERROR:201: access denied', LACNIC's
+# 'Query rate limit exceeded', and comment lines about a query limit. Only whole refusal lines
+# count: netnames like ERX-NETBLOCK or the RIPE placeholder are ordinary answers.
+_THROTTLE_PATTERN = re.compile(
+    r'^\s*(?:%\s*ERROR:201\b'
+    r'|[%#].*\b(?:access denied|(?:query|rate|access) limit|limit exceeded|too many (?:queries|requests))'
+    r'|query rate limit exceeded)',
+    re.IGNORECASE | re.MULTILINE,
+)
+
+_REFERRAL_PATTERNS = (
+    re.compile(r'^\s*ReferralServer:\s*(\S+)', re.IGNORECASE | re.MULTILINE),
+    re.compile(r'^\s*refer:\s*([^\s]+)', re.IGNORECASE | re.MULTILINE),
+    re.compile(r'^\s*whois:\s*([^\s]+)', re.IGNORECASE | re.MULTILINE),
+)
+
+# RIPE and APNIC answer for the whole space but only with a placeholder outside their own
+_FOREIGN_BLOCK_MARKERS = ('NON-RIPE-NCC-MANAGED-ADDRESS-BLOCK', 'IANA-BLK', 'IANA-NETBLOCK', 'ERX-NETBLOCK')
+
+
+def _is_foreign_block(response):
+    return any(marker in response for marker in _FOREIGN_BLOCK_MARKERS)
+
+
+# Address block lines: RIPE/APNIC/AFRINIC/LACNIC inetnum and inet6num, ARIN NetRange and CIDR
+_BLOCK_PATTERN = re.compile(r'^\s*(inetnum|inet6num|NetRange|CIDR)\s*:\s*(\S.*?)\s*$', re.IGNORECASE | re.MULTILINE)
+
+
+def _parse_network(text):
+    # LACNIC abbreviates networks, e.g. 200.3.0/16
+    address, _, prefixlen = text.partition('/')
+    if ':' not in address and address.count('.') < 3:
+        address += '.0' * (3 - address.count('.'))
+    return ipaddress.ip_network(f'{address}/{prefixlen}', strict=False)
+
+
+def parse_blocks(response):
+    """
+    Extracts the address blocks described by a whois response.
+    Returns a list of (label, [networks]) with one entry per inetnum/NetRange/CIDR line.
+    """
+    blocks = []
+    for match in _BLOCK_PATTERN.finditer(response):
+        value = match.group(2)
+        try:
+            if ' - ' in value or value.count('-') == 1 and '/' not in value:
+                first, last = (ipaddress.ip_address(part.strip()) for part in value.split('-'))
+                networks = list(ipaddress.summarize_address_range(first, last))
+            else:
+                networks = [_parse_network(part.strip()) for part in value.split(',') if part.strip()]
+        except ValueError:
+            continue
+        if networks:
+            blocks.append((value, networks))
+    return blocks
+
+
+def find_block(response, ip):
+    """
+    Returns (label, [networks]) of the most specific block in the response that contains ip, or None.
+    """
+    address = ipaddress.ip_address(ip)
+    best = None
+    best_size = None
+    for label, networks in parse_blocks(response):
+        if not any(address in network for network in networks if network.version == address.version):
+            continue
+        size = sum(network.num_addresses for network in networks)
+        if best is None or size < best_size:
+            best, best_size = (label, networks), size
+    return best
+
+
+class NetblockCache:
+    """
+    Remembers whois answers per address block, so every later address inside a known
+    block is answered by longest-prefix match without a network query.
+
+    Blocks shorter than min_prefix (e.g. the 0.0.0.0/0 placeholders some registries return
+    for foreign space) are not stored. Answers are kept separately per query flags.
+    """
+
+    def __init__(self, min_prefix_v4=8, min_prefix_v6=12):
+        self.min_prefix = {4: min_prefix_v4, 6: min_prefix_v6}
+        self.hits = 0
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, ip, query_flags=None):
+        """
+        Returns (block_label, value) for a cached block containing ip, or None.
+        """
+        with self._lock:
+            index = self._indexes.get(query_flags or '')
+            match = index.get(ip) if index is not None else None
+            if match is not None:
+                self.hits += 1
+            return match
+
+    def store(self, ip, response, value, query_flags=None):
+        """
+        Stores value for the most specific block of the response containing ip.
+        Returns the block label, or None if the response holds no usable block.
+        """
+        block = find_block(response, ip)
+        if block is None:
+            return None
+        label, networks = block
+        if any(network.prefixlen < self.min_prefix[network.version] for network in networks):
+            return None
+        with self._lock:
+            index = self._indexes.setdefault(query_flags or '', PrefixIndex())
+            for network in networks:
+                index.insert(network, (label, value))
+        return label
+
+
+def build_routing_index():
+    """
+    Builds the IP -> authoritative whois server index from the built-in allocation tables.
+    """
+    index = PrefixIndex()
+    for server, octets in _IPV4_SLASH8.items():
+        for part in octets.split():
+            first, _, last = part.partition('-')
+            for octet in range(int(first), int(last or first) + 1):
+                index.insert(f'{octet}.0.0.0/8', server)
+    for network, server in _IPV6_ALLOCATIONS.items():
+        index.insert(network, server)
+    return index
+
+
+class WhoisError(Exception):
+    pass
+
+
+class WhoisThrottled(WhoisError):
+    pass
+
+
+class WhoisClient:
+    """
+    Asynchronous port-43 whois client.
+
+    Each IP is sent to the RIR responsible for it according to the routing index, and
+    referrals in the answer (ReferralServer:, refer:, whois:) are followed, except to
+    rwhois:// servers, which speak another protocol. A referral naming a port is queried
+    on that port (the server is then 'host:port'). Every server
+    has its own token bucket; when a server throttles us, only that server's bucket is
+    paused and retries back off with asyncio.sleep, so queries to other servers go on.
+    """
+
+    def __init__(self, rate=1.0, burst=3, timeout=10.0, max_retries=5, initial_delay=1.0,
+                 max_referrals=3, port=43, routing_index=None):
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.initial_delay = initial_delay
+        self.max_referrals = max_referrals
+        self.port = port
+        self.routing_index = routing_index if routing_index is not None else build_routing_index()
+        self._buckets = {}
+
+    def server_for(self, ip):
+        return self.routing_index.get(ip, IANA)
+
+    def bucket(self, server):
+        if server not in self._buckets:
+            self._buckets[server] = TokenBucket(self.rate, self.burst)
+        return self._buckets[server]
+
+    async def lookup(self, ip, query_flags=None):
+        """
+        Returns (server, response) from the most specific server that answered for ip.
+        Raises WhoisError if no server gave a usable answer.
+        """
+        ip = str(ipaddress.ip_address(ip))
+        server = self.server_for(ip)
+        visited = [server]
+        response = await self.query(server, self._query_text(server, ip, query_flags))
+        for _ in range(self.max_referrals):
+            referral = self._referral(response, server)
+            if referral is None or referral in visited:
+                break
+            logging.debug(f"whois {ip}: {server} refers to {referral}")
+            visited.append(referral)
+            try:
+                referred = await self.query(referral, self._query_text(referral, ip, query_flags))
+            except WhoisError as e:
+                # The answer of the referring server is still better than none
+                logging.debug(f"whois {ip}: referral to {referral} failed ({e}), keeping the answer of {server}")
+                break
+            server, response = referral, referred
+        return server, response
+
+    @staticmethod
+    def _query_text(server, ip, query_flags):
+        # ARIN needs the 'n' type keyword to return network records only
+        query = f'n {ip}' if server == ARIN and not query_flags else ip
+        return f'{query_flags} {query}' if query_flags else query
+
+    def _referral(self, response, server):
+        for pattern in _REFERRAL_PATTERNS:
+            match = pattern.search(response)
+            if match:
+                referral = self._referral_server(match.group(1))
+                if referral and referral != server:
+                    return referral
+        if server != IANA and _is_foreign_block(response):
+            return IANA
+        return None
+
+    def _referral_server(self, value):
+        """
+        The server of a referral ('host' or 'host:port'), or None for one we cannot follow.
+        """
+        scheme, separator, rest = value.strip().lower().partition('://')
+        if not separator:
+            scheme, rest = 'whois', value.strip().lower()
+        if scheme != 'whois':
+            return None
+        host, _, port = rest.strip('/').partition(':')
+        if port and not port.isdigit():
+            return None
+        return f'{host}:{port}' if port and int(port) != self.port else host
+
+    def _address(self, server):
+        host, _, port = server.partition(':')
+        return host, int(port) if port else self.port
+
+    async def query(self, server, text):
+        """
+        Sends one query to a server, retrying with exponential backoff on connection
+        errors and throttling.
+        """
+        bucket = self.bucket(server)
+        delay = self.initial_delay
+        for attempt in range(1, self.max_retries + 1):
+            await bucket.acquire()
+            try:
+                response = await asyncio.wait_for(self._exchange(server, text), self.timeout)
+                if not _is_foreign_block(response) and _THROTTLE_PATTERN.search(response):
+                    raise WhoisThrottled(f"{server} throttled the query")
+                return response
+            except (OSError, asyncio.TimeoutError, WhoisThrottled) as e:
+                if attempt == self.max_retries:
+                    error = WhoisThrottled if isinstance(e, WhoisThrottled) else WhoisError
+                    raise error(f"{server}: {e or 'timed out'} after {attempt} attempts")
+                # Pause the whole server, not just this query, and jitter to avoid retry waves
+                wait = delay * random.uniform(1.0, 1.5)
+                logging.debug(f"whois {server} attempt {attempt} failed ({e!r}), retrying in {wait:.1f}s")
+                if isinstance(e, WhoisThrottled):
+                    metrics.inc('mia_plugin_throttled_total', plugin='whois', server=server)
+                    bucket.pause(wait)
+                await asyncio.sleep(wait)
+                delay *= 2
+
+    async def _exchange(self, server, text):
+        reader, writer = await asyncio.open_connection(*self._address(server))
+        try:
+            writer.write(text.encode('utf-8') + b'\r\n')
+            await writer.drain()
+            data = await reader.read()
+        finally:
+            writer.close()
+        return data.decode('utf-8', errors='replace')
@@ -1,22 +1,25 @@
-import csv
-import re
-import requests
+import argparse
 import importlib
-import glob
 import os
 import logging
+import sqlite3
 import sys
-import yaml
-from PyQt5.QtWidgets import (
-    QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton,
-    QFileDialog, QMessageBox, QCheckBox, QLineEdit, QStatusBar, QComboBox, QTableWidget, QTableWidgetItem
-)
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, pyqtSlot
+import threading
+from collections import deque
 
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+if __name__ == "__main__" and '--headless' in sys.argv[1:]:
+    # Headless runs never import PyQt5. Shard processes import the main module again, so
+    # that is core.cli from here on.
+    from core import cli
+    sys.modules['__main__'] = cli
+    sys.exit(cli.main([arg for arg in sys.argv[1:] if arg != '--headless']))
 
 
 def import_required_packages():
+    """
+    Exits with install hints if a package the GUI needs is missing. Runs before the
+    imports below, which would otherwise fail with a traceback.
+    """
     required_packages = [
         'PyQt5', 'requests', 'yaml', 're'
     ]
@@ -34,46 +37,33 @@ def import_required_packages():
         print("\nTo install missing packages, use: pip install " + ' '.join(missing_packages))
         print("Note: On some Linux distributions, use 'pip3' instead of 'pip'.")
         print("On Archlinux, consider using 'pipx', installable via 'pacman' or 'pamac'.")
-        sys.exit()
-
-import_required_packages()
+        sys.exit(1)
 
-def load_plugins(plugin_folder='plugins'):
-    plugins = {}
-    plugin_dir = os.path.join(os.path.dirname(__file__), plugin_folder)
-
-    for py_file in glob.glob(os.path.join(plugin_dir, '*.py')):
-        plugin_base_name = os.path.basename(py_file)[:-3]
-        plugin_path = os.path.relpath(py_file, os.path.dirname(__file__))
-        plugin_name = plugin_path.replace(os.sep, '.')[:-3]
-
-        # Read exec_order from the corresponding YAML file
-        yaml_file = os.path.join(plugin_dir, plugin_base_name + '.yaml')
-        if os.path.exists(yaml_file):
-            with open(yaml_file, 'r') as file:
-                plugin_config = yaml.safe_load(file)
-                exec_order = plugin_config.get('exec_order', 0)
-        else:
-            exec_order = 0
 
-        plugins[plugin_base_name] = {'type': 'python', 'name': plugin_name, 'exec_order': exec_order}
+import_required_packages()
 
-    # Sort plugins based on exec_order
-    sorted_plugins = dict(sorted(plugins.items(), key=lambda item: item[1]['exec_order']))
-    return sorted_plugins
+import requests
+from PyQt5.QtWidgets import (
+    QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton,
+    QFileDialog, QMessageBox, QCheckBox, QLineEdit, QStatusBar, QComboBox, QTableView
+)
+from PyQt5.QtCore import Qt, QThread, QTimer, QAbstractTableModel, QModelIndex, pyqtSignal, pyqtSlot
+from core.classify import ClassificationError, load_classifier
+from core.dependencies import DependencyError, DependencyPlan
+from core.cli import add_engine_arguments, agent_addresses, start_metrics_exporter, start_remote_workers
+from core.jobs import DEFAULT_OUTPUT_MODE, MAX_PARALLEL_FILES, OUTPUT_MODES, JobScheduler
+from core.journal import default_journal_path
+from core.metrics import configure_logging, metrics
+from core.parsers import DEFAULT_PARSER, ParserSet, load_parsers
+from core.pipeline import (
+    COLUMN_LAYOUTS, DEFAULT_CACHE_FILE, DEFAULT_COLUMN_LAYOUT, MAX_IN_FLIGHT, MAX_WORKERS, create_engine
+)
+from core.plugins import load_plugins, plugin_config
+from core.records import open_record_sink
+from core.result_cache import CACHE_MODES, ResultCache
 
-def execute_plugin(plugin, entity, command_flag=None):
-    try:
-        if plugin['type'] == 'python':
-            plugin_module = importlib.import_module(plugin['name'])
-            result = plugin_module.run(entity, command_flag)
-            if isinstance(result, dict) and 'success' in result and 'result' in result:
-                return result
-            else:
-                raise ValueError("Plugin returned data in an unexpected format")
-    except Exception as e:
-        logging.error(f"Error executing plugin {plugin['name']} for entity {entity}: {e}")
-        return {'success': False, 'result': str(e)}
+# Workers only queue rows and status; the window picks them up on a timer instead of one signal per row
+UI_REFRESH_MS = 100
 
 
 class IPFetcher(QThread):
@@ -87,107 +77,148 @@ class IPFetcher(QThread):
         except Exception as e:
             self.ip_fetched.emit(f"Error: {e}")
 
+class ResultTableModel(QAbstractTableModel):
+    """
+    Read-only model of the written result rows. Each row is stored as a single string
+    (cells joined with ROW_SEPARATOR), and the view only decodes the rows it displays.
+    """
+    ROW_SEPARATOR = '\x1f'
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+        self.column_count = 0
+        self.decoded_row = (-1, [])
+
+    @classmethod
+    def encode_row(cls, row):
+        return cls.ROW_SEPARATOR.join(cell.replace(cls.ROW_SEPARATOR, ' ') for cell in row)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.column_count
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        # The view asks for a row cell by cell, so keep the last decoded row around
+        if self.decoded_row[0] != index.row():
+            self.decoded_row = (index.row(), self.rows[index.row()].split(self.ROW_SEPARATOR))
+        cells = self.decoded_row[1]
+        return cells[index.column()] if index.column() < len(cells) else None
+
+    def append_rows(self, encoded_rows):
+        if not encoded_rows:
+            return
+        width = max(row.count(self.ROW_SEPARATOR) for row in encoded_rows) + 1
+        if width > self.column_count:
+            self.beginInsertColumns(QModelIndex(), self.column_count, width - 1)
+            self.column_count = width
+            self.endInsertColumns()
+        first = len(self.rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(encoded_rows) - 1)
+        self.rows.extend(encoded_rows)
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.rows = []
+        self.column_count = 0
+        self.decoded_row = (-1, [])
+        self.endResetModel()
+
+
 class CsvWorker(QThread):
-    update_status = pyqtSignal(str, str, int, int)
-    update_table_signal = pyqtSignal(list, int)  # list of data and row number
     finished = pyqtSignal()
     error_occurred = pyqtSignal(str)  # Signal for reporting errors
-    def __init__(self, input_file, plugins, output_file, command_flags, parser_config):
+    def __init__(self, input_files, plugins, output_file, command_flags, parser_set, engine=None,
+                 layout=DEFAULT_COLUMN_LAYOUT, output_mode=DEFAULT_OUTPUT_MODE, parallel_files=MAX_PARALLEL_FILES,
+                 journal_path=None, resume=False, classifier=None, shards=1, record_sink=None):
         super().__init__()
-        self.input_file = input_file
+        self.input_files = [input_files] if isinstance(input_files, str) else list(input_files)
         self.plugins = plugins
         self.output_file = output_file
         self.command_flags = command_flags
-        self.parser_regex = parser_config['regex']
-        self.parser_entity_type = parser_config['entity_type']
-    
+        # A standalone worker gets its own engine
+        self.owns_engine = engine is None
+        self.engine = engine if engine is not None else create_engine(plugins)
+        self.scheduler = JobScheduler(
+            plugins, command_flags, parser_set, self.engine, self.input_files, output_file,
+            output_mode, layout, parallel_files,
+            on_row=self.on_row_written, on_status=self.set_status, on_job_done=self.on_job_done,
+            classifier=classifier, shards=shards, record_sink=record_sink
+        )
+        self.record_sink = record_sink
+        self.journal_path = journal_path
+        self.resume = resume
+        # Filled by the job threads, drained by the window's refresh timer
+        self.pending_rows = deque()
+        self.last_status = None
+
     def run(self):
         try:
-            self.max_input_cols = self.find_max_columns(self.input_file)
-            with open(self.input_file, newline='') as infile, open(self.output_file, 'w', newline='') as outfile:
-                reader = csv.reader(infile)
-                writer = csv.writer(outfile)
-                self.process_csv(reader, writer)
-                self.finished.emit()
-                logging.debug("finished processing csv")
+            if self.journal_path is not None:
+                # Fingerprints the inputs, so it runs here rather than in the GUI thread
+                self.scheduler.open_journal(self.journal_path, self.resume)
+            self.scheduler.run()
+            if self.engine.cache is not None:
+                self.engine.cache.flush()
+            logging.debug("finished processing csv")
         except Exception as e:
             self.error_occurred.emit(str(e))
-
-
-    def process_csv(self, reader, writer):
-        headers = next(reader, None)  # Read the header row if it exists
-        self.update_headers(headers, writer)
-
-        for current_line, row in enumerate(reader, start=1 if headers else 0):
-            logging.debug(f"Processing line {current_line}: {row}")
-            new_row = self.process_row(row, current_line)
-            self.update_table_signal.emit(new_row, current_line - 1)
-            writer.writerow(new_row)
-
-    def find_max_columns(self, file_name):
-        max_cols = 0
-        with open(file_name, newline='') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                max_cols = max(max_cols, len(row))
-        return max_cols
-
-    def update_headers(self, headers, writer):
-        if headers:
-            headers += [''] * (self.max_input_cols - len(headers))  # Pad headers if needed
-            for plugin_name, command_flag in self.command_flags.items():
-                headers.append(f"{plugin_name} ({command_flag})")
-            writer.writerow(headers)
-
-    def process_row(self, row, current_line):
-        original_length = len(row)
-        row.extend([''] * (self.max_input_cols - original_length))  # Pad row to max columns
-        row.extend([''] * len(self.plugins))  # Extend row for plugin results
-
-        for cell_index, cell in enumerate(row[:original_length]):
-            matches = re.findall(self.parser_regex, cell)
-            for match in matches:
-                for plugin_index, (plugin_name, plugin) in enumerate(self.plugins.items()):
-                    result_index = self.max_input_cols + plugin_index
-                    self.update_status.emit(plugin_name, match, current_line, cell_index)
-                    plugin_result = execute_plugin(plugin, match, self.command_flags.get(plugin_name, ""))
-                    row[result_index] = self.format_plugin_result(plugin_result)
-
-        return row
-
-
-    
-    @staticmethod
-    def format_plugin_result(plugin_result):
-        if isinstance(plugin_result, dict) and 'success' in plugin_result and 'result' in plugin_result:
-            if plugin_result['success']:
-                return str(plugin_result['result'])
-            else:
-                return f"Error: {plugin_result['result']}"
-        return "Invalid format"
-
-    def process_entity(self, entity, current_line, cell_index):
-        results = []
-        for plugin_name, plugin in self.plugins.items():
-            self.update_status.emit(plugin_name, entity, current_line, cell_index)
-            plugin_result = execute_plugin(plugin, entity, self.command_flags.get(plugin_name, ""))
-            if isinstance(plugin_result, dict) and 'success' in plugin_result and 'result' in plugin_result:
-                if plugin_result['success']:
-                    results.append(plugin_result['result'])
-                else:
-                    self.error_occurred.emit(plugin_result['result'])
-            else:
-                self.error_occurred.emit("Plugin result format is incorrect")
-        return results
+        finally:
+            if self.owns_engine:
+                self.engine.shutdown()
+            if self.record_sink is not None:
+                self.record_sink.close()
+            # Also after a failure, so the window ends the run and enables Start again
+            self.finished.emit()
+
+    def on_row_written(self, job, row, current_line):
+        self.pending_rows.append(ResultTableModel.encode_row(row))
+
+    def on_job_done(self, job):
+        if job.state == 'failed':
+            self.error_occurred.emit(f"{os.path.basename(job.input_path)}: {job.error}")
+
+    def set_status(self, plugin_name, entity, current_line, cell_index):
+        self.last_status = (plugin_name, entity, current_line, cell_index)
+
+    def take_rows(self):
+        rows = []
+        while self.pending_rows:
+            rows.append(self.pending_rows.popleft())
+        return rows
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, cache_mode='refresh', cache_file=DEFAULT_CACHE_FILE, max_workers=MAX_WORKERS,
+                 layout=DEFAULT_COLUMN_LAYOUT, max_in_flight=MAX_IN_FLIGHT, parallel_files=MAX_PARALLEL_FILES,
+                 output_mode=DEFAULT_OUTPUT_MODE, resume=False, metrics_exporter=None, classifier=None, shards=1,
+                 records_path=None, agents=None, agent_token=None):
         super().__init__()
         self.setWindowTitle('Mass IP Analysis')
         self.setMinimumSize(500, 400)  # Allow the window to be resized
 
         self.selected_output_file = None
-        self.parsers = self.load_parsers('parser')
+        self.cache_file = cache_file
+        self.result_cache = None
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight
+        self.parallel_files = parallel_files
+        self.shards = shards
+        self.engine = None
+        # Publishes the metrics shown in the statistics panel to a file or HTTP port, if asked for
+        self.metrics_exporter = metrics_exporter
+        # Decides which plugins run on which entities; None for the built-in classes only
+        self.classifier = classifier
+        # SQLite or JSON Lines file every run also writes its results to as records, if any
+        self.records_path = records_path
+        # Remote agents running the plugins, connected per run
+        self.agents = agents or []
+        self.agent_token = agent_token
+        self.parsers = load_parsers('parser')
         self.plugins = load_plugins('plugins')  # Load plugins from the 'plugins' folder
 
         central_widget = QWidget()
@@ -216,6 +247,43 @@ class MainWindow(QMainWindow):
             plugin_layout.addWidget(command_flag_input)
             main_layout.addLayout(plugin_layout)
 
+        # Result cache selection
+        cache_layout = QHBoxLayout()
+        cache_layout.addWidget(QLabel("Result cache:"))
+        self.cache_selector = QComboBox()
+        for mode, label in CACHE_MODES.items():
+            self.cache_selector.addItem(label, mode)
+        self.cache_selector.setCurrentIndex(list(CACHE_MODES).index(cache_mode))
+        cache_layout.addWidget(self.cache_selector)
+        main_layout.addLayout(cache_layout)
+
+        # Result column layout selection
+        columns_layout = QHBoxLayout()
+        columns_layout.addWidget(QLabel("Result columns:"))
+        self.layout_selector = QComboBox()
+        for name, label in COLUMN_LAYOUTS.items():
+            self.layout_selector.addItem(label, name)
+        self.layout_selector.setCurrentIndex(list(COLUMN_LAYOUTS).index(layout))
+        columns_layout.addWidget(self.layout_selector)
+        main_layout.addLayout(columns_layout)
+
+        # Output of several input files
+        output_mode_layout = QHBoxLayout()
+        output_mode_layout.addWidget(QLabel("Output:"))
+        self.output_mode_selector = QComboBox()
+        for mode, label in OUTPUT_MODES.items():
+            self.output_mode_selector.addItem(label, mode)
+        self.output_mode_selector.setCurrentIndex(list(OUTPUT_MODES).index(output_mode))
+        output_mode_layout.addWidget(self.output_mode_selector)
+        main_layout.addLayout(output_mode_layout)
+
+        # Results are journaled next to the output file, an interrupted run can continue from there
+        self.resume_checkbox = QCheckBox("Resume interrupted run (only rerun missing results)")
+        self.resume_checkbox.setChecked(resume)
+        # Sharded runs (--shards) are not journaled
+        self.resume_checkbox.setEnabled(shards <= 1)
+        main_layout.addWidget(self.resume_checkbox)
+
         # File selection setup
         self.file_path_label = QLabel('No file selected for analysis')
         self.file_path_button = QPushButton('Select File for Analysis')
@@ -235,11 +303,19 @@ class MainWindow(QMainWindow):
         self.analysis_button.setEnabled(False)
         main_layout.addWidget(self.analysis_button)
 
+        # Stops reading and drops the remaining plugin runs; the rows read so far are still written
+        self.cancel_button = QPushButton('Cancel Analysis')
+        self.cancel_button.clicked.connect(self.cancel_analysis)
+        self.cancel_button.setEnabled(False)
+        main_layout.addWidget(self.cancel_button)
+
         status_widget = QWidget()
         status_layout = QVBoxLayout(status_widget)
 
         # Status labels
         self.status_label = QLabel("Ready")
+        self.memo_label = QLabel("Cache hits: 0, misses: 0")
+        self.progress_label = QLabel("")
         self.error_label = QLabel("")
         self.ip_status_label = QLabel("Fetching IP address...")
 
@@ -249,6 +325,8 @@ class MainWindow(QMainWindow):
 
         # Add labels to the status bar layout
         status_layout.addWidget(self.status_label)
+        status_layout.addWidget(self.memo_label)
+        status_layout.addWidget(self.progress_label)
         status_layout.addWidget(self.error_label)
         status_layout.addWidget(self.ip_status_label)
 
@@ -266,22 +344,30 @@ class MainWindow(QMainWindow):
         self.ip_fetcher.start()
 
         # Table setup
-        self.table_widget = QTableWidget()
-        main_layout.addWidget(self.table_widget)
-
-    def load_parsers(self, parser_folder):
-        parsers = {}
-        parser_dir = os.path.join(os.path.dirname(__file__), parser_folder)
-        for yaml_file in glob.glob(os.path.join(parser_dir, '*.yaml')):
-            with open(yaml_file, 'r') as file:
-                parser_config = yaml.safe_load(file)
-                parsers[os.path.basename(yaml_file).split('.')[0]] = parser_config
-        return parsers   
+        self.table_model = ResultTableModel(self)
+        self.table_view = QTableView()
+        self.table_view.setModel(self.table_model)
+        main_layout.addWidget(self.table_view)
+
+        # Plugin statistics, refreshed with the table
+        self.stats_label = QLabel("")
+        self.stats_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        self.stats_label.setStyleSheet("font-family: monospace")
+        main_layout.addWidget(self.stats_label)
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(UI_REFRESH_MS)
+        self.refresh_timer.timeout.connect(self.refresh_view)
 
     def create_parser_selector(self, layout):
-        self.parser_selector = QComboBox()
-        self.parser_selector.addItems(self.parsers.keys())
-        layout.addWidget(self.parser_selector)     
+        # Several parsers can be checked; a single pass over each cell extracts all their entity types
+        self.parser_checkboxes = {}
+        parser_layout = QHBoxLayout()
+        for parser_name in self.parsers.keys():
+            checkbox = QCheckBox(parser_name)
+            checkbox.setChecked(parser_name == DEFAULT_PARSER)
+            self.parser_checkboxes[parser_name] = checkbox
+            parser_layout.addWidget(checkbox)
+        layout.addLayout(parser_layout)
     
     def update_ip_status(self, ip):
         self.ip_status_label.setText(f"Current IP: {ip}")
@@ -292,7 +378,8 @@ class MainWindow(QMainWindow):
         if file_paths:
             self.file_paths = file_paths  # Save selected file paths
             self.file_path_label.setText(', '.join(file_paths))  # Show selected file paths
-            self.analysis_button.setEnabled(True)
+            # Not while a run is going on; it is enabled again when the run ends
+            self.analysis_button.setEnabled(not self.worker_threads)
 
 
 
@@ -316,11 +403,22 @@ class MainWindow(QMainWindow):
         self.error_label.setText(error_message)
 
     def start_analysis(self):
-        selected_parser = self.parsers[self.parser_selector.currentText()]
+        if self.worker_threads:
+            # The running analysis owns self.engine until on_worker_finished shuts it down
+            return
+        selected_parsers = [parser for name, parser in self.parsers.items() if self.parser_checkboxes[name].isChecked()]
+        if not selected_parsers:
+            QMessageBox.warning(self, 'Warning', 'No entity types selected for analysis.')
+            return
         selected_plugins = {name: plugin for name, plugin in self.plugins.items() if self.checkboxes[name].isChecked()}
         if not selected_plugins:
             QMessageBox.warning(self, 'Warning', 'No plugins selected for analysis.')
             return
+        try:
+            DependencyPlan(selected_plugins)
+        except DependencyError as e:
+            QMessageBox.warning(self, 'Warning', f'Cannot order the selected plugins: {e}')
+            return
 
         # Set default output file if none selected
         if not self.selected_output_file:
@@ -330,34 +428,109 @@ class MainWindow(QMainWindow):
         # Fetch command flags for each plugin
         command_flags = {name: self.command_flags[name].text() for name in self.plugins.keys()}
 
-        for file_path in self.file_paths:
-            worker = CsvWorker(file_path, selected_plugins, self.selected_output_file, command_flags, selected_parser)
-            worker.update_status.connect(self.update_status_message)
-            worker.update_table_signal.connect(self.update_table)
-            worker.error_occurred.connect(self.handle_plugin_error)
-            worker.finished.connect(self.on_worker_finished)  # Connect finished signal
-            worker.start()
-            self.worker_threads.append(worker)
+        if self.layout_selector.currentData() == 'none' and self.records_path is None:
+            QMessageBox.warning(self, 'Warning', 'Without result columns, start with --records PATH to keep the results.')
+            return
+        record_sink = None
+        if self.records_path is not None:
+            try:
+                record_sink = open_record_sink(self.records_path)
+            except (ValueError, OSError, sqlite3.Error) as e:
+                QMessageBox.warning(self, 'Warning', f'Cannot write records to {self.records_path}: {e}')
+                return
+        try:
+            remote = start_remote_workers(self.agents, selected_plugins, self.agent_token)
+        except (ValueError, OSError) as e:
+            if record_sink is not None:
+                record_sink.close()
+            QMessageBox.warning(self, 'Warning', f'Cannot use the agents: {e}')
+            return
 
+        # One engine (and memo) per analysis run, shared by all files so repeated entities are only looked up once
+        cache = self.get_result_cache(self.cache_selector.currentData())
+        self.engine = create_engine(selected_plugins, cache, self.max_workers, self.max_in_flight, remote)
+
+        self.table_model.clear()
+        metrics.reset()
+        journal_path = default_journal_path(self.selected_output_file) if self.shards <= 1 else None
+        # One worker runs all files through a job scheduler, which caps how many are processed at once
+        worker = CsvWorker(self.file_paths, selected_plugins, self.selected_output_file, command_flags,
+                           ParserSet(selected_parsers), self.engine, self.layout_selector.currentData(),
+                           self.output_mode_selector.currentData(), self.parallel_files,
+                           journal_path, self.resume_checkbox.isChecked(), self.classifier, self.shards, record_sink)
+        worker.error_occurred.connect(self.handle_plugin_error)
+        worker.finished.connect(self.on_worker_finished)  # Connect finished signal
+        worker.start()
+        self.worker_threads.append(worker)
+        self.refresh_timer.start()
+        self.analysis_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+
+    def cancel_analysis(self):
+        if self.engine is None or self.engine.cancelled:
+            return
+        self.cancel_button.setEnabled(False)
+        self.status_label.setText("Cancelling analysis...")
+        # Resolving the pending results takes the engine's locks, so not in the GUI thread
+        threading.Thread(target=self.engine.cancel, name='cancel', daemon=True).start()
+
+    def get_result_cache(self, mode):
+        if self.result_cache is None:
+            self.result_cache = ResultCache(self.cache_file, mode)
+        else:
+            self.result_cache.mode = mode
+        return self.result_cache
 
     def update_status_message(self, plugin_name, entity, current_line, cell_index):
         status_message = f"Processing {plugin_name} on {entity} (Line {current_line}, Cell {cell_index})"
         self.status_label.setText(status_message)
 
+    def update_memo_stats(self, hits, misses):
+        self.memo_label.setText(f"Cache hits: {hits}, misses: {misses}")
+
+    def refresh_view(self):
+        # One model insert and one label update per tick, however many rows were written since
+        status = None
+        for worker in self.worker_threads:
+            self.table_model.append_rows(worker.take_rows())
+            status = worker.last_status or status
+            self.progress_label.setText('\n'.join(job.describe() for job in worker.scheduler.jobs))
+        if status is not None:
+            self.update_status_message(*status)
+        if self.engine is not None:
+            self.update_memo_stats(*self.engine.memo.stats())
+        self.stats_label.setText('\n'.join(metrics.summary_lines()))
+
     @pyqtSlot(str)
     def on_plugin_link_clicked(self, link):
         self.display_plugin_description(link)
 
     @pyqtSlot()
     def on_worker_finished(self):
+        # Pick up the last rows before finished workers are dropped
+        self.refresh_view()
         # Safely remove and delete finished workers
         for worker in self.worker_threads[:]:
-            if not worker.isRunning():
+            # finished is emitted at the very end of run(), so the sender is done even if it still reports running
+            if worker is self.sender() or not worker.isRunning():
+                worker.wait()
                 self.worker_threads.remove(worker)
                 worker.deleteLater()
 
         if not self.worker_threads:
-            self.status_label.setText("Analysis completed!")
+            self.refresh_timer.stop()
+            self.cancel_button.setEnabled(False)
+            self.analysis_button.setEnabled(True)
+            cancelled = self.engine is not None and self.engine.cancelled
+            self.shutdown_engine()
+            self.status_label.setText("Analysis cancelled" if cancelled else "Analysis completed!")
+
+    def shutdown_engine(self):
+        if self.engine is not None:
+            # Keep the engine's final queue and memo figures in the panel
+            self.stats_label.setText('\n'.join(metrics.summary_lines()))
+            self.engine.shutdown(wait=False)
+            self.engine = None
 
     def display_plugin_description(self, plugin_name):
         # Ensure the plugin name is not empty and correctly formatted
@@ -365,49 +538,64 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, "Error", "Invalid plugin name.")
             return
 
-        yaml_file_path = os.path.join(os.path.dirname(__file__), f'plugins/{plugin_name}.yaml')
         try:
-            with open(yaml_file_path, 'r') as file:
-                plugin_config = yaml.safe_load(file)
-                description = plugin_config.get('description', 'No description available.')
-                QMessageBox.information(self, f"{plugin_name} Description", description)
+            # Served from the plugin registry's manifest cache
+            description = plugin_config(plugin_name).get('description', 'No description available.')
+            QMessageBox.information(self, f"{plugin_name} Description", description)
         except Exception as e:
             QMessageBox.warning(self, "Error", f"Failed to load description for {plugin_name}: {e}")
     
-    def handle_finished_worker(self):
-        worker = self.sender()
-        if worker:
-            worker.deleteLater()  # Safely delete the worker
-        # Refresh the worker_threads list to only keep running threads
-        self.worker_threads = [thread for thread in self.worker_threads if thread.isRunning()]
-        # Now check if all threads have finished
-        if not self.worker_threads:
-            self.status_label.setText("Analysis completed!")  # Update the status label
-
-    def update_table(self, row_data, row_number):
-        current_row_count = self.table_widget.rowCount()
-        if row_number >= current_row_count:
-            self.table_widget.insertRow(row_number)
-
-        for col_number, cell_data in enumerate(row_data):
-            if col_number >= self.table_widget.columnCount():
-                self.table_widget.insertColumn(col_number)
-            item = QTableWidgetItem(cell_data)
-            self.table_widget.setItem(row_number, col_number, item)
-    
     def closeEvent(self, event):
+            if self.engine is not None and self.worker_threads:
+                # Don't wait for the whole input to be analysed
+                self.engine.cancel()
             for worker in self.worker_threads:
                 if worker.isRunning():
                     worker.wait()
+            self.shutdown_engine()
+            if self.result_cache is not None:
+                self.result_cache.close()
+            if self.metrics_exporter is not None:
+                self.metrics_exporter.stop()
             event.accept()
 
 
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description='Mass IP Analysis')
+    parser.add_argument('--headless', action='store_true', help='Run without GUI, see --headless --help')
+    add_engine_arguments(parser)
+    # Leave unknown arguments to Qt
+    return parser.parse_known_args(argv[1:])
+
+
 def main():
-    app = QApplication(sys.argv)
-    main_window = MainWindow()
+    args, qt_args = parse_arguments(sys.argv)
+    configure_logging(args.verbose)
+    app = QApplication(sys.argv[:1] + qt_args)
+    try:
+        classifier = load_classifier(args.classification)
+    except (ClassificationError, OSError) as e:
+        # Running without the lists could send excluded ranges to the plugins
+        QMessageBox.critical(None, "Error", f"Cannot load the classification: {e}")
+        sys.exit(2)
+    if args.records is not None and args.shards > 1:
+        QMessageBox.critical(None, "Error", "--records does not work with --shards")
+        sys.exit(2)
+    agents = agent_addresses(args.agents)
+    if agents and args.shards > 1:
+        QMessageBox.critical(None, "Error", "--agents does not work with --shards")
+        sys.exit(2)
+    try:
+        exporter = start_metrics_exporter(args)
+    except OSError as e:
+        QMessageBox.critical(None, "Error", f"Cannot serve metrics on port {args.metrics_port}: {e}")
+        sys.exit(2)
+    main_window = MainWindow(args.cache_mode, args.cache_file, args.max_workers, args.layout,
+                             args.max_in_flight, args.parallel_files, args.output_mode, args.resume, exporter,
+                             classifier, args.shards, args.records, agents, args.agent_token)
     main_window.show()
     if os.geteuid() != 0:
-        QMessageBox.warning(None, "Info", "It is recommended to run the application with root permissions. Missing root permissions might lead to failures if certain plugins require root permissions. Watch the DEBUG outputs and retry with root privileges if the results are not satisfying.")
+        QMessageBox.warning(None, "Info", "It is recommended to run the application with root permissions. Missing root permissions might lead to failures if certain plugins require root permissions. Start with -v to watch the DEBUG outputs and retry with root privileges if the results are not satisfying.")
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
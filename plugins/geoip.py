@@ -1,51 +1,118 @@
-import subprocess
+import asyncio
+import os
+import shlex
 import logging
 import ipaddress
+import threading
 import datetime
 from datetime import datetime, timezone
 
-def execute_command(command):
+from core.command_runner import run_command
+from core.geoip_table import NOT_FOUND, GeoIPTable
+from core.plugins import plugin_config, run_each_async
+
+_table = None
+_table_loaded = False
+_table_lock = threading.Lock()
+
+def get_table():
     """
-    Executes a system command and returns the output.
+    Loads the local database configured as 'database' in geoip.yaml once, compiling it
+    into a memory-mapped range table if needed. Returns None if no database is configured
+    or it cannot be loaded, in which case lookups fall back to the geoiplookup command.
     """
-    try:
-        result = subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True)
-        output = result.decode('utf-8').strip()
+    global _table, _table_loaded
+    with _table_lock:
+        if _table_loaded:
+            return _table
+        _table_loaded = True
+        plugin_dir = os.path.dirname(os.path.abspath(__file__))
+        database = plugin_config('geoip').get('database')
+        if not database:
+            return None
+        database = os.path.join(plugin_dir, os.path.expanduser(database))
+        try:
+            _table = GeoIPTable.open(database)
+            logging.debug(f"Loaded GeoIP table with {_table.count} ranges from {database}")
+        except Exception as e:
+            logging.error(f"Could not load GeoIP database {database}, falling back to geoiplookup: {e}")
+        return _table
 
-        # Remove "GeoIP Country Edition: " from the output
-        if "GeoIP Country Edition: " in output:
-            output = output.replace("GeoIP Country Edition: ", "")
+def lookup_local(ip_obj, command_flag):
+    """
+    Answers from the local table when possible. Flags are meant for geoiplookup and the
+    table only holds IPv4 ranges, so anything else returns None.
+    """
+    if command_flag or ip_obj.version != 4:
+        return None
+    table = get_table()
+    if table is None:
+        return None
+    return table.lookup(int(ip_obj)) or NOT_FOUND
 
-        return True, output
-    except subprocess.CalledProcessError as e:
-        output = e.output.decode('utf-8').strip()
+async def execute_command(argv):
+    """
+    Executes a system command and returns the output.
+    """
+    _, output = await run_command(argv)
 
-        # Remove "GeoIP Country Edition: " from the error output as well
-        if "GeoIP Country Edition: " in output:
-            output = output.replace("GeoIP Country Edition: ", "")
+    # Remove "GeoIP Country Edition: " from the output, failed lookups included
+    if "GeoIP Country Edition: " in output:
+        output = output.replace("GeoIP Country Edition: ", "")
 
-        return True, output  # Even if the command fails, it's a valid result for our purpose.
+    return True, output  # Even if the command fails, it's a valid result for our purpose.
 
 def run(ip, command_flag=None):
     """
     Main function to be called by the plugin system.
     The 'command_flag' can be used to modify the command behavior.
     """
+    return asyncio.run(run_async(ip, command_flag))
+
+async def run_async(ip, command_flag=None):
+    """
+    Coroutine entry point, driven by the plugin engine's event loop.
+    """
     try:
         ip_obj = ipaddress.ip_address(ip)
-        if ip_obj.is_global:
-            # Append command_flag if provided
-            command = f"geoiplookup {command_flag} {ip}" if command_flag else f"geoiplookup {ip}"
-            logging.debug(f'Executing command: {command}')
-            success, result_message = execute_command(command)
-        else:
-            success = True
-            result_message = f"{ip} is in a private address range, skipped"
+        result_message = lookup_local(ip_obj, command_flag)
+        if result_message is not None:
+            return {'success': True, 'result': result_message}
+        # Append command_flag if provided
+        argv = ['geoiplookup', *shlex.split(command_flag), ip] if command_flag else ['geoiplookup', ip]
+        success, result_message = await execute_command(argv)
 
         return {'success': success, 'result': result_message}
     except ValueError:
         return {'success': False, 'result': f"{ip} is not a valid IP address"}
 
+async def run_batch(ips, command_flag=None):
+    """
+    Looks up all IPv4 addresses of a chunk in the local table at once; everything else
+    goes through run_async.
+    """
+    table = None if command_flag else get_table()
+    local = []
+    remaining = []
+    for ip in ips:
+        try:
+            ip_obj = ipaddress.ip_address(ip)
+        except ValueError:
+            remaining.append(ip)
+            continue
+        if table is not None and ip_obj.version == 4:
+            local.append(ip)
+        else:
+            remaining.append(ip)
+
+    results = {}
+    if local:
+        for ip, label in zip(local, table.lookup_many(local)):
+            results[ip] = {'success': True, 'result': label or NOT_FOUND}
+    if remaining:
+        results.update(await run_each_async(run_async, remaining, command_flag))
+    return results
+
 if __name__ == "__main__":
     # Test the plugin
     test_ip = "8.8.8.8"
@@ -1,39 +1,126 @@
-import subprocess
+import asyncio
+import shlex
 import logging
 import ipaddress
 import datetime
+import xml.etree.ElementTree as ElementTree
 from datetime import datetime, timezone
 
-def execute_command(command):
+from core.command_runner import MAX_OUTPUT_BYTES, run_command
+from core.metrics import TRACE
+
+async def execute_command(argv):
     """
     Executes a system command and returns the output.
     """
-    try:
-        result = subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True)
-        return True, result.decode('utf-8').strip()
-    except subprocess.CalledProcessError as e:
-        return True, e.output.decode('utf-8').strip()  # Return True even in case of a standard error
+    _, output = await run_command(argv)
+    return True, output  # Return True even in case of a standard error
 
 def run(ip, command_flag=None):
     """
     Main function to be called by the plugin system.
     The 'command_flag' can be used to modify the command behavior.
     """
-    ip_obj = ipaddress.ip_address(ip)
-    if ip_obj.is_global:
-        # Append command_flag if provided
-        command = f"nmap {command_flag} {ip}" if command_flag else f"nmap {ip}"
-        logging.debug(f'Executing command: {command}')
-        
-        success, output = execute_command(command)
-        logging.debug(f"Command output for IP {ip}: {output}")
-
-        # Following the standardized format
-        return {'success': success, 'result': output}
-    else:
-        success = True
-        output = f"{ip} is in a private address range, skipped"
-        return {'success': success, 'result': output}
+    return asyncio.run(run_async(ip, command_flag))
+
+async def run_async(ip, command_flag=None):
+    """
+    Coroutine entry point, driven by the plugin engine's event loop.
+    """
+    ipaddress.ip_address(ip)  # Only addresses reach the command line
+    # Append command_flag if provided
+    argv = ['nmap', *shlex.split(command_flag), ip] if command_flag else ['nmap', ip]
+
+    success, output = await execute_command(argv)
+    logging.log(TRACE, f"Command output for IP {ip}: {output}")
+
+    # Following the standardized format
+    return {'success': success, 'result': output}
+
+async def run_batch(ips, command_flag=None):
+    """
+    Scans many IPs with one nmap invocation per address family, using XML output
+    (-oX -) that is split back into one result per host.
+    Returns a dict mapping each IP to a result in the standardized format.
+    """
+    results = {}
+    targets = {4: [], 6: []}
+    for ip in ips:
+        try:
+            ip_obj = ipaddress.ip_address(ip)
+        except ValueError:
+            results[ip] = {'success': False, 'result': f"{ip} is not a valid IP address"}
+            continue
+        targets[ip_obj.version].append(ip)
+
+    for version, version_targets in targets.items():
+        if not version_targets:
+            continue
+        argv = ['nmap', '-oX', '-', *shlex.split(command_flag or '')]
+        if version == 6:
+            argv.append('-6')
+        argv += version_targets
+        _, output = await run_command(argv, max_output_bytes=MAX_OUTPUT_BYTES * len(version_targets))
+        logging.log(TRACE, f"Batch command output for {len(version_targets)} IPs: {output}")
+        results.update(parse_xml_output(output, version_targets))
+
+    return results
+
+def parse_xml_output(output, ips):
+    """
+    Splits nmap XML output into a readable per-host summary.
+    Hosts missing from the report are reported as down.
+    """
+    try:
+        root = ElementTree.fromstring(output)
+    except ElementTree.ParseError as e:
+        return {ip: {'success': False, 'result': f"Could not parse nmap output: {e}"} for ip in ips}
+
+    hosts = {}
+    for host in root.iter('host'):
+        address = host.find("address[@addrtype='ipv4']")
+        if address is None:
+            address = host.find("address[@addrtype='ipv6']")
+        if address is not None:
+            hosts[str(ipaddress.ip_address(address.get('addr')))] = format_host(host, address.get('addr'))
+
+    results = {}
+    for ip in ips:
+        summary = hosts.get(str(ipaddress.ip_address(ip)))
+        if summary is None:
+            summary = f"Nmap scan report for {ip}\nHost seems down."
+        results[ip] = {'success': True, 'result': summary}
+    return results
+
+def format_host(host, ip):
+    lines = [f"Nmap scan report for {ip}"]
+    status = host.find('status')
+    times = host.find('times')
+    if status is not None and status.get('state') == 'up':
+        if times is not None and times.get('srtt'):
+            lines.append(f"Host is up ({int(times.get('srtt')) / 1000000:.2g}s latency).")
+        else:
+            lines.append("Host is up.")
+    elif status is not None:
+        lines.append(f"Host is {status.get('state')} ({status.get('reason')}).")
+
+    ports = host.find('ports')
+    if ports is not None:
+        for extraports in ports.findall('extraports'):
+            lines.append(f"Not shown: {extraports.get('count')} {extraports.get('state')} ports")
+        port_lines = []
+        for port in ports.findall('port'):
+            state = port.find('state')
+            service = port.find('service')
+            port_lines.append(
+                f"{port.get('portid')}/{port.get('protocol')}\t"
+                f"{state.get('state') if state is not None else 'unknown'}\t"
+                f"{service.get('name') if service is not None else ''}"
+            )
+        if port_lines:
+            lines.append("PORT\tSTATE\tSERVICE")
+            lines.extend(port_lines)
+    return '\n'.join(lines)
 
 if __name__ == "__main__":
     # Test the plugin
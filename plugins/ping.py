@@ -1,32 +1,78 @@
-import subprocess
-import logging
+import asyncio
+import shlex
 import ipaddress
 import datetime
 from datetime import datetime, timezone
 
-def execute_command(command):
+from core.command_runner import run_command
+from core.plugins import plugin_config, run_each_async
+from core.prober import DEFAULT_TCP_PORTS, Prober
+
+_probers = {}
+
+def get_prober():
+    """
+    Returns the prober of the running event loop, configured from ping.yaml.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _probers:
+        config = plugin_config('ping')
+        _probers[loop] = Prober(
+            method=config.get('probe_method', 'auto'),
+            tcp_ports=config.get('probe_tcp_ports', DEFAULT_TCP_PORTS),
+            timeout=config.get('probe_timeout', 1.0),
+            retries=config.get('probe_retries', 1),
+            rate=config.get('probe_rate', 500),
+        )
+    return _probers[loop]
+
+def close_prober():
+    prober = _probers.pop(asyncio.get_running_loop(), None)
+    if prober is not None:
+        prober.close()
+
+def format_probe(ip, up, rtt, method):
+    ct = datetime.now(timezone.utc)
+    ct = ct.strftime('%Y-%m-%d %H:%M:%S')
+    if up:
+        return f"{ip}: UP at {ct} (UTC), rtt {rtt * 1000:.1f} ms ({method})"
+    return f"{ip}: DOWN at {ct} (UTC) ({method})"
+
+async def execute_command(argv):
     """
     Executes a system command and returns the output.
     """
-    try:
-        result = subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True)
-        return True, result.decode('utf-8').strip()
-    except subprocess.CalledProcessError as e:
-        return True, e.output.decode('utf-8').strip()
+    _, output = await run_command(argv)
     # Even if the ping command fails, it's a valid result for our purpose.
+    return True, output
 
 def run(ip, command_flag=None):
     """
     Main function to be called by the plugin system.
     The 'command_flag' can be used to modify the command behavior.
     """
+    async def run_once():
+        try:
+            return await run_async(ip, command_flag)
+        finally:
+            close_prober()
+
+    return asyncio.run(run_once())
+
+async def run_async(ip, command_flag=None):
+    """
+    Coroutine entry point, driven by the plugin engine's event loop.
+    Without a command_flag the built-in prober is used, otherwise the ping command.
+    """
     try:
-        ip_obj = ipaddress.ip_address(ip)
-        if ip_obj.is_global:
-            # Append command_flag if provided
-            command = f"ping {command_flag} {ip}" if command_flag else f"ping -c 1 {ip}"
-            logging.debug(f'Executing command: {command}')
-            success, output = execute_command(command)
+        ipaddress.ip_address(ip)
+        if not command_flag:
+            up, rtt, method = await get_prober().probe(ip)
+            success = True
+            result_message = format_probe(ip, up, rtt, method)
+        else:
+            argv = ['ping', *shlex.split(command_flag), ip]
+            success, output = await execute_command(argv)
             ct = datetime.now(timezone.utc)
             ct = ct.strftime('%Y-%m-%d %H:%M:%S')
             # Determine the result based on the output
@@ -34,14 +80,32 @@ def run(ip, command_flag=None):
                 result_message = f"{ip}: UP at {ct} (UTC)"
             else:
                 result_message = f"{ip}: DOWN at {ct} (UTC)"
-        else:
-            success = True
-            result_message = f"{ip} is in a private address range, skipped"
 
         return {'success': success, 'result': result_message}
     except ValueError:
         return {'success': False, 'result': f"{ip} is not a valid IP address"}
 
+async def run_batch(ips, command_flag=None):
+    """
+    Probes all addresses of a chunk concurrently with the built-in prober.
+    """
+    if command_flag:
+        return await run_each_async(run_async, ips, command_flag)
+
+    results = {}
+    targets = []
+    for ip in ips:
+        try:
+            ipaddress.ip_address(ip)
+        except ValueError:
+            results[ip] = {'success': False, 'result': f"{ip} is not a valid IP address"}
+            continue
+        targets.append(ip)
+
+    for ip, (up, rtt, method) in (await get_prober().probe_many(targets)).items():
+        results[ip] = {'success': True, 'result': format_probe(ip, up, rtt, method)}
+    return results
+
 if __name__ == "__main__":
     # Test the plugin
     test_ip = "8.8.8.8"
@@ -1,4 +1,15 @@
 # plugin_name.py
+# Settings go into plugin_name.yaml next to it; the keys the application reads are
+# checked against MANIFEST_SCHEMA in core/plugins.py when the plugins are loaded.
+# entity_classes limits the plugin to some classes of entities, e.g. [global] for public
+# addresses only (classes are explained in classification.yaml); without it, the plugin
+# gets every entity.
+# requires makes the plugin wait for other plugins' results on the same entity and skip it
+# where a condition is not met, e.g. [ping.up]; conditions names regular expressions on this
+# plugin's own results that other plugins can require (see core/dependencies.py).
+# timeout gives up on a run (or batch) after that many seconds: commands started through
+# core.command_runner.run_command from run_async/run_batch are killed, a sync run() is
+# only abandoned, so it should bound its own commands.
 
 
 def flatten_output(command):
@@ -23,6 +34,10 @@ def run(entity, command_flag):
     A dictionary containing:
     - 'success': Boolean indicating if the processing was successful.
     - 'result': The processed result or an error message.
+    - 'throttled' (optional): True if an upstream refused the request for rate limiting.
+      The engine then lowers the plugin's concurrency and request rate, and raises them
+      again while results succeed, up to max_concurrency and max_rate from the YAML
+      ('adaptive: false' keeps max_concurrency fixed).
     """
     
     try:
@@ -40,3 +55,28 @@ def run(entity, command_flag):
     except Exception as e:
         # Handle any exceptions and return an error message in the same format
         return {'success': False, 'result': str(e)}
+
+
+async def run_async(entity, command_flag):
+    """
+    Optional coroutine entry point. If present, the plugin engine drives it on its shared
+    event loop instead of calling run() in a worker thread, so use non-blocking calls only.
+    External tools should be started through core.command_runner.run_command with an argv list:
+
+        returncode, output = await run_command(['tool', *shlex.split(command_flag or ''), entity])
+
+    Returns the same dictionary as run().
+    """
+    return run(entity, command_flag)
+
+
+def run_batch(entities, command_flag):
+    """
+    Optional batch entry point for tools that accept many targets per invocation.
+    If present, the plugin engine groups pending entities into chunks (batch_size and
+    batch_latency in the plugin YAML) and calls this once per chunk. May be a plain
+    function or an `async def`.
+
+    Returns a dictionary mapping every entity to a result dictionary as returned by run().
+    """
+    return {entity: run(entity, command_flag) for entity in entities}
@@ -1,46 +1,54 @@
-import subprocess
+import asyncio
 import logging
 import ipaddress
-import time
-import random
 
-def get_whois_servers():
-    return ['whois.ripe.net', 'whois.arin.net', 'whois.apnic.net']
-
-def rotate_servers(servers, last_server):
-    if last_server in servers:
-        servers.remove(last_server)
-    return random.choice(servers), servers
-
-def execute_command(ip, command_flag=None, max_retries=10, initial_delay=0.1):
-    retries = 0
-    delay = initial_delay
-    last_server = None
-    servers = get_whois_servers()
-
-    while retries < max_retries:
-        whois_server, servers = rotate_servers(servers, last_server)
-        last_server = whois_server
-        command = f'whois -h {whois_server} {command_flag} {ip}' if command_flag else f'whois -h {whois_server} {ip}'
-        logging.debug(f'Attempt {retries+1} with {whois_server}: Executing command: {command}')
-
-        try:
-            result = subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True)
-            output = result.decode('utf-8').strip()
-
-            if 'BLOCK' in output:
-                logging.debug("BLOCK found in output, attempting retry with a different server")
-                raise ValueError("BLOCK found in output")
-
-            return True, output
-
-        except (subprocess.CalledProcessError, ValueError) as e:
-            logging.debug(f"Error or BLOCK detected: {e}. Retrying after {delay} seconds.")
-            retries += 1
-            time.sleep(delay)
-            delay *= 1.1  # Adjusted backoff factor
-
-    return False, "Command failed after retries or BLOCK found in all attempts"
+from core.metrics import TRACE
+from core.plugins import plugin_config
+from core.whois_client import NetblockCache, WhoisClient, WhoisError, WhoisThrottled
+
+_clients = {}
+# Shared by all event loops of the process: answers stay valid for the whole block
+_netblocks = NetblockCache()
+
+def get_client():
+    """
+    Returns the whois client of the running event loop, configured from whois.yaml.
+    Sharing one client keeps the per-server rate limits global to the run.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _clients:
+        config = plugin_config('whois')
+        _clients[loop] = WhoisClient(
+            rate=config.get('server_rate', 1.0),
+            burst=config.get('server_burst', 3),
+            timeout=config.get('query_timeout', 10.0),
+            max_retries=config.get('max_retries', 5),
+        )
+    return _clients[loop]
+
+async def execute_command(ip, command_flag=None):
+    """
+    Queries the authoritative whois server for ip. The 'command_flag' is sent in front
+    of the query, e.g. '-B' for RIPE. Returns (success, output, throttled).
+    """
+    try:
+        server, output = await get_client().lookup(ip, command_flag)
+        logging.log(TRACE, f'WHOIS answer for {ip} from {server}')
+        return True, output, False
+    except WhoisError as e:
+        # Still throttled after all retries: lets the engine slow down whois as a whole
+        return False, f"Query failed: {e}", isinstance(e, WhoisThrottled)
+
+def lookup_block(ip, command_flag=None):
+    """
+    Answers from an earlier response for the same address block, if there is one.
+    """
+    cached = _netblocks.lookup(ip, command_flag)
+    if cached is None:
+        return None
+    block, owner_info = cached
+    logging.log(TRACE, f'WHOIS answer for {ip} taken from cached block {block}')
+    return f"{owner_info}\nBlock: {block} (cached)"
 
 def parse_owner_info(whois_output):
     relevant_descriptors = ['netname', 'country', 'owner', 'OrgName', 'org-name']
@@ -56,20 +64,36 @@ def parse_owner_info(whois_output):
 
 
 def run(ip, command_flag=None):
-    ip_obj = ipaddress.ip_address(ip)
-    if ip_obj.is_global:
-        logging.debug(f'Starting WHOIS lookup for {ip}')
-
-        success, output = execute_command(ip, command_flag)
-        if success:
-            owner_info = parse_owner_info(output).strip()
-        else:
-            owner_info = output  # Here, the output is an error message
-        logging.debug(f'WHOIS lookup result: {owner_info}')
-
-        return {'success': success, 'result': owner_info}
+    async def run_once():
+        try:
+            return await run_async(ip, command_flag)
+        finally:
+            _clients.pop(asyncio.get_running_loop(), None)
+
+    return asyncio.run(run_once())
+
+
+async def run_async(ip, command_flag=None):
+    ipaddress.ip_address(ip)  # Raises for anything but an address
+    cached = lookup_block(ip, command_flag)
+    if cached is not None:
+        return {'success': True, 'result': cached}
+
+    logging.log(TRACE, f'Starting WHOIS lookup for {ip}')
+
+    success, output, throttled = await execute_command(ip, command_flag)
+    if success:
+        owner_info = parse_owner_info(output).strip()
+        block = _netblocks.store(ip, output, owner_info, command_flag)
+        if block is not None:
+            owner_info += f"\nBlock: {block}"
     else:
-        return {'success': True, 'result': f"{ip} is in a private address range, skipped"}
+        owner_info = output  # Here, the output is an error message
+    logging.log(TRACE, f'WHOIS lookup result: {owner_info}')
+
+    if throttled:
+        return {'success': False, 'result': owner_info, 'throttled': True}
+    return {'success': success, 'result': owner_info}
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import the application's packages the way mass_ip_analysis.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,24 @@
+import socket
+
+import pytest
+
+from core import cli
+
+
+class Sink:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_argument_errors_close_what_was_opened(monkeypatch, tmp_path):
+    sink = Sink()
+    monkeypatch.setattr(cli, 'open_record_sink', lambda path: sink)
+    with socket.create_server(('127.0.0.1', 0)) as busy:
+        port = busy.getsockname()[1]
+        with pytest.raises(SystemExit) as exit_info:
+            cli.main(['-p', 'geoip', '--records', str(tmp_path / 'records.jsonl'), '--metrics-port', str(port),
+                      str(tmp_path / 'in.csv')])
+    assert exit_info.value.code == 2
+    assert sink.closed
@@ -0,0 +1,58 @@
+import logging
+import os
+import sys
+import time
+
+from benchmarks.mock_plugins import make_mock_plugin
+from core.engine import CANCELLED_RESULT
+from core.pipeline import create_engine
+
+
+def test_cancel_resolves_pending_runs_and_ignores_late_results(caplog):
+    plugins = {
+        'single': make_mock_plugin('engine_single', latency='fixed:300ms'),
+        'batch': make_mock_plugin('engine_batch', mode='batch', latency='fixed:300ms', batch_size=4,
+                                  batch_latency=0),
+    }
+    engine = create_engine(plugins)
+    try:
+        futures = [engine.submit(name, f'10.0.0.{index}') for name in plugins for index in range(8)]
+        time.sleep(0.1)
+        engine.cancel()
+        assert all(future.done() and future.result() == CANCELLED_RESULT for future in futures)
+        assert engine.submit('single', '10.0.1.1').result() == CANCELLED_RESULT
+        with caplog.at_level(logging.ERROR):
+            # The runs that were already going finish now, into resolved futures
+            time.sleep(0.5)
+    finally:
+        engine.shutdown()
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+
+
+def test_timeout_kills_the_commands_of_a_plugin(tmp_path):
+    marker = tmp_path / 'survived'
+    script = f"sleep 2 && touch {marker}"
+
+    module = type(sys)('engine_hanging')
+
+    async def run_async(entity, command_flag=None):
+        from core.command_runner import run_command
+        returncode, output = await run_command(['sh', '-c', f'({script}) & wait'])
+        return {'success': True, 'result': output}
+
+    module.run = lambda entity, command_flag=None: {'success': True, 'result': ''}
+    module.run_async = run_async
+    sys.modules['engine_hanging'] = module
+    plugin = make_mock_plugin('engine_unused')
+    plugin.update(name='engine_hanging', timeout=0.5)
+    engine = create_engine({'hanging': plugin})
+    try:
+        started = time.monotonic()
+        result = engine.submit('hanging', '10.0.0.1').result()
+        assert result['timed_out'] and result['result'] == "Timed out after 0.5 s"
+        assert time.monotonic() - started < 1.5
+    finally:
+        engine.shutdown()
+    # The background child of the command was killed with its process group
+    time.sleep(2.5)
+    assert not os.path.exists(marker)
@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from core import geoip_table
+from core.geoip_table import GeoIPTable, compile_database
+
+# One row per supported CSV layout, plus a range overlapping the first one
+DATABASE = (
+    '"1.0.0.0","1.0.0.255","16777216","16777471","AU","Australia"\n'
+    '8.8.8.0,8.8.8.255,US,United States\n'
+    '81.0.0.0/8,DE,Germany\n'
+    '1.0.0.128,1.0.1.255,CN,China\n'
+    'start,end,cc\n'
+)
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = tmp_path / 'geo.csv'
+    path.write_text(DATABASE)
+    return str(path)
+
+
+def test_compile_resolves_overlaps_in_favour_of_the_earlier_range(database, tmp_path):
+    assert compile_database(database, str(tmp_path / 'geo.miageo')) == 4
+    table = GeoIPTable(str(tmp_path / 'geo.miageo'))
+    try:
+        assert table.lookup('1.0.0.200') == table.lookup('1.0.0.1')
+        assert table.lookup('1.0.1.1') != table.lookup('1.0.0.1')
+    finally:
+        table.close()
+
+
+def test_lookup(database):
+    table = GeoIPTable.open(database)
+    try:
+        assert table.lookup('1.0.0.1') == 'AU, Australia'
+        assert table.lookup('1.0.1.1') == 'CN, China'
+        assert table.lookup('8.8.8.8') == 'US, United States'
+        assert table.lookup('81.200.1.2') == 'DE, Germany'
+        assert table.lookup(int.from_bytes(bytes([8, 8, 8, 255]), 'big')) == 'US, United States'
+        for missing in ('0.0.0.1', '8.8.9.0', '255.255.255.255'):
+            assert table.lookup(missing) is None
+    finally:
+        table.close()
+
+
+@pytest.mark.parametrize('with_numpy', [False, True])
+def test_lookup_many_matches_lookup(database, monkeypatch, with_numpy):
+    if with_numpy and geoip_table.numpy is None:
+        pytest.skip("numpy is not installed")
+    if not with_numpy:
+        monkeypatch.setattr(geoip_table, 'numpy', None)
+    ips = ['81.1.1.1', '0.0.0.1', '8.8.8.8', '1.0.0.200', '1.0.1.255', '8.8.9.0', '8.8.8.8']
+    table = GeoIPTable.open(database)
+    try:
+        assert table.lookup_many(ips) == [table.lookup(ip) for ip in ips]
+        assert table.lookup_many([]) == []
+    finally:
+        table.close()
+
+
+def test_open_recompiles_a_changed_database(database):
+    table = GeoIPTable.open(database)
+    table.close()
+    with open(database, 'a') as f:
+        f.write('9.9.9.0,9.9.9.255,CH,Switzerland\n')
+    later = os.path.getmtime(database + '.miageo') + 10
+    os.utime(database, (later, later))
+    table = GeoIPTable.open(database)
+    try:
+        assert table.lookup('9.9.9.9') == 'CH, Switzerland'
+    finally:
+        table.close()
@@ -0,0 +1,52 @@
+import csv
+import io
+
+from benchmarks.mock_plugins import MockStats, make_mock_plugin
+from core.classify import Classifier
+from core.parsers import load_parsers, select_parsers
+from core.pipeline import CsvProcessor, create_engine
+
+
+def run_pipeline(plugins, parser_names, text, **options):
+    parser_set = select_parsers(load_parsers('parser'), parser_names)
+    engine = create_engine(plugins)
+    out = io.StringIO()
+    try:
+        processor = CsvProcessor(plugins, {}, parser_set, engine, classifier=Classifier(), **options)
+        processor.process_csv(csv.reader(io.StringIO(text)), csv.writer(out))
+    finally:
+        engine.shutdown()
+    return list(csv.reader(io.StringIO(out.getvalue())))
+
+
+def test_classifier_puts_networks_in_their_own_class():
+    classifier = Classifier()
+    assert classifier.classify('8.8.8.0/24') == 'network'
+    assert classifier.classify('2001:db8::/32') == 'network'
+    assert classifier.classify('8.8.8.8') == 'global'
+    assert classifier.classify('example') == 'other'
+
+
+def test_cidr_cells_are_not_sent_to_address_plugins():
+    stats = MockStats()
+    plugin = make_mock_plugin('cidr_lookup', stats=stats)
+    plugin['entity_classes'] = ['global']
+    rows = run_pipeline({'lookup': plugin}, ['cidr network', 'ipv4 address'],
+                        "net,host\n8.8.8.0/24,1.1.1.1\n")
+    assert rows[0] == ['net', 'host', 'lookup ()']
+    # The network matches in its own cell but gets no result; the address in the other cell does
+    assert rows[1] == ['8.8.8.0/24', '1.1.1.1', 'cidr_lookup:1.1.1.1']
+    assert stats.calls == 1
+
+
+def test_header_layout_keeps_result_columns_in_place():
+    plugin = make_mock_plugin('layout_lookup')
+    rows = run_pipeline({'lookup': plugin}, ['ipv4 address'],
+                        "a,b\n1.1.1.1\n2.2.2.2,x\n3.3.3.3,x,extra,more\n", layout='header')
+    assert rows == [
+        ['a', 'b', 'lookup ()'],
+        ['1.1.1.1', '', 'layout_lookup:1.1.1.1'],
+        ['2.2.2.2', 'x', 'layout_lookup:2.2.2.2'],
+        # Cells beyond the header's width follow the result column
+        ['3.3.3.3', 'x', 'layout_lookup:3.3.3.3', 'extra', 'more'],
+    ]
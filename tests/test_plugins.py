@@ -0,0 +1,75 @@
+import json
+import sys
+
+import pytest
+
+from core import plugins
+from core.plugins import MANIFEST_CACHE_VERSION, PluginRegistry
+
+PLUGIN = '''
+IMPORTS = []
+IMPORTS.append(__name__)
+
+def run(entity, command_flag=None):
+    return {'success': True, 'result': entity}
+'''
+
+
+@pytest.fixture
+def plugin_folder(tmp_path, monkeypatch):
+    """
+    A plugin folder 'registry_plugins' with the plugins 'first' and 'second', importable as
+    registry_plugins.first and registry_plugins.second.
+    """
+    monkeypatch.setattr(plugins, 'BASE_DIR', str(tmp_path))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    folder = tmp_path / 'registry_plugins'
+    folder.mkdir()
+    for name, exec_order in (('first', 2), ('second', 1)):
+        (folder / f'{name}.py').write_text(PLUGIN)
+        (folder / f'{name}.yaml').write_text(f'exec_order: {exec_order}\nbatch_size: 4\n')
+    yield folder
+    for name in ('registry_plugins', 'registry_plugins.first', 'registry_plugins.second'):
+        sys.modules.pop(name, None)
+
+
+def test_load_imports_nothing_until_a_plugin_is_used(plugin_folder):
+    registry = PluginRegistry('registry_plugins')
+    loaded = registry.load()
+    assert list(loaded) == ['second', 'first']
+    assert loaded['first']['name'] == 'registry_plugins.first' and loaded['first']['batch_size'] == 4
+    assert 'registry_plugins.first' not in sys.modules
+
+    entry_points = registry.entry_points(loaded['first'])
+    assert entry_points.run('10.0.0.1') == {'success': True, 'result': '10.0.0.1'}
+    assert registry.entry_points(loaded['first']) is entry_points
+    assert entry_points.module.IMPORTS == ['registry_plugins.first']
+    assert 'registry_plugins.second' not in sys.modules
+
+
+def test_manifests_are_cached_until_their_yaml_changes(plugin_folder, monkeypatch):
+    PluginRegistry('registry_plugins').load()
+    cache_file = plugin_folder / '__pycache__' / 'manifests.json'
+    cache = json.loads(cache_file.read_text())
+    assert cache['version'] == MANIFEST_CACHE_VERSION
+    assert cache['manifests']['first']['manifest'] == {'exec_order': 2, 'batch_size': 4}
+
+    parsed = []
+    safe_load = plugins.yaml.safe_load
+    monkeypatch.setattr(plugins.yaml, 'safe_load', lambda file: parsed.append(file.name) or safe_load(file))
+    assert PluginRegistry('registry_plugins').load()['first']['exec_order'] == 2
+    assert parsed == []
+
+    (plugin_folder / 'first.yaml').write_text('exec_order: 3\nbatch_size: 4\n# changed\n')
+    assert PluginRegistry('registry_plugins').load()['first']['exec_order'] == 3
+    assert parsed == [str(plugin_folder / 'first.yaml')]
+
+    # A cache of another version is ignored
+    cache_file.write_text(json.dumps(dict(json.loads(cache_file.read_text()), version=MANIFEST_CACHE_VERSION + 1)))
+    PluginRegistry('registry_plugins').load()
+    assert len(parsed) == 3
+
+
+def test_plugins_with_an_invalid_manifest_are_skipped(plugin_folder):
+    (plugin_folder / 'second.yaml').write_text('batch_size: 0\n')
+    assert list(PluginRegistry('registry_plugins').load()) == ['first']
@@ -0,0 +1,65 @@
+import asyncio
+import socket
+
+import pytest
+
+from core.prober import Prober, _open_icmp_socket
+
+
+def probe_many(ips, **options):
+    async def run():
+        prober = Prober(**options)
+        try:
+            return await prober.probe_many(ips)
+        finally:
+            prober.close()
+    return asyncio.run(run())
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_tcp_probe_on_loopback():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        port = listener.getsockname()[1]
+        results = probe_many(['127.0.0.1'], method='tcp', tcp_ports=[port], timeout=1.0)
+    up, rtt, method = results['127.0.0.1']
+    assert up and method == 'tcp'
+    assert 0 <= rtt < 1.0
+
+
+def test_tcp_probe_counts_a_refused_connection_as_up():
+    results = probe_many(['127.0.0.2', '127.0.0.3'], method='tcp', tcp_ports=[closed_port()], timeout=1.0)
+    assert [up for up, _, _ in results.values()] == [True, True]
+
+
+def test_tcp_probe_reports_silent_hosts_as_down(monkeypatch):
+    attempts = []
+
+    async def silent(ip, port):
+        attempts.append(port)
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(Prober, '_tcp_connect', staticmethod(silent))
+    results = probe_many(['127.0.0.1'], method='tcp', tcp_ports=[80, 443], timeout=0.1, retries=1)
+    assert results['127.0.0.1'] == (False, None, 'tcp')
+    assert attempts == [80, 443, 80, 443]
+
+
+def test_icmp_probe_on_loopback():
+    sock, _ = _open_icmp_socket(socket.AF_INET)
+    if sock is None:
+        pytest.skip("No ICMP socket available")
+    sock.close()
+    results = probe_many([f'127.0.0.{i}' for i in range(1, 6)], method='icmp', timeout=1.0)
+    assert all(up and method == 'icmp' for up, _, method in results.values())
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        Prober(method='udp')
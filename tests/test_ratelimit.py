@@ -0,0 +1,21 @@
+from core.ratelimit import AimdController
+
+
+def test_throttling_before_any_success_keeps_pacing():
+    controller = AimdController(max_concurrency=1)
+    controller.record('throttled')
+    assert controller.rate == controller.min_rate
+    controller.record('success')
+    assert controller.rate is not None and controller.rate < 2 * controller.min_rate
+
+
+def test_pacing_stops_well_past_the_throttled_level():
+    controller = AimdController(max_concurrency=1)
+    for _ in range(10):
+        controller.record('success')
+    controller.record('throttled')
+    assert 0.1 < controller.rate <= 5
+    # Recovery adds a tenth of the cut level per second
+    controller._last_increase -= 100
+    controller.record('success')
+    assert controller.rate is None
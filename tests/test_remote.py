@@ -0,0 +1,77 @@
+import json
+import socket
+import threading
+
+from benchmarks.mock_plugins import make_mock_plugin
+from core import remote
+from core.metrics import metrics
+from core.pipeline import create_engine
+from core.remote import AgentServer, RemoteWorkers, encode_message
+
+
+class DyingAgent:
+    """
+    An agent that takes `tasks` run messages, never answers them and then drops the
+    connection, or with hang=True just goes silent. It accepts one coordinator only.
+    """
+
+    def __init__(self, tasks, hang=False):
+        self.tasks = tasks
+        self.hang = hang
+        self.received = []
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.address = f"127.0.0.1:{self.listener.getsockname()[1]}"
+        self.released = threading.Event()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        conn, _ = self.listener.accept()
+        self.listener.close()
+        with conn, conn.makefile('rb') as reader:
+            reader.readline()
+            conn.sendall(encode_message({'op': 'hello', 'missing': [], 'slots': self.tasks}))
+            while len(self.received) < self.tasks:
+                self.received.append(json.loads(reader.readline())['id'])
+            if self.hang:
+                self.released.wait()
+
+
+def retries():
+    counters, _, _ = metrics.snapshot()
+    return counters.get(('mia_remote_retries_total', ()), 0)
+
+
+def run_tasks(dying, count=10):
+    engine = create_engine({'probe': make_mock_plugin('remote_probe', latency='fixed:50ms')})
+    server = AgentServer(('127.0.0.1', 0), engine, slots=4)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    workers = RemoteWorkers([dying.address, f'127.0.0.1:{server.server_address[1]}'], ['probe'])
+    retried = retries()
+    try:
+        workers.start()
+        futures = [workers.submit('probe', [f'10.0.0.{index}']) for index in range(count)]
+        results = [future.result(timeout=20) for future in futures]
+    finally:
+        dying.released.set()
+        workers.close()
+        server.shutdown()
+        server.server_close()
+        engine.shutdown()
+    return results, retries() - retried
+
+
+def test_tasks_of_a_lost_agent_go_to_the_other_agents():
+    dying = DyingAgent(4)
+    results, retried = run_tasks(dying)
+    assert len(dying.received) == 4
+    assert results == [{f'10.0.0.{index}': {'success': True, 'result': f'remote_probe:10.0.0.{index}'}}
+                       for index in range(10)]
+    assert retried == 4
+
+
+def test_tasks_of_a_silent_agent_go_to_the_other_agents_once_the_lease_expires(monkeypatch):
+    monkeypatch.setattr(remote, 'LEASE_SECONDS', 1.0)
+    dying = DyingAgent(2, hang=True)
+    results, retried = run_tasks(dying, count=6)
+    assert all(result[entity]['success'] for result in results for entity in result)
+    assert retried == 2
@@ -0,0 +1,97 @@
+import random
+import threading
+import time
+
+import pytest
+
+from benchmarks.mock_plugins import make_mock_plugin
+from core.classify import Classifier
+from core.jobs import JobScheduler
+from core.parsers import load_parsers, select_parsers
+from core.pipeline import DEFAULT_COLUMN_LAYOUT, create_engine
+from core.shards import ShardPool, record_ends, shard_ranges
+
+
+def write_input(path, rows):
+    rng = random.Random(7)
+    lines = ['host,note,extra\n']
+    for index in range(rows):
+        address = f'10.{index % 7}.{index % 251}.{index % 199}'
+        kind = rng.random()
+        if kind < 0.1:
+            # A quoted field spanning lines, with a quote inside
+            lines.append(f'{address},"first line\nsecond ""quoted"" {index}",x\n')
+        elif kind < 0.2:
+            lines.append(f'{address}\n')  # Narrower than the header
+        elif kind < 0.3:
+            lines.append(f'{address},a,b,c,d\n')  # Wider than the header
+        else:
+            lines.append(f'{address},note {index},{address}\n')
+    path.write_text(''.join(lines), newline='')
+
+
+def run_jobs(input_path, output_path, shards):
+    plugins = {'lookup': make_mock_plugin('shard_lookup')}
+    parser_set = select_parsers(load_parsers('parser'), ['ipv4 address'])
+    engine = create_engine(plugins)
+    try:
+        scheduler = JobScheduler(plugins, {}, parser_set, engine, [str(input_path)], str(output_path),
+                                 classifier=Classifier(), shards=shards, shard_min_bytes=0)
+        jobs = scheduler.run()
+    finally:
+        engine.shutdown()
+    return jobs
+
+
+def test_record_ends_skip_newlines_in_quoted_fields(tmp_path):
+    path = tmp_path / 'quoted.csv'
+    path.write_bytes(b'a,"b\nc"\nd,e\n')
+    # The newline at 4 is inside quotes; the record ends after offset 7
+    assert record_ends(str(path), [0, 5, 9]) == [8, 8, 12]
+    header_end, ranges = shard_ranges(str(path), 2)
+    assert header_end == 8
+    assert ranges[0][0] == 8 and ranges[-1][1] == 12
+
+
+def test_sharded_output_is_identical_to_unsharded(tmp_path):
+    input_path = tmp_path / 'input.csv'
+    write_input(input_path, 5000)
+    single = run_jobs(input_path, tmp_path / 'single.csv', shards=1)
+    sharded = run_jobs(input_path, tmp_path / 'sharded.csv', shards=3)
+    assert [job.state for job in single + sharded] == ['done', 'done']
+    assert sharded[0].rows == single[0].rows == 5000
+    assert (tmp_path / 'sharded.csv').read_bytes() == (tmp_path / 'single.csv').read_bytes()
+
+
+def test_cancel_reaches_the_shard_processes(tmp_path):
+    input_path = tmp_path / 'input.csv'
+    write_input(input_path, 3000)
+    plugins = {'slow': make_mock_plugin('shard_slow', latency='fixed:2s', max_concurrency=4)}
+    parser_set = select_parsers(load_parsers('parser'), ['ipv4 address'])
+    engine = create_engine(plugins)
+    scheduler = JobScheduler(plugins, {}, parser_set, engine, [str(input_path)], str(tmp_path / 'out.csv'),
+                             classifier=Classifier(), shards=2, shard_min_bytes=0)
+    threading.Timer(1.0, engine.cancel).start()
+    started = time.monotonic()
+    try:
+        jobs = scheduler.run()
+    finally:
+        engine.shutdown()
+    # Without the cancel, each shard would take 1500 rows x 2 s / 4 slots
+    assert time.monotonic() - started < 20
+    assert jobs[0].state == 'cancelled'
+
+
+def test_slots_are_not_taken_past_the_end():
+    plugins = {'lookup': make_mock_plugin('shard_lookup')}
+    engine = create_engine(plugins)
+    pool = ShardPool(1, 4, plugins, {}, None, engine, DEFAULT_COLUMN_LAYOUT, Classifier())
+    try:
+        assert pool.take_slots(3) == range(0, 3)
+        with pytest.raises(RuntimeError):
+            pool.take_slots(2)
+        # The refused reservation took nothing
+        assert pool.take_slots(1) == range(3, 4)
+    finally:
+        pool.shutdown()
+        engine.shutdown()
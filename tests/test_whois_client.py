@@ -0,0 +1,257 @@
+import asyncio
+import ipaddress
+import time
+
+import pytest
+
+from core.metrics import metrics
+from core.prefix_index import PrefixIndex
+from core.whois_client import (
+    APNIC, ARIN, IANA, LACNIC, RIPE, NetblockCache, WhoisClient, WhoisThrottled, find_block, parse_blocks
+)
+
+
+class FakeWhoisServer:
+    """
+    A local whois server answering every query with the next of its replies (the last one
+    once they run out), which may use {port} of the other servers passed to start().
+    """
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.queries = []
+        self.times = []
+        self.port = None
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def _handle(self, reader, writer):
+        self.queries.append((await reader.readline()).decode().strip())
+        self.times.append(time.monotonic())
+        reply = self.replies.pop(0) if len(self.replies) > 1 else self.replies[0]
+        writer.write(reply.encode())
+        await writer.drain()
+        writer.close()
+
+    def close(self):
+        self._server.close()
+
+
+def local_client(port, **options):
+    """
+    A client routing everything to 127.0.0.1 on port, with fast retries.
+    """
+    index = PrefixIndex()
+    index.insert('0.0.0.0/0', '127.0.0.1')
+    index.insert('::/0', '127.0.0.1')
+    options = {'rate': 0, 'initial_delay': 0.01, 'max_retries': 3, 'timeout': 2, **options}
+    return WhoisClient(port=port, routing_index=index, **options)
+
+
+ARIN_ANSWER = """
+NetRange:       8.0.0.0 - 8.2.255.255
+CIDR:           8.0.0.0/15, 8.2.0.0/16
+NetName:        EXAMPLE
+"""
+
+RIPE_ANSWER = """
+inetnum:        0.0.0.0 - 255.255.255.255
+netname:        IANA-BLK
+inetnum:        193.0.0.0 - 193.0.7.255
+netname:        RIPE-NCC
+"""
+
+
+def networks(*texts):
+    return [ipaddress.ip_network(text) for text in texts]
+
+
+def test_parse_blocks():
+    assert parse_blocks(ARIN_ANSWER) == [
+        ('8.0.0.0 - 8.2.255.255', networks('8.0.0.0/15', '8.2.0.0/16')),
+        ('8.0.0.0/15, 8.2.0.0/16', networks('8.0.0.0/15', '8.2.0.0/16')),
+    ]
+    # LACNIC abbreviates networks
+    assert parse_blocks("inetnum:     200.3.0/16\nowner: Example\n") == [('200.3.0/16', networks('200.3.0.0/16'))]
+    assert parse_blocks("inet6num: 2001:db8::/32\ninetnum: not an address\n") == [
+        ('2001:db8::/32', networks('2001:db8::/32'))]
+
+
+def test_find_block_picks_the_most_specific_block():
+    assert find_block(RIPE_ANSWER, '193.0.6.139') == ('193.0.0.0 - 193.0.7.255', networks('193.0.0.0/21'))
+    assert find_block(RIPE_ANSWER, '8.8.8.8')[0] == '0.0.0.0 - 255.255.255.255'
+    assert find_block(ARIN_ANSWER, '2001:db8::1') is None
+
+
+def test_netblock_cache():
+    cache = NetblockCache()
+    assert cache.store('8.1.2.3', ARIN_ANSWER, 'EXAMPLE') == '8.0.0.0 - 8.2.255.255'
+    assert cache.lookup('8.2.200.1') == ('8.0.0.0 - 8.2.255.255', 'EXAMPLE')
+    assert cache.lookup('8.3.0.1') is None
+    assert cache.hits == 1
+    # Blocks are kept per query flags
+    assert cache.lookup('8.1.2.3', '-B') is None
+    cache.store('8.1.2.3', ARIN_ANSWER, 'EXAMPLE -B', '-B')
+    assert cache.lookup('8.1.2.4', '-B') == ('8.0.0.0 - 8.2.255.255', 'EXAMPLE -B')
+    assert cache.lookup('8.1.2.4') == ('8.0.0.0 - 8.2.255.255', 'EXAMPLE')
+
+
+def test_netblock_cache_ignores_blocks_shorter_than_min_prefix():
+    cache = NetblockCache(min_prefix_v4=8)
+    assert cache.store('8.8.8.8', RIPE_ANSWER, 'IANA-BLK') is None
+    assert cache.lookup('8.8.8.8') is None
+    assert NetblockCache(min_prefix_v4=16).store('8.1.2.3', ARIN_ANSWER, 'EXAMPLE') is None
+
+
+def test_addresses_are_routed_to_their_rir():
+    client = WhoisClient()
+    assert client.server_for('8.8.8.8') == ARIN
+    assert client.server_for('193.0.6.139') == RIPE
+    assert client.server_for('1.1.1.1') == APNIC
+    assert client.server_for('200.160.2.3') == LACNIC
+    assert client.server_for('2a00:1450::1') == RIPE
+    # Not in the built-in tables
+    assert client.server_for('0.1.2.3') == IANA
+
+
+def test_referrals_are_followed_to_the_port_they_name():
+    async def scenario():
+        rir = await FakeWhoisServer("inetnum: 0.0.0.0 - 255.255.255.255\n").start()
+        registrar = await FakeWhoisServer("inetnum: 8.8.8.0 - 8.8.8.255\nnetname: GOOGLE\n").start()
+        rir.replies = [f"NetRange: 8.0.0.0 - 8.255.255.255\nReferralServer: whois://127.0.0.1:{registrar.port}\n"]
+        try:
+            return await local_client(rir.port).lookup('8.8.8.8'), rir, registrar
+        finally:
+            rir.close()
+            registrar.close()
+
+    (server, response), rir, registrar = asyncio.run(scenario())
+    assert server == f'127.0.0.1:{registrar.port}'
+    assert 'GOOGLE' in response
+    assert rir.queries == ['8.8.8.8'] and registrar.queries == ['8.8.8.8']
+
+
+def test_rwhois_referrals_are_not_followed():
+    async def scenario():
+        rir = await FakeWhoisServer("NetRange: 8.0.0.0 - 8.255.255.255\nReferralServer: rwhois://rwhois.example.net:4321\n").start()
+        try:
+            return await local_client(rir.port).lookup('8.8.8.8')
+        finally:
+            rir.close()
+
+    server, response = asyncio.run(scenario())
+    assert server == '127.0.0.1'
+    assert 'NetRange' in response
+
+
+def test_failed_referral_keeps_the_last_answer():
+    async def scenario():
+        # Nothing listens on the referred port once the placeholder server is closed
+        gone = await FakeWhoisServer("").start()
+        gone.close()
+        rir = await FakeWhoisServer(f"NetRange: 8.0.0.0 - 8.255.255.255\nReferralServer: whois://127.0.0.1:{gone.port}\n").start()
+        try:
+            return await local_client(rir.port, max_retries=1).lookup('8.8.8.8')
+        finally:
+            rir.close()
+
+    server, response = asyncio.run(scenario())
+    assert server == '127.0.0.1'
+    assert 'NetRange' in response
+
+
+def test_every_server_has_its_own_token_bucket():
+    async def scenario():
+        first = await FakeWhoisServer("netname: FIRST\n").start()
+        second = await FakeWhoisServer("netname: SECOND\n").start()
+        client = local_client(first.port, rate=5, burst=1)
+        try:
+            started = time.monotonic()
+            await asyncio.gather(*(client.query('127.0.0.1', '8.8.8.8') for _ in range(3)),
+                                 client.query(f'127.0.0.1:{second.port}', '8.8.8.8'))
+            return started, first, second, client
+        finally:
+            first.close()
+            second.close()
+
+    started, first, second, client = asyncio.run(scenario())
+    assert client.bucket('127.0.0.1') is not client.bucket(f'127.0.0.1:{second.port}')
+    # Three queries at 5 per second with a burst of 1 take at least 0.4 s ...
+    assert first.times[-1] - started >= 0.35
+    # ... while the other server's bucket lets its query through right away
+    assert second.times[0] - started < 0.2
+
+
+def test_placeholder_answers_are_referred_to_iana():
+    async def scenario():
+        rir = await FakeWhoisServer("inetnum: 0.0.0.0 - 255.255.255.255\n"
+                                    "netname: NON-RIPE-NCC-MANAGED-ADDRESS-BLOCK\n").start()
+        iana = await FakeWhoisServer("inetnum: 8.0.0.0 - 8.255.255.255\nstatus: LEGACY\n").start()
+        client = local_client(rir.port)
+        client._address = lambda server: ('127.0.0.1', iana.port if server == IANA else rir.port)
+        try:
+            return await client.lookup('8.8.8.8'), rir, iana
+        finally:
+            rir.close()
+            iana.close()
+
+    (server, response), rir, iana = asyncio.run(scenario())
+    assert server == IANA and 'LEGACY' in response
+    # Neither answer counts as throttling
+    assert len(rir.queries) == 1 and len(iana.queries) == 1
+
+
+def test_netnames_ending_in_block_are_not_throttling():
+    metrics.reset()
+
+    async def scenario():
+        server = await FakeWhoisServer("% Information related to '192.0.2.0 - 192.0.2.255'\n"
+                                       "inetnum: 192.0.2.0 - 192.0.2.255\nnetname: EXAMPLE-NETBLOCK\n").start()
+        try:
+            return await local_client(server.port).query('127.0.0.1', '192.0.2.1'), server
+        finally:
+            server.close()
+
+    response, server = asyncio.run(scenario())
+    assert 'EXAMPLE-NETBLOCK' in response
+    assert len(server.queries) == 1
+    counters, _, _ = metrics.snapshot()
+    assert not any(name == 'mia_plugin_throttled_total' for name, _ in counters)
+
+
+def test_throttled_queries_back_off_and_retry():
+    metrics.reset()
+
+    async def scenario():
+        server = await FakeWhoisServer("%ERROR:201: access denied\n", "%ERROR:201: access denied\n",
+                                       "netname: EXAMPLE\n").start()
+        client = local_client(server.port, initial_delay=0.05, max_retries=5)
+        try:
+            return await client.query('127.0.0.1', '8.8.8.8'), server
+        finally:
+            server.close()
+
+    response, server = asyncio.run(scenario())
+    assert 'EXAMPLE' in response
+    assert len(server.queries) == 3
+    # Backoff doubles: at least 0.05 s, then 0.1 s between the attempts
+    assert server.times[1] - server.times[0] >= 0.05
+    assert server.times[2] - server.times[1] >= 0.1
+    counters, _, _ = metrics.snapshot()
+    assert sum(value for (name, _), value in counters.items() if name == 'mia_plugin_throttled_total') == 2
+
+
+def test_throttling_that_does_not_end_raises():
+    async def scenario():
+        server = await FakeWhoisServer("Query rate limit exceeded\n").start()
+        try:
+            await local_client(server.port, max_retries=2).query('127.0.0.1', '8.8.8.8')
+        finally:
+            server.close()
+
+    with pytest.raises(WhoisThrottled):
+        asyncio.run(scenario())
@@ -0,0 +1,64 @@
+import socketserver
+import threading
+
+import pytest
+
+from core.pipeline import create_engine
+from core.plugins import load_plugins
+from core.prefix_index import PrefixIndex
+from core.whois_client import NetblockCache, WhoisClient
+from plugins import whois
+
+ANSWER = ("% Information related to '192.0.2.0 - 192.0.2.255'\n"
+          "inetnum: 192.0.2.0 - 192.0.2.255\n"
+          "netname: EXAMPLE-NETBLOCK\n"
+          "country: ZZ\n")
+
+
+class WhoisHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.queries.append(self.rfile.readline().decode().strip())
+        self.wfile.write(ANSWER.encode())
+
+
+@pytest.fixture
+def whois_server(monkeypatch):
+    """
+    A local whois server answering every query with ANSWER, used by the whois plugin
+    with a fresh netblock cache.
+    """
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), WhoisHandler)
+    server.daemon_threads = True
+    server.queries = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    index = PrefixIndex()
+    index.insert('0.0.0.0/0', '127.0.0.1')
+    client = WhoisClient(rate=0, initial_delay=0.01, max_retries=3, port=server.server_address[1],
+                         routing_index=index)
+    monkeypatch.setattr(whois, 'get_client', lambda: client)
+    monkeypatch.setattr(whois, '_netblocks', NetblockCache())
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_answers_naming_a_block_are_not_throttled(whois_server):
+    engine = create_engine({'whois': load_plugins()['whois']})
+    try:
+        limit = engine.concurrency_limit('whois')
+        result = engine.submit('whois', '192.0.2.1').result(timeout=10)
+    finally:
+        engine.shutdown()
+    assert result['success'] and not result.get('throttled')
+    assert 'EXAMPLE-NETBLOCK' in result['result']
+    assert whois_server.queries == ['192.0.2.1']
+    # The adaptive controller saw a success, not a reason to slow down
+    assert engine.concurrency_limit('whois') == limit
+
+
+def test_addresses_in_an_answered_block_are_served_from_the_cache(whois_server):
+    first = whois.run('192.0.2.1')
+    second = whois.run('192.0.2.77')
+    assert whois_server.queries == ['192.0.2.1']
+    assert first == {'success': True, 'result': 'netname:EXAMPLE-NETBLOCK\ncountry:ZZ\nBlock: 192.0.2.0 - 192.0.2.255'}
+    assert second == {'success': True, 'result': first['result'] + ' (cached)'}